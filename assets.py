@@ -0,0 +1,107 @@
+"""页面静态资源：启动时读入内存并预压缩
+
+CSS/JS 按内容哈希命名（app.<hash>.js），可以永久缓存；index.html 每次按 ETag 协商，
+内容不变时返回 304。整个房间的设备同时扫码打开页面时，服务器只需返回很少的数据。
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 内容哈希命名的资源可以永久缓存
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# 页面入口每次都要向服务器确认是否有更新
+REVALIDATE_CACHE = "no-cache"
+# 小于这个大小的资源压缩收益不大
+COMPRESS_MIN_SIZE = 256
+
+
+class Asset:
+    """一个静态资源的原始内容和各压缩版本"""
+
+    def __init__(self, body: bytes, content_type: str, cache_control: str):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        # 编码 -> (内容, ETag)，同一资源不同编码的字节不同，强 ETag 也要不同
+        self.encodings = {"identity": (body, f'"{self.digest}"')}
+        if len(body) >= COMPRESS_MIN_SIZE:
+            self._add_encoding("gzip", "gz", gzip.compress(body, compresslevel=9, mtime=0))
+            if brotli is not None:
+                self._add_encoding("br", "br", brotli.compress(body, quality=11))
+
+    def _add_encoding(self, encoding: str, suffix: str, body: bytes):
+        if len(body) < len(self.encodings["identity"][0]):
+            self.encodings[encoding] = (body, f'"{self.digest}-{suffix}"')
+
+    def negotiate(self, accept_encoding: str) -> str:
+        """按 Accept-Encoding 选择最小的可用编码"""
+        accepted = set()
+        for item in accept_encoding.split(","):
+            name, _, params = item.strip().partition(";")
+            if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(name.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def response(self, request: Request) -> Response:
+        encoding = self.negotiate(request.headers.get("accept-encoding", ""))
+        body, etag = self.encodings[encoding]
+        headers = {"ETag": etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if etag_matches(request.headers.get("if-none-match"), self.encodings):
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type=self.content_type, headers=headers)
+
+
+def etag_matches(if_none_match: str | None, encodings: dict) -> bool:
+    """If-None-Match 中的任一 ETag 与资源的任一编码版本相同即视为未修改"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return any(etag in tags for _, etag in encodings.values())
+
+
+class StaticAssets:
+    """从目录加载页面资源，index.html 中引用的文件改写为带内容哈希的地址"""
+
+    def __init__(self, directory: str, prefix: str = "/static/", index: str = "index.html"):
+        self.prefix = prefix
+        self.assets: dict[str, Asset] = {}
+        page = None
+        renames = {}
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), "rb") as f:
+                body = f.read()
+            if name == index:
+                page = body
+                continue
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if content_type.startswith("text/") or content_type == "application/javascript":
+                content_type += "; charset=utf-8"
+            asset = Asset(body, content_type, IMMUTABLE_CACHE)
+            stem, ext = os.path.splitext(name)
+            hashed = f"{stem}.{asset.digest[:10]}{ext}"
+            self.assets[hashed] = asset
+            renames[name] = prefix + hashed
+        if page is None:
+            raise FileNotFoundError(os.path.join(directory, index))
+        for name, url in renames.items():
+            page = page.replace(f'"{name}"'.encode(), f'"{url}"'.encode())
+        self.index = Asset(page, "text/html; charset=utf-8", REVALIDATE_CACHE)
+
+    def get(self, name: str) -> Asset | None:
+        return self.assets.get(name)
@@ -0,0 +1,1264 @@
+"""信令服务性能基准
+
+用法: python bench.py fanout
+      python bench.py stall
+      python bench.py relay
+      python bench.py sfu      (需要 aiortc)
+      python bench.py p2p      (需要 aiortc)
+      python bench.py stun
+      python bench.py turn     (需要 aiortc)
+      python bench.py workers  (需要 Linux)
+      python bench.py tls
+      python bench.py heartbeat
+      python bench.py record   (需要 aiortc)
+      python bench.py hls      (需要 aiortc)
+      python bench.py resume
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from main import DEFAULT_ROOM, SIMULCAST_LAYERS, ConnectionManager, orjson
+
+
+class FakeWebSocket:
+    """只统计发送次数的假连接，delay 模拟慢速客户端"""
+
+    def __init__(self, delay=0.0):
+        self.sent = 0
+        self.delay = delay
+        self.last_received = None
+
+    async def accept(self):
+        pass
+
+    async def send_bytes(self, message):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent += 1
+        self.last_received = time.perf_counter()
+
+    async def send_text(self, message):
+        # 与 websockets 一致，文本帧每次发送都要重新编码
+        await self.send_bytes(message.encode())
+
+    async def close(self, code=1000):
+        pass
+
+
+async def drain(manager):
+    """等待所有发送队列清空"""
+    while any(peer.queue and peer.writer is not None for peer in manager.peers.values()):
+        await asyncio.sleep(0)
+
+
+async def close_all(manager):
+    """断开所有连接并等待发送任务退出"""
+    writers = [peer.writer for peer in manager.peers.values() if peer.writer is not None]
+    for client_id in list(manager.peers):
+        manager.disconnect(client_id)
+    await asyncio.gather(*writers, return_exceptions=True)
+
+
+async def bench_fanout(viewer_counts, rounds):
+    """测量每条信令消息触发的发送次数随观看人数的变化"""
+    print(f"{'观看人数':>8} {'单条发送次数':>12} {'耗时/条(us)':>12}")
+    for viewers in viewer_counts:
+        manager = ConnectionManager()
+        sharer = FakeWebSocket()
+        await manager.connect(sharer, 0)
+        sockets = {}
+        for viewer_id in range(1, viewers + 1):
+            sockets[viewer_id] = FakeWebSocket()
+            await manager.connect(sockets[viewer_id], viewer_id)
+
+        # 每个观看者与投屏端完成一次 offer/answer/ICE 交换
+        start = time.perf_counter()
+        messages = 0
+        for _ in range(rounds):
+            for viewer_id in sockets:
+                manager.relay(f'{{"type": "offer", "targetId": {viewer_id}, "data": {{}}}}', 0)
+                manager.relay('{"type": "answer", "targetId": 0, "data": {}}', viewer_id)
+                manager.relay(f'{{"type": "ice-candidates", "to": {viewer_id}, "data": {{}}}}', 0)
+                messages += 3
+                await asyncio.sleep(0)
+        await drain(manager)
+        elapsed = time.perf_counter() - start
+        await close_all(manager)
+
+        sent = sharer.sent + sum(ws.sent for ws in sockets.values())
+        print(f"{viewers:>8} {sent / messages:>12.2f} {elapsed / messages * 1e6:>12.2f}")
+
+
+async def bench_stall(viewers, delay):
+    """一个卡住的观看者不应拖慢其他人收到广播"""
+    manager = ConnectionManager()
+    stalled = FakeWebSocket(delay=delay)
+    await manager.connect(stalled, 0)
+    sockets = [FakeWebSocket() for _ in range(viewers)]
+    for viewer_id, ws in enumerate(sockets, start=1):
+        await manager.connect(ws, viewer_id)
+
+    start = time.perf_counter()
+    for count in range(20):
+        manager.broadcast(DEFAULT_ROOM, f'{{"type": "user-count", "data": {count}}}'.encode())
+        await asyncio.sleep(0)
+    while any(ws.sent < 20 for ws in sockets):
+        await asyncio.sleep(0)
+    latest = max(ws.last_received for ws in sockets) - start
+
+    print(f"卡住的客户端延迟 {delay * 1000:.0f}ms/条，其余 {viewers} 人收齐 20 条广播耗时 {latest * 1000:.2f}ms")
+    print(f"统计: {manager.stats()}")
+    await close_all(manager)
+
+
+# 模拟一条约 3KB 的 offer 和一条 ICE 候选
+SAMPLE_SDP = "v=0\r\n" + "a=candidate:1 1 udp 2122260223 192.168.1.10 54321 typ host\r\n" * 45
+SAMPLE_CANDIDATE = {"candidate": "candidate:1 1 udp 2122260223 192.168.1.10 54321 typ host",
+                    "sdpMid": "0", "sdpMLineIndex": 0}
+
+
+async def legacy_relay(sockets, data, sender_id):
+    """旧实现：解析、盖 from、重新编码，再逐个 await send_text"""
+    message = json.loads(data)
+    message['from'] = sender_id
+    text = json.dumps(message)
+    for client_id, ws in sockets.items():
+        if client_id != sender_id:
+            await ws.send_text(text)
+
+
+async def bench_relay(viewers, count):
+    """对比旧实现与一次编码转发路径的消息吞吐"""
+    offer = json.dumps({"type": "offer", "targetId": 1, "data": {"type": "offer", "sdp": SAMPLE_SDP}})
+    candidate = json.dumps({"type": "ice-candidates", "targetId": 1,
+                            "data": {"candidates": [SAMPLE_CANDIDATE] * 4, "done": False}})
+    presence = json.dumps({"type": "start-sharing"})
+    print(f"JSON后端: {'orjson' if orjson else 'json'}，观看人数 {viewers}")
+    print(f"{'消息':>14} {'旧实现(msg/s)':>14} {'新实现(msg/s)':>14}")
+
+    for name, data, targeted in (("offer", offer, True), ("ice-candidates", candidate, True),
+                                 ("start-sharing", presence, False)):
+        sockets = {client_id: FakeWebSocket() for client_id in range(viewers + 1)}
+        # 旧实现中所有消息都会广播给全部连接
+        start = time.perf_counter()
+        for _ in range(count):
+            await legacy_relay(sockets, data, 0)
+        legacy = count / (time.perf_counter() - start)
+
+        manager = ConnectionManager()
+        for client_id in range(viewers + 1):
+            await manager.connect(FakeWebSocket(), client_id)
+        start = time.perf_counter()
+        for sent in range(count):
+            manager.relay(data, 0)
+            # 模拟并发到达的消息，攒一批再让发送任务清空队列
+            if sent % 50 == 49:
+                await drain(manager)
+        await drain(manager)
+        current = count / (time.perf_counter() - start)
+        await close_all(manager)
+
+        label = name if targeted else f"{name}(广播)"
+        print(f"{label:>14} {legacy:>14.0f} {current:>14.0f}")
+
+
+async def bench_sfu(viewer_counts, seconds):
+    """本机回环端到端验证 SFU：投屏端推一路合成视频，所有观看者同时收到画面，
+    偶数号观看者请求 quarter 层级"""
+    from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+    from sfu import SFU, SFU_PEER_ID
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+
+    print(f"{'观看人数':>8} {'最少收到帧数':>12} {'投屏端上行(KB)':>14} {'各观看者画面宽度':>16}")
+    for viewers in viewer_counts:
+        publisher_id = 1
+        viewer_ids = list(range(2, viewers + 2))
+        connections = {}
+        frames = dict.fromkeys(viewer_ids, 0)
+        widths = dict.fromkeys(viewer_ids, 0)
+        tasks = []
+
+        async def count_frames(client_id, track):
+            while True:
+                frame = await track.recv()
+                frames[client_id] += 1
+                widths[client_id] = frame.width
+
+        async def on_message(client_id, message):
+            """模拟页面脚本对 SFU 消息的处理"""
+            msg_type = message['type']
+            if msg_type == 'request-watching':
+                pc = connections[client_id] = RTCPeerConnection()
+                pc.addTrack(VideoStreamTrack())
+                await pc.setLocalDescription(await pc.createOffer())
+                offer = {"type": "offer", "sdp": pc.localDescription.sdp}
+                sfu.handle("bench", client_id, {"type": "offer", "targetId": SFU_PEER_ID, "data": offer})
+            elif msg_type == 'answer':
+                data = message['data']
+                await connections[client_id].setRemoteDescription(RTCSessionDescription(data['sdp'], data['type']))
+            elif msg_type == 'start-sharing':
+                sfu.handle("bench", client_id, {"type": "request-watching", "targetId": SFU_PEER_ID})
+            elif msg_type == 'offer':
+                pc = connections[client_id] = RTCPeerConnection()
+
+                @pc.on("track")
+                def on_track(track):
+                    tasks.append(asyncio.create_task(count_frames(client_id, track)))
+
+                data = message['data']
+                await pc.setRemoteDescription(RTCSessionDescription(data['sdp'], data['type']))
+                await pc.setLocalDescription(await pc.createAnswer())
+                answer = {"type": "answer", "sdp": pc.localDescription.sdp}
+                sfu.handle("bench", client_id, {"type": "answer", "targetId": SFU_PEER_ID, "data": answer})
+                if client_id % 2 == 0:
+                    sfu.handle("bench", client_id, {"type": "request-layer", "targetId": SFU_PEER_ID,
+                                                    "data": "quarter"})
+
+        def send(client_id, message):
+            tasks.append(asyncio.create_task(on_message(client_id, message)))
+
+        def broadcast(room, message, sender_id):
+            for client_id in viewer_ids:
+                if client_id != sender_id:
+                    send(client_id, message)
+
+        sfu = SFU(send, broadcast, layers=SIMULCAST_LAYERS)
+        sfu.request_publish("bench", publisher_id)
+        await asyncio.sleep(seconds)
+
+        stats = await connections[publisher_id].getStats()
+        uploaded = sum(getattr(report, 'bytesSent', 0) for report in stats.values()
+                       if report.type == 'outbound-rtp')
+        print(f"{viewers:>8} {min(frames.values()):>12} {uploaded / 1024:>14.1f} "
+              f"{' '.join(str(width) for width in widths.values()):>16}")
+
+        for task in tasks:
+            task.cancel()
+        sfu.close(publisher_id, disconnected=True)
+        await asyncio.gather(*(pc.close() for pc in connections.values()))
+
+
+async def start_server(port):
+    """在当前事件循环中启动服务"""
+    import uvicorn
+    from main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def stop_server(server, task):
+    server.should_exit = True
+    await task
+
+
+# 模拟改动前页面写死的公网 STUN：离线局域网中请求发出后没有应答，这里用不会应答的
+# 文档保留地址代替。浏览器会查询列表中的所有服务器，aiortc 只查询第一个，因此只放这一个
+LEGACY_ICE_SERVERS = [
+    {"urls": "stun:198.51.100.1:19302"},
+]
+
+
+class PageClient:
+    """按页面脚本的信令协议模拟一个浏览器客户端，用 aiortc 收发合成视频"""
+
+    def __init__(self, uri, legacy_ice=False):
+        self.uri = uri
+        self.legacy_ice = legacy_ice
+        self.ice_servers = LEGACY_ICE_SERVERS if legacy_ice else []
+        self.watch_requested_at = None
+        self.first_frame_at = None
+        self.client_id = None
+        self.websocket = None
+        self.reader = None
+        self.sharing = False
+        self.remote_peer_id = None
+        self.peer_connection = None  # 观看端与投屏端的连接
+        self.peer_connections = {}  # 投屏端按观看者ID维护的连接
+        self.frames = 0
+        self.tasks = []
+        self.source = None
+
+    async def connect(self):
+        import websockets
+
+        self.websocket = await websockets.connect(self.uri)
+        self.reader = asyncio.create_task(self._read())
+        while self.client_id is None:
+            await asyncio.sleep(0.01)
+
+    async def send(self, message):
+        await self.websocket.send(json.dumps(message))
+
+    async def start_sharing(self):
+        from aiortc import VideoStreamTrack
+        from aiortc.contrib.media import MediaRelay
+
+        self.source = (MediaRelay(), VideoStreamTrack())
+        self.sharing = True
+        await self.send({"type": "start-sharing"})
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        connections = [*self.peer_connections.values(), self.peer_connection]
+        await asyncio.gather(*(pc.close() for pc in connections if pc is not None))
+        await self.websocket.close()
+        self.reader.cancel()
+
+    async def _read(self):
+        async for data in self.websocket:
+            message = json.loads(data)
+            try:
+                await self._handle(message)
+            except Exception as e:
+                print(f"客户端 {self.client_id} 处理 {message['type']} 失败: {e}")
+
+    def _new_connection(self):
+        from aiortc import RTCConfiguration, RTCIceServer, RTCPeerConnection
+
+        # aiortc 每类服务器只使用第一个地址
+        servers = [RTCIceServer(**server) for server in self.ice_servers]
+        return RTCPeerConnection(RTCConfiguration(iceServers=servers))
+
+    async def _handle(self, message):
+        from aiortc import RTCSessionDescription
+
+        msg_type, data, sender = message['type'], message.get('data'), message.get('from')
+        if msg_type == 'client-id':
+            self.client_id = data
+        elif msg_type == 'server-config' and not self.legacy_ice:
+            self.ice_servers = data['ice']['iceServers']
+        elif msg_type == 'ping':
+            await self.send({"type": "pong"})
+        elif msg_type == 'start-sharing' and not self.sharing:
+            self.watch_requested_at = time.perf_counter()
+            await self.send({"type": "request-watching", "targetId": sender})
+        elif msg_type == 'request-watching' and self.sharing:
+            old = self.peer_connections.pop(sender, None)
+            if old is not None:
+                await old.close()
+            pc = self.peer_connections[sender] = self._new_connection()
+            relay, track = self.source
+            pc.addTrack(relay.subscribe(track))
+            await pc.setLocalDescription(await pc.createOffer())
+            offer = {"type": "offer", "sdp": pc.localDescription.sdp}
+            await self.send({"type": "offer", "targetId": sender, "data": offer})
+        elif msg_type == 'offer' and not self.sharing:
+            if self.peer_connection is not None:
+                await self.peer_connection.close()
+            self.remote_peer_id = sender
+            pc = self.peer_connection = self._new_connection()
+
+            @pc.on("track")
+            def on_track(track):
+                self.tasks.append(asyncio.create_task(self._count_frames(track)))
+
+            await pc.setRemoteDescription(RTCSessionDescription(data['sdp'], data['type']))
+            await pc.setLocalDescription(await pc.createAnswer())
+            answer = {"type": "answer", "sdp": pc.localDescription.sdp}
+            await self.send({"type": "answer", "targetId": sender, "data": answer})
+        elif msg_type == 'answer' and sender in self.peer_connections:
+            await self.peer_connections[sender].setRemoteDescription(
+                RTCSessionDescription(data['sdp'], data['type']))
+        elif msg_type == 'stop-sharing':
+            if self.sharing:
+                pc = self.peer_connections.pop(sender, None)
+                if pc is not None:
+                    await pc.close()
+            elif sender == self.remote_peer_id and self.peer_connection is not None:
+                await self.peer_connection.close()
+                self.peer_connection = None
+
+    async def _count_frames(self, track):
+        while True:
+            await track.recv()
+            if self.first_frame_at is None:
+                self.first_frame_at = time.perf_counter()
+            self.frames += 1
+
+
+async def bench_p2p(viewers, seconds, port, legacy_ice=False):
+    """无头负载测试：一个投屏端同时向多个观看者点对点推流，所有观看者都应持续收到画面
+
+    legacy_ice 使用改动前写死的 ICE 配置，用于对比首帧耗时。
+    """
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+    server, server_task = await start_server(port)
+    uri = f"ws://127.0.0.1:{port}/ws?room=bench"
+
+    sharer = PageClient(uri, legacy_ice)
+    await sharer.connect()
+    await sharer.start_sharing()
+
+    # 观看者依次加入，之前的观看者不应被后来者打断
+    clients = []
+    for _ in range(viewers):
+        client = PageClient(uri, legacy_ice)
+        await client.connect()
+        clients.append(client)
+        await asyncio.sleep(0.2)
+
+    await asyncio.sleep(seconds / 2)
+    midpoint = [client.frames for client in clients]
+    await asyncio.sleep(seconds / 2)
+
+    print(f"{'观看者':>6} {'收到帧数':>8} {'后半段帧数':>10} {'首帧耗时':>10}")
+    failed = []
+    for index, client in enumerate(clients):
+        recent = client.frames - midpoint[index]
+        if client.first_frame_at is None:
+            first_frame = "-"
+        else:
+            first_frame = f"{(client.first_frame_at - client.watch_requested_at) * 1000:.0f}ms"
+        print(f"{index + 1:>6} {client.frames:>8} {recent:>10} {first_frame:>10}")
+        if recent <= 0:
+            failed.append(index + 1)
+    print(f"投屏端同时维护 {len(sharer.peer_connections)} 个连接")
+
+    for client in [sharer, *clients]:
+        await client.close()
+    await stop_server(server, server_task)
+
+    if failed or len(sharer.peer_connections) != viewers:
+        raise SystemExit(f"以下观看者没有持续收到画面: {failed}")
+
+
+class STUNFloodClient(asyncio.DatagramProtocol):
+    """保持固定数量的 Binding 请求在途，记录每个请求的往返时延"""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.transport = None
+        self.pending = {}
+        self.latencies = []
+        self.running = True
+
+    def connection_made(self, transport):
+        self.transport = transport
+        for _ in range(self.concurrency):
+            self.send_request()
+
+    def send_request(self):
+        from stun import BINDING_REQUEST, HEADER, MAGIC_COOKIE
+
+        transaction_id = os.urandom(12)
+        self.pending[transaction_id] = time.perf_counter()
+        self.transport.sendto(HEADER.pack(BINDING_REQUEST, 0, MAGIC_COOKIE, transaction_id))
+
+    def datagram_received(self, data, addr):
+        sent = self.pending.pop(data[8:20], None)
+        if sent is not None:
+            self.latencies.append(time.perf_counter() - sent)
+        if self.running:
+            self.send_request()
+
+
+async def bench_stun(seconds, concurrency):
+    """本机回环压测内置 STUN 服务器"""
+    from stun import start_stun_server
+
+    loop = asyncio.get_running_loop()
+    server, protocol = await start_stun_server('127.0.0.1', 0)
+    port = server.get_extra_info('sockname')[1]
+    client, flood = await loop.create_datagram_endpoint(
+        lambda: STUNFloodClient(concurrency), remote_addr=('127.0.0.1', port))
+
+    # 丢包的请求超时后补发，保证在途数量不变
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        await asyncio.sleep(0.1)
+        now = time.perf_counter()
+        for transaction_id, sent in list(flood.pending.items()):
+            if now - sent > 1.0:
+                del flood.pending[transaction_id]
+                flood.send_request()
+    flood.running = False
+    elapsed = time.perf_counter() - start
+    client.close()
+    server.close()
+
+    latencies = sorted(flood.latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"在途请求 {concurrency}，{elapsed:.1f}s 内处理 {protocol.requests} 个请求")
+    print(f"吞吐 {len(latencies) / elapsed:.0f} req/s，p50 {p50:.3f}ms，p99 {p99:.3f}ms")
+
+
+class EchoProtocol(asyncio.DatagramProtocol):
+    """TURN 测试中的对端：收到什么就原样发回"""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+class WindowedClient(asyncio.DatagramProtocol):
+    """保持固定数量的包在途，收到回包后立即补发，记录往返时延"""
+
+    def __init__(self, size):
+        self.size = size
+        self.send = None
+        self.sent = {}
+        self.latencies = []
+        self.sequence = 0
+        self.running = True
+
+    def send_packet(self):
+        self.sequence += 1
+        self.sent[self.sequence] = time.perf_counter()
+        self.send(self.sequence.to_bytes(8, 'big') + bytes(self.size - 8))
+
+    def datagram_received(self, data, addr):
+        sent = self.sent.pop(int.from_bytes(data[:8], 'big'), None)
+        if sent is None:
+            return
+        self.latencies.append(time.perf_counter() - sent)
+        if self.running:
+            self.send_packet()
+
+
+async def run_window(client, seconds, concurrency):
+    """跑满 seconds 秒，返回 (包/秒, p50 毫秒)"""
+    client.latencies = []
+    client.running = True
+    for _ in range(concurrency):
+        client.send_packet()
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        await asyncio.sleep(0.1)
+        # 丢失的包超时后补发，保证在途数量不变
+        now = time.perf_counter()
+        for sequence, sent in list(client.sent.items()):
+            if now - sent > 1.0:
+                del client.sent[sequence]
+                client.send_packet()
+    client.running = False
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.1)
+    client.sent.clear()
+    latencies = sorted(client.latencies)
+    return len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000
+
+
+async def bench_turn(seconds, concurrency, size):
+    """本机回环测试 TURN 中继的吞吐、时延和每包开销，对比直连"""
+    from aioice.turn import create_turn_endpoint
+    from stun import start_stun_server
+    from turn import CHANNEL_HEADER, TURNProtocol, issue_credentials
+
+    loop = asyncio.get_running_loop()
+    secret = os.urandom(32)
+    # 服务器默认拒绝中继到本机地址，测试时显式放行回环上的对端
+    server, turn = await start_stun_server('127.0.0.1', 0,
+                                           lambda: TURNProtocol(secret, allowed_peers=['127.0.0.1']))
+    port = server.get_extra_info('sockname')[1]
+    peer, _ = await loop.create_datagram_endpoint(EchoProtocol, local_addr=('127.0.0.1', 0))
+    peer_addr = peer.get_extra_info('sockname')
+
+    # 直连基线
+    direct, direct_client = await loop.create_datagram_endpoint(
+        lambda: WindowedClient(size), remote_addr=peer_addr)
+    direct_client.send = direct.sendto
+    direct_rate, direct_p50 = await run_window(direct_client, seconds, concurrency)
+    direct.close()
+
+    # 经 TURN 中继，aioice 会为对端绑定通道后用 ChannelData 发送
+    username, password = issue_credentials(secret, 1, 600)
+    relayed, relayed_client = await create_turn_endpoint(
+        lambda: WindowedClient(size), server_addr=('127.0.0.1', port),
+        username=username, password=password)
+    relayed_client.send = lambda data: relayed.sendto(data, peer_addr)
+    turn_rate, turn_p50 = await run_window(relayed_client, seconds, concurrency)
+    relayed.close()
+    await asyncio.sleep(0.1)
+    peer.close()
+    server.close()
+
+    # Send 指示：消息头 20 + XOR-PEER-ADDRESS 12 + DATA 属性头 4
+    indication_overhead = 20 + 12 + 4
+    print(f"包大小 {size} 字节，在途 {concurrency} 个")
+    print(f"直连:     {direct_rate:8.0f} 包/s  {direct_rate * size * 8 / 1e6:7.1f} Mbit/s  p50 往返 {direct_p50:.3f}ms")
+    print(f"TURN中继: {turn_rate:8.0f} 包/s  {turn_rate * size * 8 / 1e6:7.1f} Mbit/s  p50 往返 {turn_p50:.3f}ms")
+    print(f"中继转发 {turn.relayed_packets} 个包，{turn.relayed_bytes / 1e6:.1f} MB")
+    print(f"每包开销: ChannelData {CHANNEL_HEADER.size} 字节 "
+          f"({CHANNEL_HEADER.size / size:.1%})，Send/Data 指示 {indication_overhead} 字节 "
+          f"({indication_overhead / size:.1%})")
+
+
+async def wait_for_port(port, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+class SignalingClient:
+    """只收发信令的客户端，按类型记录收到的消息"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.client_id = None
+        self.received = {}
+        self.user_count = 0
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        async for data in self.websocket:
+            message = json.loads(data)
+            msg_type = message['type']
+            if msg_type == 'client-id':
+                self.client_id = message['data']
+            elif msg_type == 'user-count':
+                self.user_count = message['data']
+            self.received.setdefault(msg_type, []).append(message)
+
+    async def close(self):
+        await self.websocket.close()
+        self.reader.cancel()
+
+
+async def wait_until(condition, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def bench_workers(worker_counts, clients, messages, port):
+    """多 worker 端到端测试：客户端由内核分配到各 worker，跨 worker 的房间状态和信令转发应与单进程一致"""
+    import websockets
+    from main import spawn_workers
+
+    print(f"{'worker数':>8} {'各worker连接数':>16} {'房间人数正确':>12} {'点对点(msg/s)':>14} {'广播(msg/s)':>12}")
+    for workers in worker_counts:
+        processes = spawn_workers(workers, '127.0.0.1', port)
+        try:
+            await wait_for_port(port)
+            await asyncio.sleep(0.5)
+            uri = f"ws://127.0.0.1:{port}/ws?room=bench"
+            peers = []
+            for _ in range(clients):
+                peer = SignalingClient(await websockets.connect(uri))
+                peers.append(peer)
+            await wait_until(lambda: all(peer.client_id for peer in peers))
+            distribution = [0] * workers
+            for peer in peers:
+                distribution[peer.client_id % workers] += 1
+            counts_ok = await wait_until(lambda: all(peer.user_count == clients for peer in peers))
+
+            # 第一个客户端投屏，其余客户端都应收到通知
+            sharer, viewers = peers[0], peers[1:]
+            await sharer.websocket.send(json.dumps({"type": "start-sharing"}))
+            await wait_until(lambda: all('start-sharing' in viewer.received for viewer in viewers))
+
+            # 投屏端向每个观看者点对点发送 offer
+            start = time.perf_counter()
+            for index in range(messages):
+                viewer = viewers[index % len(viewers)]
+                await sharer.websocket.send(json.dumps(
+                    {"type": "offer", "targetId": viewer.client_id, "data": {"sdp": SAMPLE_SDP}}))
+            delivered = await wait_until(
+                lambda: sum(len(viewer.received.get('offer', [])) for viewer in viewers) >= messages)
+            targeted = messages / (time.perf_counter() - start) if delivered else 0
+
+            # 投屏端反复广播在线状态，每条都要送达所有观看者
+            rounds = max(1, messages // len(viewers))
+            start = time.perf_counter()
+            for _ in range(rounds):
+                await sharer.websocket.send(json.dumps({"type": "start-sharing"}))
+            delivered = await wait_until(
+                lambda: all(len(viewer.received['start-sharing']) > rounds for viewer in viewers))
+            broadcast = rounds * len(viewers) / (time.perf_counter() - start) if delivered else 0
+
+            for peer in peers:
+                await peer.close()
+            print(f"{workers:>8} {str(distribution):>16} {'是' if counts_ok else '否':>12} "
+                  f"{targeted:>14.0f} {broadcast:>12.0f}")
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+
+def tls_handshake(server_context, client_context, session=None):
+    """在内存中完成一次 TLS 握手，返回 (服务端握手耗时, 客户端会话, 是否为恢复的会话)"""
+    import ssl
+
+    server_in, server_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+    client_in, client_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+    server = server_context.wrap_bio(server_in, server_out, server_side=True)
+    client = client_context.wrap_bio(client_in, client_out, server_hostname="localhost", session=session)
+    server_time = 0.0
+    client_done = server_done = False
+    while not (client_done and server_done):
+        if not client_done:
+            try:
+                client.do_handshake()
+                client_done = True
+            except ssl.SSLWantReadError:
+                pass
+            server_in.write(client_out.read())
+        if not server_done:
+            start = time.perf_counter()
+            try:
+                server.do_handshake()
+                server_done = True
+            except ssl.SSLWantReadError:
+                pass
+            server_time += time.perf_counter() - start
+            client_in.write(server_out.read())
+    # TLS 1.3 的会话票据在握手之后发送，客户端读一次数据才能拿到
+    server.write(b"x")
+    client_in.write(server_out.read())
+    client.read(1)
+    return server_time, client.session, client.session_reused
+
+
+def bench_tls(handshakes):
+    """对比 RSA 2048 和 ECDSA P-256 证书的启动耗时、完整握手和会话恢复的服务端开销"""
+    import ssl
+    import tempfile
+    from cert import ensure_cert
+
+    print(f"{'证书':>6} {'生成(ms)':>9} {'复用(ms)':>9} {'完整握手(ms)':>13} {'恢复握手(ms)':>13} "
+          f"{'完整(次/s)':>11} {'恢复(次/s)':>11} {'恢复率':>7}")
+    with tempfile.TemporaryDirectory() as directory:
+        for key_type in ("rsa", "ecdsa"):
+            certfile = os.path.join(directory, f"{key_type}-cert.pem")
+            keyfile = os.path.join(directory, f"{key_type}-key.pem")
+            start = time.perf_counter()
+            ensure_cert(certfile, keyfile, key_type=key_type)
+            generate_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            ensure_cert(certfile, keyfile, key_type=key_type)
+            reuse_ms = (time.perf_counter() - start) * 1000
+
+            server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            server_context.load_cert_chain(certfile, keyfile)
+            client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            client_context.load_verify_locations(certfile)
+
+            # 每次都是新客户端
+            full = sum(tls_handshake(server_context, client_context)[0] for _ in range(handshakes))
+
+            # 同一客户端断线重连，带上次的会话
+            _, session, _ = tls_handshake(server_context, client_context)
+            resumed = 0.0
+            reused = 0
+            for _ in range(handshakes):
+                elapsed, session, was_reused = tls_handshake(server_context, client_context, session)
+                resumed += elapsed
+                reused += was_reused
+
+            print(f"{key_type.upper():>6} {generate_ms:>9.1f} {reuse_ms:>9.1f} "
+                  f"{full / handshakes * 1000:>13.3f} {resumed / handshakes * 1000:>13.3f} "
+                  f"{handshakes / full:>11.0f} {handshakes / resumed:>11.0f} {reused / handshakes:>7.0%}")
+
+
+def bench_heartbeat_scheduler(connections, active_fraction, interval=15.0, timeout=40.0):
+    """心跳调度的开销：按模拟时钟推进，统计每个连接每个周期的检查耗时"""
+    from heartbeat import Heartbeat
+
+    pings, evicted = [0], []
+    heartbeat = Heartbeat(interval, timeout, lambda client_id: pings.__setitem__(0, pings[0] + 1),
+                          evicted.append)
+    for client_id in range(connections):
+        heartbeat.add(client_id)
+    base = min(heartbeat.last_seen.values())
+    active = int(connections * active_fraction)
+    # 活跃连接每秒都有消息，其余连接从不回复，模拟 3 个超时周期
+    elapsed = 0.0
+    now = base
+    while now < base + 3 * timeout:
+        now += heartbeat.resolution * 10
+        for client_id in range(active):
+            heartbeat.last_seen[client_id] = now
+        start = time.perf_counter()
+        heartbeat.check(now)
+        elapsed += time.perf_counter() - start
+    periods = 3 * timeout / interval
+    return elapsed / (connections * periods) * 1e6, pings[0], len(evicted)
+
+
+async def bench_heartbeat(clients, silent, interval, timeout, port):
+    """心跳端到端测试：部分客户端停止响应（模拟断网），观察者统计多久收到 user-count/stop-sharing"""
+    import websockets
+    from main import manager
+
+    print(f"{'连接数':>8} {'活跃比例':>8} {'每连接每周期(µs)':>16} {'ping':>8} {'超时断开':>8}")
+    for connections in (10_000, 100_000):
+        for active_fraction in (0.0, 0.9):
+            per_connection, pings, evicted = bench_heartbeat_scheduler(connections, active_fraction)
+            print(f"{connections:>8} {active_fraction:>8.0%} {per_connection:>16.3f} {pings:>8} {evicted:>8}")
+
+    manager.heartbeat.interval, manager.heartbeat.timeout = interval, timeout
+    # 测量的是发现断网的时间，不保留会话
+    manager.resume_grace = 0
+    server, task = await start_server(port)
+    try:
+        uri = f"ws://127.0.0.1:{port}/ws?room=heartbeat"
+        observer = SignalingClient(await websockets.connect(uri, ping_interval=None))
+        alive, dead = [], []
+        for index in range(clients):
+            websocket = await websockets.connect(uri, ping_interval=None)
+            (dead if index < silent else alive).append(websocket)
+
+        async def respond(websocket):
+            # 正常页面：收到 ping 回复 pong
+            async for data in websocket:
+                if json.loads(data)['type'] == 'ping':
+                    await websocket.send(json.dumps({"type": "pong"}))
+
+        async def observer_respond():
+            while True:
+                pings = observer.received.pop('ping', [])
+                for _ in pings:
+                    await observer.websocket.send(json.dumps({"type": "pong"}))
+                await asyncio.sleep(0.05)
+
+        responders = [asyncio.create_task(respond(websocket)) for websocket in alive]
+        responders.append(asyncio.create_task(observer_respond()))
+        # 断网的客户端不再读取，也不发送关闭帧
+        for websocket in dead:
+            websocket.transport.pause_reading()
+        await wait_until(lambda: observer.user_count == clients + 1)
+        silenced = time.perf_counter()
+        evicted = await wait_until(lambda: len(observer.received.get('stop-sharing', [])) >= silent,
+                                   timeout=timeout * 3)
+        detected = time.perf_counter() - silenced
+        remaining = len(manager.peers)
+        print(f"\n{silent}/{clients} 个客户端停止响应（间隔 {interval}s，超时 {timeout}s）: "
+              f"{'全部' if evicted else '未能全部'}在 {detected:.2f}s 内断开，剩余连接 {remaining}"
+              f"（期望 {clients - silent + 1}），心跳 ping {manager.heartbeat.pings} 次")
+        for responder in responders:
+            responder.cancel()
+        for websocket in [*alive, *dead]:
+            websocket.transport.abort()
+        await observer.close()
+    finally:
+        await stop_server(server, task)
+
+
+def pattern_frame(width, height, index):
+    """合成一帧逐帧移动的条纹画面，编码器每帧都有真实的变化需要编码"""
+    import av
+
+    frame = av.VideoFrame(width, height, "yuv420p")
+    size = frame.planes[0].buffer_size
+    pattern = PATTERN[:256] * (size // 256 + 2)
+    offset = index * 7 % 256
+    frame.planes[0].update(pattern[offset:offset + size])
+    for plane in frame.planes[1:]:
+        plane.update(bytes([128]) * plane.buffer_size)
+    return frame
+
+
+PATTERN = bytes((value * 3) & 0xff for value in range(256))
+
+
+def pattern_track(width=640, height=480):
+    """合成的移动条纹视频轨道，供录制和 HLS 测试作为投屏画面"""
+    from aiortc import VideoStreamTrack
+
+    class PatternTrack(VideoStreamTrack):
+        def __init__(self):
+            super().__init__()
+            self.index = 0
+
+        async def recv(self):
+            pts, time_base = await self.next_timestamp()
+            frame = pattern_frame(width, height, self.index)
+            self.index += 1
+            frame.pts, frame.time_base = pts, time_base
+            return frame
+
+    return PatternTrack()
+
+
+def bench_segment_writer(directory, format, width, height, frames, segment_seconds):
+    """分段写入的编码吞吐：按 30fps 的时间戳送入合成帧"""
+    from fractions import Fraction
+    from recorder import SegmentWriter
+
+    writer = SegmentWriter(os.path.join(directory, f"writer-{format}"), segment_seconds, format)
+    start = time.perf_counter()
+    for index in range(frames):
+        frame = pattern_frame(width, height, index)
+        frame.pts = index * 3000
+        frame.time_base = Fraction(1, 90000)
+        writer.write(frame)
+    writer.close()
+    elapsed = time.perf_counter() - start
+    total = sum(segment["bytes"] for segment in writer.index["segments"])
+    return frames / elapsed, len(writer.index["segments"]), total
+
+
+def verify_recording(directory):
+    """读取索引，逐段解码确认可以播放，并测试按时间定位"""
+    import av
+    from recorder import find_segment
+
+    with open(os.path.join(directory, "index.json"), encoding="utf-8") as f:
+        index = json.load(f)
+    decoded = 0
+    for segment in index["segments"]:
+        with av.open(os.path.join(directory, segment["file"])) as container:
+            decoded += sum(1 for _ in container.decode(video=0))
+    seeks = []
+    for fraction in (0.1, 0.5, 0.9):
+        found = find_segment(index, index["duration"] * fraction)
+        if found is None:
+            continue
+        segment, offset = found
+        start = time.perf_counter()
+        with av.open(os.path.join(directory, segment["file"])) as container:
+            stream = container.streams.video[0]
+            container.seek(int(offset / stream.time_base), stream=stream)
+            next(container.decode(stream))
+        seeks.append(time.perf_counter() - start)
+    return index, decoded, seeks
+
+
+async def bench_record(seconds, segment_seconds, port):
+    """录制端到端测试：合成画面的投屏端经回环点对点推流给录制端，检查分段文件和索引"""
+    import tempfile
+    from aiortc.contrib.media import MediaRelay
+    from main import encode, manager
+    from recorder import RECORDER_PEER_ID, Recorder
+
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'格式':>5} {'分辨率':>10} {'编码(fps)':>10} {'段数':>5} {'大小(KB)':>9}")
+        for format in ("mp4", "webm"):
+            fps, segments, size = bench_segment_writer(directory, format, 1280, 720, 150, 2.0)
+            print(f"{format:>5} {'1280x720':>10} {fps:>10.1f} {segments:>5} {size / 1024:>9.0f}")
+
+        manager.recorder = Recorder(lambda client_id, message: manager.send_to(client_id, encode(message)),
+                                    os.path.join(directory, "recordings"), segment_seconds=segment_seconds)
+        server, server_task = await start_server(port)
+        try:
+            sharer = PageClient(f"ws://127.0.0.1:{port}/ws?room=录制测试")
+            await sharer.connect()
+            await sharer.start_sharing()
+            sharer.source = (MediaRelay(), pattern_track())
+            cpu = time.process_time()
+            await asyncio.sleep(seconds)
+            active = manager.recorder.stats()
+            await sharer.send({"type": "stop-sharing"})
+            await wait_until(lambda: not manager.recorder.recordings, timeout=10)
+            cpu = time.process_time() - cpu
+            connected = RECORDER_PEER_ID in sharer.peer_connections
+            await sharer.close()
+        finally:
+            await stop_server(server, server_task)
+            manager.recorder = None
+
+        [recording] = [root for root, _, files in os.walk(os.path.join(directory, "recordings"))
+                       if "index.json" in files]
+        index, decoded, seeks = verify_recording(recording)
+        print(f"\n回环录制 {seconds}s（分段 {segment_seconds}s）: 录制端连接{'成功' if connected else '失败'}，"
+              f"写入 {sum(segment['frames'] for segment in index['segments'])} 帧 / "
+              f"{len(index['segments'])} 段 / {index['duration']:.2f}s，回读解码 {decoded} 帧，"
+              f"丢弃 {active['dropped']} 帧，进程 CPU {cpu / seconds:.0%}")
+        print(f"目录: {os.path.relpath(recording, directory)}，"
+              f"按索引定位并解码首帧平均 {sum(seeks) / max(1, len(seeks)) * 1000:.1f}ms")
+        for segment in index["segments"]:
+            print(f"  {segment['file']}  起始 {segment['start']:>6.2f}s  时长 {segment['duration']:>5.2f}s  "
+                  f"{segment['frames']:>4} 帧  {segment['bytes'] / 1024:>6.0f}KB")
+
+
+def hls_viewer_process(base, viewers, seconds, connection):
+    """子进程：viewers 个 LL-HLS 播放器，每个部分段先阻塞请求播放列表再取部分段"""
+    import re
+    import httpx
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    async def viewer(received, latencies):
+        async with httpx.AsyncClient(base_url=base, timeout=10) as client:
+            playlist = (await client.get("playlist.m3u8")).text
+            sequence, index = map(int, re.search(r'PRELOAD-HINT:TYPE=PART,URI="part(\d+)\.(\d+)', playlist).groups())
+            init = await client.get("init.mp4")
+            if init.status_code != 200:
+                return
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                start = time.monotonic()
+                await client.get("playlist.m3u8", params={"_HLS_msn": sequence, "_HLS_part": index})
+                response = await client.get(f"part{sequence}.{index}.m4s")
+                if response.status_code == 404:
+                    # 当前段已结束，下一个部分段在新的段中
+                    sequence, index = sequence + 1, 0
+                    continue
+                received.append(((sequence, index), time.monotonic()))
+                latencies.append(time.monotonic() - start)
+                index += 1
+
+    async def run():
+        results = [([], []) for _ in range(viewers)]
+        await asyncio.gather(*(viewer(received, latencies) for received, latencies in results))
+        return results
+
+    connection.send(asyncio.run(run()))
+
+
+async def bench_hls(viewer_counts, seconds, port):
+    """LL-HLS：一路投屏输入，HTTP 观看者数量增加时服务器的 CPU、请求量和部分段送达时延"""
+    import multiprocessing
+    from aiortc.contrib.media import MediaRelay
+    from hls import HLSIngest
+    from main import encode, manager
+    from qoe import percentile
+
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+    manager.hls = HLSIngest(lambda client_id, message: manager.send_to(client_id, encode(message)), window=60)
+    server, server_task = await start_server(port)
+    sharer = PageClient(f"ws://127.0.0.1:{port}/ws?room=hls")
+    try:
+        await sharer.connect()
+        await sharer.start_sharing()
+        sharer.source = (MediaRelay(), pattern_track())
+        if not await wait_until(lambda: "hls" in manager.hls.streams and len(manager.hls.streams["hls"].segments) >= 2,
+                                timeout=20):
+            raise SystemExit("HLS 拉流没有产生分段")
+        stream = manager.hls.streams["hls"]
+        context = multiprocessing.get_context("spawn")
+        loop = asyncio.get_running_loop()
+
+        print(f"{'观看者':>6} {'CPU':>6} {'每观看者CPU':>11} {'请求/s':>8} {'出流量(Mbit/s)':>14} "
+              f"{'部分段送达p50':>12} {'p99':>8} {'收到/生成':>10}")
+        baseline = None
+        for viewers in viewer_counts:
+            served = stream.bytes_served
+            cpu = time.process_time()
+            start = time.perf_counter()
+            if viewers:
+                parent, child = context.Pipe()
+                process = context.Process(target=hls_viewer_process,
+                                          args=(f"http://127.0.0.1:{port}/hls/hls/", viewers, seconds, child))
+                process.start()
+                results = await loop.run_in_executor(None, parent.recv)
+                process.join()
+            else:
+                await asyncio.sleep(seconds)
+                results = []
+            elapsed = time.perf_counter() - start
+            usage = (time.process_time() - cpu) / elapsed
+            baseline = usage if baseline is None else baseline
+
+            created = {(segment.sequence, index): part.created
+                       for segment in stream.segments.values() for index, part in enumerate(segment.parts)}
+            delays = [arrived - created[key] for received, _ in results for key, arrived in received if key in created]
+            requests = sum(2 * len(latencies) for _, latencies in results)
+            # 每个观看者从收到的第一个到最后一个部分段之间，服务器生成了多少个
+            generated = sum(sum(1 for key in created if received[0][0] <= key <= received[-1][0])
+                            for received, _ in results if received)
+            per_viewer = (usage - baseline) / viewers if viewers else 0
+            p50 = f"{percentile(delays, 0.5) * 1000:.1f}ms" if delays else "-"
+            p99 = f"{percentile(delays, 0.99) * 1000:.1f}ms" if delays else "-"
+            coverage = f"{len(delays) / generated:.0%}" if generated else "-"
+            print(f"{viewers:>6} {usage:>6.0%} {per_viewer:>11.2%} {requests / elapsed:>8.0f} "
+                  f"{(stream.bytes_served - served) * 8 / elapsed / 1e6:>14.1f} {p50:>12} {p99:>8} {coverage:>10}")
+    finally:
+        await sharer.close()
+        await stop_server(server, server_task)
+        await manager.hls.close()
+        manager.hls = None
+
+
+async def bench_resume(rounds, grace, port):
+    """断线重连：客户端断网（不发送关闭帧）后带会话令牌重连，检查身份和角色的恢复、断线期间消息的补发、
+    半开连接的取代，以及保留期满后房间内成员收到离开通知"""
+    import websockets
+    from main import manager
+    from qoe import percentile
+
+    manager.resume_grace = grace
+    server, task = await start_server(port)
+    uri = f"ws://127.0.0.1:{port}/ws?room=resume"
+
+    async def join(url=uri):
+        client = SignalingClient(await websockets.connect(url))
+        await wait_until(lambda: 'session' in client.received)
+        return client, client.received['session'][-1]['data']
+
+    def drop(client):
+        client.websocket.transport.abort()
+        client.reader.cancel()
+
+    try:
+        sharer, sharer_session = await join()
+        await sharer.websocket.send(json.dumps({"type": "start-sharing"}))
+        observer, _ = await join()
+        await wait_until(lambda: 'start-sharing' in observer.received)
+
+        # 观看者断网期间投屏端发来 ICE 重启的 offer，重连后应补发
+        latencies, delivered, same_id = [], 0, 0
+        for _ in range(rounds):
+            viewer, session = await join()
+            client_id = viewer.client_id
+            drop(viewer)
+            await wait_until(lambda: manager.peers[client_id].detached_reason is not None)
+            await sharer.websocket.send(json.dumps({
+                "type": "offer", "targetId": client_id, "restart": True, "data": {"type": "offer", "sdp": ""}}))
+            await asyncio.sleep(0.01)
+            start = time.perf_counter()
+            viewer, resumed = await join(f"{uri}&session={session['token']}")
+            await wait_until(lambda: 'offer' in viewer.received, timeout=1)
+            latencies.append(time.perf_counter() - start)
+            same_id += resumed['resumed'] and viewer.client_id == client_id
+            delivered += 'offer' in viewer.received
+            await viewer.close()
+            await wait_until(lambda: client_id not in manager.peers)
+        print(f"观看者断网重连 {rounds} 次: 恢复原ID {same_id}/{rounds}，补发断线期间的 offer {delivered}/{rounds}，"
+              f"重连到收到补发 p50 {percentile(latencies, 0.5) * 1000:.1f}ms p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+
+        # 投屏端断网后恢复：仍是投屏端，观察者收不到离开通知
+        stops = len(observer.received.get('stop-sharing', []))
+        drop(sharer)
+        await asyncio.sleep(0.1)
+        sharer, resumed = await join(f"{uri}&session={sharer_session['token']}")
+        await asyncio.sleep(0.2)
+        print(f"投屏端断网重连: 恢复 {resumed['resumed']}，仍在投屏 {sharer.client_id in manager.sharers('resume')}，"
+              f"观察者收到 stop-sharing {len(observer.received.get('stop-sharing', [])) - stops} 次")
+
+        # 半开连接：服务端尚未发现旧连接断开，新连接带令牌取代旧连接
+        old, session = await join()
+        new, resumed = await join(f"{uri}&session={session['token']}")
+        await asyncio.wait([old.reader], timeout=5)
+        code = old.websocket.close_code
+        old.reader.cancel()
+        await asyncio.gather(old.reader, return_exceptions=True)
+        await new.websocket.send(json.dumps({"type": "stats", "data": []}))
+        print(f"半开连接: 恢复 {resumed['resumed']}，旧连接关闭码 {code}，新连接在线 {new.client_id in manager.peers}")
+        await new.close()
+
+        # 不再重连：保留期满后才通知房间
+        stops = len(observer.received.get('stop-sharing', []))
+        dropped_at = time.perf_counter()
+        drop(sharer)
+        await wait_until(lambda: len(observer.received.get('stop-sharing', [])) > stops, timeout=grace + 5)
+        print(f"投屏端断网不重连: {time.perf_counter() - dropped_at:.2f}s 后通知房间（保留期 {grace}s），"
+              f"恢复次数 {manager.resumes}，离开原因 {manager.disconnects}")
+        await observer.close()
+    finally:
+        await stop_server(server, task)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="信令服务性能基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    fanout = sub.add_parser("fanout", help="点对点信令的扇出次数")
+    fanout.add_argument("--viewers", type=int, nargs="+", default=[10, 50, 100, 500])
+    fanout.add_argument("--rounds", type=int, default=3)
+
+    stall = sub.add_parser("stall", help="慢速客户端对广播的影响")
+    stall.add_argument("--viewers", type=int, default=100)
+    stall.add_argument("--delay", type=float, default=1.0)
+
+    relay = sub.add_parser("relay", help="信令转发吞吐，对比旧实现")
+    relay.add_argument("--viewers", type=int, default=20)
+    relay.add_argument("--count", type=int, default=2000)
+
+    sfu = sub.add_parser("sfu", help="SFU 回环端到端测试（需要 aiortc）")
+    sfu.add_argument("--viewers", type=int, nargs="+", default=[1, 2, 4])
+    sfu.add_argument("--seconds", type=float, default=5.0)
+
+    p2p = sub.add_parser("p2p", help="多观看者点对点无头负载测试（需要 aiortc）")
+    p2p.add_argument("--viewers", type=int, default=4)
+    p2p.add_argument("--seconds", type=float, default=6.0)
+    p2p.add_argument("--port", type=int, default=8765)
+    p2p.add_argument("--legacy-ice", action="store_true", help="模拟改动前含公网 STUN 的 ICE 配置，首帧要等 STUN 超时，需加大 --seconds")
+
+    stun = sub.add_parser("stun", help="内置 STUN 服务器吞吐和时延")
+    stun.add_argument("--seconds", type=float, default=3.0)
+    stun.add_argument("--concurrency", type=int, default=64)
+
+    turn = sub.add_parser("turn", help="内置 TURN 中继吞吐、时延和每包开销（需要 aiortc）")
+    turn.add_argument("--seconds", type=float, default=3.0)
+    turn.add_argument("--concurrency", type=int, default=32)
+    turn.add_argument("--size", type=int, default=1200)
+
+    workers = sub.add_parser("workers", help="多 worker 共享端口时的房间状态和跨进程转发（需要 Linux）")
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    workers.add_argument("--clients", type=int, default=20)
+    workers.add_argument("--messages", type=int, default=2000)
+    workers.add_argument("--port", type=int, default=8766)
+
+    tls = sub.add_parser("tls", help="证书生成/复用耗时，RSA 与 ECDSA 的完整握手和会话恢复开销")
+    tls.add_argument("--handshakes", type=int, default=300)
+
+    heartbeat = sub.add_parser("heartbeat", help="心跳调度开销和断网客户端的清理时间")
+    heartbeat.add_argument("--clients", type=int, default=200)
+    heartbeat.add_argument("--silent", type=int, default=50)
+    heartbeat.add_argument("--interval", type=float, default=1.0)
+    heartbeat.add_argument("--timeout", type=float, default=3.0)
+    heartbeat.add_argument("--port", type=int, default=8768)
+
+    record = sub.add_parser("record", help="分段写入的编码吞吐，回环录制合成画面并校验索引（需要 aiortc）")
+    record.add_argument("--seconds", type=float, default=6.0)
+    record.add_argument("--segment-seconds", type=float, default=2.0)
+    record.add_argument("--port", type=int, default=8769)
+
+    hls = sub.add_parser("hls", help="LL-HLS 一路输入多个 HTTP 观看者的开销和部分段送达时延（需要 aiortc）")
+    hls.add_argument("--viewers", type=int, nargs="+", default=[0, 1, 10, 50, 100])
+    hls.add_argument("--seconds", type=float, default=6.0)
+    hls.add_argument("--port", type=int, default=8770)
+
+    resume = sub.add_parser("resume", help="断线重连的会话恢复、消息补发和保留期满后的清理")
+    resume.add_argument("--rounds", type=int, default=50)
+    resume.add_argument("--grace", type=float, default=2.0)
+    resume.add_argument("--port", type=int, default=8771)
+
+    args = parser.parse_args()
+    if args.command == "fanout":
+        asyncio.run(bench_fanout(args.viewers, args.rounds))
+    elif args.command == "stall":
+        asyncio.run(bench_stall(args.viewers, args.delay))
+    elif args.command == "relay":
+        asyncio.run(bench_relay(args.viewers, args.count))
+    elif args.command == "sfu":
+        asyncio.run(bench_sfu(args.viewers, args.seconds))
+    elif args.command == "p2p":
+        asyncio.run(bench_p2p(args.viewers, args.seconds, args.port, args.legacy_ice))
+    elif args.command == "stun":
+        asyncio.run(bench_stun(args.seconds, args.concurrency))
+    elif args.command == "turn":
+        asyncio.run(bench_turn(args.seconds, args.concurrency, args.size))
+    elif args.command == "workers":
+        asyncio.run(bench_workers(args.workers, args.clients, args.messages, args.port))
+    elif args.command == "tls":
+        bench_tls(args.handshakes)
+    elif args.command == "heartbeat":
+        asyncio.run(bench_heartbeat(args.clients, args.silent, args.interval, args.timeout, args.port))
+    elif args.command == "record":
+        asyncio.run(bench_record(args.seconds, args.segment_seconds, args.port))
+    elif args.command == "hls":
+        asyncio.run(bench_hls(args.viewers, args.seconds, args.port))
+    elif args.command == "resume":
+        asyncio.run(bench_resume(args.rounds, args.grace, args.port))
+
+
+if __name__ == "__main__":
+    main()
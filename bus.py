@@ -0,0 +1,137 @@
+"""worker 之间的消息总线
+
+多个 worker 进程通过 SO_REUSEPORT 共享同一个端口，同一房间的客户端可能连在不同的 worker 上。
+每个 worker 只保存自己的连接，房间成员变化和需要投递给其他 worker 上客户端的消息通过总线转发。
+
+- LocalBus：单个 worker，没有其他进程，所有操作都是空操作
+- UnixSocketBus：同一台机器上的多个 worker，每个 worker 绑定一个 Unix 数据报套接字
+
+总线消息由一行 JSON 头和可选的原始信令帧组成，信令帧不做二次编码。
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+
+def pack(header: dict, payload: bytes = b"") -> bytes:
+    # JSON 编码结果中不会出现原始换行，可以直接用作分隔符
+    return json.dumps(header, separators=(",", ":")).encode() + b"\n" + payload
+
+
+def unpack(data: bytes) -> tuple[dict, bytes]:
+    header, _, payload = data.partition(b"\n")
+    return json.loads(header), payload
+
+
+class LocalBus:
+    """单进程运行时的总线"""
+
+    def __init__(self):
+        self.worker_index = 0
+        self.workers = 1
+
+    async def start(self, handler):
+        pass
+
+    def publish(self, header: dict, payload: bytes = b""):
+        """发给所有其他 worker"""
+
+    def send(self, worker: int, header: dict, payload: bytes = b""):
+        """发给指定 worker"""
+
+    def close(self):
+        pass
+
+
+class BusProtocol(asyncio.DatagramProtocol):
+    def __init__(self, bus: "UnixSocketBus"):
+        self.bus = bus
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            header, payload = unpack(data)
+        except ValueError:
+            return
+        self.bus.handler(header, payload)
+
+    def error_received(self, exc):
+        logger.debug("总线发送失败: %s", exc)
+
+
+class UnixSocketBus(LocalBus):
+    """同一台机器上多个 worker 之间的总线，每个 worker 监听 <directory>/worker-<序号>.sock
+
+    Unix 数据报在本机内不会丢失也不会乱序，对端队列满时由 asyncio 传输层缓冲。
+    """
+
+    def __init__(self, directory: str, worker_index: int, workers: int, parent_pid: int | None = None):
+        super().__init__()
+        self.directory = directory
+        self.worker_index = worker_index
+        self.workers = workers
+        self.parent_pid = parent_pid
+        self.transport = None
+        self.handler = None
+        self.watchdog = None
+
+    def path(self, worker: int) -> str:
+        return os.path.join(self.directory, f"worker-{worker}.sock")
+
+    async def start(self, handler):
+        self.handler = handler
+        path = self.path(self.worker_index)
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # 信令中的 SDP 可能有几十 KB，调大收发缓冲区避免对端暂时处理不过来时阻塞
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(path)
+        sock.setblocking(False)
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: BusProtocol(self), sock=sock)
+        if self.parent_pid is not None:
+            self.watchdog = asyncio.create_task(self._watch_parent())
+
+    def publish(self, header: dict, payload: bytes = b""):
+        header["worker"] = self.worker_index
+        data = pack(header, payload)
+        for worker in range(self.workers):
+            if worker != self.worker_index:
+                self._sendto(worker, data)
+
+    def send(self, worker: int, header: dict, payload: bytes = b""):
+        if worker != self.worker_index:
+            header["worker"] = self.worker_index
+            self._sendto(worker, pack(header, payload))
+
+    def _sendto(self, worker: int, data: bytes):
+        if self.transport is None:
+            return
+        try:
+            self.transport.sendto(data, self.path(worker))
+        except OSError as e:
+            # 对端 worker 尚未启动或已退出
+            logger.debug("总线发往 worker %s 失败: %s", worker, e)
+
+    async def _watch_parent(self):
+        """主进程被强制结束时 worker 随之退出"""
+        while True:
+            await asyncio.sleep(1)
+            if os.getppid() != self.parent_pid:
+                os._exit(0)
+
+    def close(self):
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        try:
+            os.unlink(self.path(self.worker_index))
+        except OSError:
+            pass
@@ -1,26 +1,49 @@
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 import datetime
 import ipaddress
+import os
 import socket
 
-def generate_cert():
+from interfaces import find_local_addresses
+
+# 证书到期前多少天重新生成
+RENEW_BEFORE = datetime.timedelta(days=30)
+VALID_FOR = datetime.timedelta(days=3650)
+
+
+def generate_key(key_type="ecdsa"):
+    # ECDSA P-256 的签名比 RSA 2048 快一个数量级，握手时服务器的开销主要在签名上
+    if key_type == "rsa":
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return ec.generate_private_key(ec.SECP256R1())
+
+
+def certificate_addresses(addresses=None):
+    """证书中需要包含的 IP 地址：回环地址和本机所有网卡地址"""
+    if addresses is None:
+        addresses = find_local_addresses()
+    return sorted({"127.0.0.1", *addresses}, key=lambda address: ipaddress.ip_address(address).packed)
+
+
+def generate_cert(certfile="cert.pem", keyfile="key.pem", addresses=None, key_type="ecdsa"):
     # 生成私钥
-    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
-    
-    # 获取本机IP
-    try:
-        local_ip = socket.gethostbyname(socket.gethostname())
-    except:
-        local_ip = "127.0.0.1"
-    
+    private_key = generate_key(key_type)
+    addresses = certificate_addresses(addresses)
+
     # 创建证书
     subject = issuer = x509.Name([
         x509.NameAttribute(NameOID.COMMON_NAME, "localhost"),
     ])
-    
+    names = [x509.DNSName("localhost")]
+    hostname = socket.gethostname()
+    if hostname and hostname != "localhost":
+        names.append(x509.DNSName(hostname))
+    names += [x509.IPAddress(ipaddress.ip_address(address)) for address in addresses]
+
+    now = datetime.datetime.now(datetime.timezone.utc)
     cert = x509.CertificateBuilder().subject_name(
         subject
     ).issuer_name(
@@ -30,30 +53,65 @@ def generate_cert():
     ).serial_number(
         x509.random_serial_number()
     ).not_valid_before(
-        datetime.datetime.now(datetime.UTC)
+        now - datetime.timedelta(minutes=5)
     ).not_valid_after(
-        datetime.datetime.now(datetime.UTC) + datetime.timedelta(days=3650)
+        now + VALID_FOR
     ).add_extension(
-        x509.SubjectAlternativeName([
-            x509.DNSName("localhost"),
-            x509.IPAddress(ipaddress.IPv4Address("127.0.0.1")),
-            x509.IPAddress(ipaddress.IPv4Address(local_ip)),
-        ]),
+        x509.SubjectAlternativeName(names),
         critical=False,
     ).sign(private_key, hashes.SHA256())
-    
-    # 保存文件
-    with open("key.pem", "wb") as f:
+
+    # 保存文件，私钥只允许当前用户读取
+    fd = os.open(keyfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
         f.write(private_key.private_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PrivateFormat.PKCS8,
             encryption_algorithm=serialization.NoEncryption()
         ))
-    
-    with open("cert.pem", "wb") as f:
+
+    with open(certfile, "wb") as f:
         f.write(cert.public_bytes(serialization.Encoding.PEM))
-    
-    print("证书生成完成: cert.pem, key.pem")
+
+    print(f"证书生成完成: {certfile}, {keyfile} ({key_type.upper()}, {', '.join(addresses)})")
+
+
+def cert_is_current(certfile, keyfile, addresses=None, key_type="ecdsa"):
+    """已有证书能否继续使用：密钥类型一致、未临近过期、包含本机所有地址且与私钥配对"""
+    try:
+        with open(certfile, "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+        with open(keyfile, "rb") as f:
+            # 私钥是本程序自己生成的，跳过 RSA 的完整性校验（耗时与重新生成相当）
+            private_key = serialization.load_pem_private_key(
+                f.read(), password=None, unsafe_skip_rsa_key_validation=True)
+    except (OSError, ValueError):
+        return False
+
+    expected_type = rsa.RSAPrivateKey if key_type == "rsa" else ec.EllipticCurvePrivateKey
+    if not isinstance(private_key, expected_type):
+        return False
+    if cert.not_valid_after_utc - datetime.datetime.now(datetime.timezone.utc) < RENEW_BEFORE:
+        return False
+    public_format = (serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+    if cert.public_key().public_bytes(*public_format) != private_key.public_key().public_bytes(*public_format):
+        return False
+    try:
+        san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    except x509.ExtensionNotFound:
+        return False
+    present = {str(address) for address in san.get_values_for_type(x509.IPAddress)}
+    return set(certificate_addresses(addresses)) <= present
+
+
+def ensure_cert(certfile="cert.pem", keyfile="key.pem", addresses=None, key_type="ecdsa"):
+    """启动时调用：证书可用时直接复用，否则重新生成。返回是否重新生成"""
+    addresses = certificate_addresses(addresses)
+    if cert_is_current(certfile, keyfile, addresses, key_type):
+        return False
+    generate_cert(certfile, keyfile, addresses, key_type)
+    return True
+
 
 if __name__ == "__main__":
-    generate_cert()
\ No newline at end of file
+    generate_cert()
@@ -0,0 +1,72 @@
+"""信令连接的应用层心跳
+
+客户端没有发送关闭帧就消失时（断网、休眠、切换网络），服务器要等到 TCP 超时才会发现。
+所有连接共用一个定时任务：按下次检查时间排成最小堆，每次只处理到期的连接，
+不为每个连接创建任务。收到客户端的任何消息都算作存活，只有空闲的连接才会收到 ping。
+"""
+import asyncio
+import heapq
+import time
+
+
+class Heartbeat:
+    def __init__(self, interval: float, timeout: float, ping, evict, resolution: float = 0.1):
+        """ping(client_id) 发送心跳，evict(client_id) 清理超时的连接
+
+        resolution 为最短的唤醒间隔，相近时间到期的连接合并在一次唤醒中处理。
+        """
+        self.interval = interval
+        self.timeout = max(timeout, interval)
+        self.ping = ping
+        self.evict = evict
+        self.resolution = resolution
+        # (下次检查时间, 客户端ID)，连接断开后堆中的记录在到期时丢弃
+        self.heap: list[tuple[float, int]] = []
+        # 客户端ID -> 最后一次收到消息的时间
+        self.last_seen: dict[int, float] = {}
+        self.pings = 0
+        self.timeouts = 0
+
+    def add(self, client_id: int):
+        now = time.monotonic()
+        self.last_seen[client_id] = now
+        heapq.heappush(self.heap, (now + self.interval, client_id))
+
+    def remove(self, client_id: int):
+        self.last_seen.pop(client_id, None)
+
+    def touch(self, client_id: int):
+        """收到客户端消息时调用，只更新时间，不调整堆"""
+        if client_id in self.last_seen:
+            self.last_seen[client_id] = time.monotonic()
+
+    def check(self, now: float) -> float | None:
+        """处理到期的连接，返回下一次检查时间"""
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            _, client_id = heapq.heappop(heap)
+            last_seen = self.last_seen.get(client_id)
+            if last_seen is None:
+                continue
+            idle = now - last_seen
+            if idle >= self.timeout:
+                del self.last_seen[client_id]
+                self.timeouts += 1
+                self.evict(client_id)
+                continue
+            if idle >= self.interval:
+                self.pings += 1
+                self.ping(client_id)
+                due = min(now + self.interval, last_seen + self.timeout)
+            else:
+                # 期间收到过消息，从最后一次消息起重新计时
+                due = last_seen + self.interval
+            heapq.heappush(heap, (due, client_id))
+        return heap[0][0] if heap else None
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            due = self.check(now)
+            delay = self.interval if due is None else due - now
+            await asyncio.sleep(max(delay, self.resolution))
@@ -0,0 +1,571 @@
+"""低延迟 HLS：给无法使用 WebRTC 的设备（智能电视、受限浏览器）提供投屏画面
+
+每个房间由一个无头观看者接收投屏画面（与录制相同，见 recorder.py），编码成 H.264 分片 MP4，
+按 HLS_PART_SECONDS 切成部分段（partial segment），每 HLS_SEGMENT_SECONDS 一个关键帧开始新的段。
+所有数据只保存在内存中，每个房间保留最近 HLS_WINDOW 个段，更早的段被淘汰。
+
+HTTP 观看者数量不影响编码开销：播放列表按版本缓存，段和部分段直接返回内存中的字节。
+播放器用 _HLS_msn/_HLS_part 请求尚未生成的播放列表或部分段时，请求挂起到数据就绪（阻塞式重新加载）。
+"""
+import asyncio
+import logging
+import math
+import struct
+import time
+from fractions import Fraction
+
+try:
+    import av
+except ImportError:
+    av = None
+
+from fastapi.responses import Response
+
+from recorder import Recorder, Recording
+
+logger = logging.getLogger(__name__)
+
+# HLS 拉流端在信令中的客户端ID
+HLS_PEER_ID = -2
+
+TIME_BASE = Fraction(1, 90000)
+
+# 分片 MP4：空 moov 的初始化段，之后每个部分段是一对 moof+mdat
+MUXER_OPTIONS = {
+    "movflags": "empty_moov+default_base_moof+frag_keyframe",
+    # 每个包写入后立即刷新，部分段在下一帧编码后就能取到
+    "flush_packets": "1",
+}
+# 只在段边界强制插入 IDR 帧，禁止场景切换产生额外的关键帧，保证段长稳定
+ENCODER_OPTIONS = {
+    "preset": "veryfast",
+    "tune": "zerolatency",
+    "profile": "main",
+    "forced-idr": "1",
+    "x264-params": "scenecut=0:keyint=infinite",
+}
+
+# sample_is_non_sync_sample
+NON_SYNC_SAMPLE = 0x00010000
+
+PLAYLIST_TYPE = "application/vnd.apple.mpegurl"
+MEDIA_TYPE = "video/mp4"
+# 播放器可能来自其他域名（如 hls.js 网页播放器）
+HEADERS = {"Access-Control-Allow-Origin": "*"}
+# 段和部分段生成后不再变化，播放列表每次都要重新获取
+SEGMENT_CACHE = "public, max-age=60"
+PLAYLIST_CACHE = "no-cache"
+# 投屏结束后保留的段时长倍数，让播放器取到带 EXT-X-ENDLIST 的播放列表后再释放内存
+ENDED_LINGER_SEGMENTS = 3
+
+
+def iter_boxes(data: bytes, offset: int = 0, end: int | None = None):
+    """遍历 ISO BMFF 的 box，返回 (类型, 内容起点, box终点)"""
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+def find_box(data: bytes, path: tuple, offset: int = 0, end: int | None = None):
+    """按路径查找嵌套的 box，返回 (内容起点, box终点)"""
+    for kind, start, stop in iter_boxes(data, offset, end):
+        if kind == path[0]:
+            return (start, stop) if len(path) == 1 else find_box(data, path[1:], start, stop)
+    return None
+
+
+def media_timescale(init: bytes) -> int:
+    """初始化段中视频轨道的时间刻度"""
+    start, _ = find_box(init, (b"moov", b"trak", b"mdia", b"mdhd"))
+    version = init[start]
+    return struct.unpack_from(">I", init, start + (20 if version == 1 else 12))[0]
+
+
+def fragment_info(moof: bytes) -> tuple[int, int, bool]:
+    """解析 moof，返回 (起始解码时间, 时长, 是否以关键帧开始)，时间单位为轨道的时间刻度"""
+    traf = find_box(moof, (b"moof", b"traf"))
+    start, stop = traf
+    default_duration = default_flags = 0
+    base_time = 0
+    duration = 0
+    first_flags = None
+    for kind, body, end in iter_boxes(moof, start, stop):
+        flags = int.from_bytes(moof[body + 1:body + 4], "big")
+        if kind == b"tfhd":
+            position = body + 8
+            for bit, size in ((0x01, 8), (0x02, 4)):
+                if flags & bit:
+                    position += size
+            if flags & 0x08:
+                default_duration = struct.unpack_from(">I", moof, position)[0]
+                position += 4
+            if flags & 0x10:
+                position += 4
+            if flags & 0x20:
+                default_flags = struct.unpack_from(">I", moof, position)[0]
+        elif kind == b"tfdt":
+            if moof[body] == 1:
+                base_time = struct.unpack_from(">Q", moof, body + 4)[0]
+            else:
+                base_time = struct.unpack_from(">I", moof, body + 4)[0]
+        elif kind == b"trun":
+            count = struct.unpack_from(">I", moof, body + 4)[0]
+            position = body + 8
+            if flags & 0x01:
+                position += 4
+            if flags & 0x04:
+                first_flags = struct.unpack_from(">I", moof, position)[0]
+                position += 4
+            for index in range(count):
+                sample_duration = default_duration
+                if flags & 0x100:
+                    sample_duration = struct.unpack_from(">I", moof, position)[0]
+                    position += 4
+                if flags & 0x200:
+                    position += 4
+                if flags & 0x400:
+                    if index == 0 and first_flags is None:
+                        first_flags = struct.unpack_from(">I", moof, position)[0]
+                    position += 4
+                if flags & 0x800:
+                    position += 4
+                duration += sample_duration
+    if first_flags is None:
+        first_flags = default_flags
+    return base_time, duration, not first_flags & NON_SYNC_SAMPLE
+
+
+class Part:
+    __slots__ = ("data", "duration", "independent", "created")
+
+    def __init__(self, data: bytes, duration: float, independent: bool):
+        self.data = data
+        self.duration = duration
+        self.independent = independent
+        self.created = time.monotonic()
+
+
+class Segment:
+    def __init__(self, sequence: int, init_version: int, discontinuity: bool = False):
+        self.sequence = sequence
+        # 所用初始化段的版本；重新拉流后编码参数可能不同，新段用新的初始化段并标记为不连续
+        self.init_version = init_version
+        self.discontinuity = discontinuity
+        self.parts: list[Part] = []
+        self.data = b""
+        self.complete = False
+
+    @property
+    def duration(self) -> float:
+        return sum(part.duration for part in self.parts)
+
+
+class HLSStream:
+    """一个房间的 HLS 输出：初始化段和最近若干段，只在事件循环线程中修改
+
+    投屏端重新连接或换人投屏时沿用同一个 HLSStream，媒体序号继续递增，
+    新的段以 EXT-X-DISCONTINUITY 标记并通过 EXT-X-MAP 指向新的初始化段。
+    """
+
+    def __init__(self, room: str, segment_seconds: float, part_seconds: float, window: int):
+        self.room = room
+        self.segment_seconds = segment_seconds
+        self.part_seconds = part_seconds
+        self.window = window
+        # 初始化段按版本保存，窗口内的段还在引用的旧版本不能删除
+        self.inits: dict[int, bytes] = {}
+        self.init_version = -1
+        self.segments: dict[int, Segment] = {}
+        self.first_sequence = 0
+        self.next_sequence = 0
+        self.discontinuity_sequence = 0
+        self.pending_discontinuity = False
+        # 当前写入的 HLSWriter，被取代的写入器迟到的输出直接丢弃
+        self.writer = None
+        self.ended = False
+        self.version = 0
+        self.playlist_cache: tuple[int, bytes] | None = None
+        self.changed = asyncio.Event()
+        self.bytes_served = 0
+
+    @property
+    def current(self) -> Segment | None:
+        return self.segments.get(self.next_sequence - 1)
+
+    @property
+    def init(self) -> bytes | None:
+        """最新的初始化段"""
+        return self.inits.get(self.init_version)
+
+    def set_init(self, data: bytes):
+        self.init_version += 1
+        self.inits[self.init_version] = data
+        self._notify()
+
+    def restart(self):
+        """同一房间重新开始拉流：结束当前段，之后的段标记为不连续"""
+        current = self.current
+        if current is not None and not current.complete:
+            self._complete(current)
+        self.pending_discontinuity = bool(self.segments)
+        self.ended = False
+        self._notify()
+
+    def add_part(self, data: bytes, duration: float, independent: bool):
+        current = self.current
+        if current is None or current.complete or (independent and current.parts):
+            # 关键帧开始新的段
+            if current is not None and not current.complete:
+                self._complete(current)
+            current = self.segments[self.next_sequence] = Segment(
+                self.next_sequence, self.init_version, self.pending_discontinuity)
+            self.pending_discontinuity = False
+            self.next_sequence += 1
+            while len(self.segments) > self.window:
+                if self.segments.pop(self.first_sequence).discontinuity:
+                    self.discontinuity_sequence += 1
+                self.first_sequence += 1
+            oldest = self.segments[self.first_sequence].init_version
+            for version in [version for version in self.inits if version < oldest]:
+                del self.inits[version]
+        current.parts.append(Part(data, duration, independent))
+        self._notify()
+
+    def end(self):
+        if self.current is not None and not self.current.complete:
+            self._complete(self.current)
+        self.ended = True
+        self._notify()
+
+    @property
+    def last_sequence(self) -> int:
+        """播放列表中最后一个完整段的序号，还没有完整段时为 -1"""
+        current = self.current
+        if current is not None and not current.complete:
+            return current.sequence - 1
+        return self.next_sequence - 1
+
+    def _complete(self, segment: Segment):
+        segment.data = b"".join(part.data for part in segment.parts)
+        segment.complete = True
+
+    def _notify(self):
+        self.version += 1
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def has_part(self, sequence: int, part: int | None) -> bool:
+        """_HLS_msn/_HLS_part 指定的位置是否已经生成（或已被淘汰）"""
+        if self.ended or sequence < self.first_sequence:
+            return True
+        segment = self.segments.get(sequence)
+        if segment is None:
+            return False
+        if part is None:
+            return segment.complete
+        return segment.complete or part < len(segment.parts)
+
+    def is_next_part(self, sequence: int, index: int) -> bool:
+        """是否为下一个将要生成的部分段（播放列表中的预加载提示）"""
+        current = self.current
+        if current is None:
+            return sequence == self.next_sequence and index == 0
+        return ((sequence == current.sequence and index == len(current.parts))
+                or (sequence == self.next_sequence and index == 0))
+
+    async def wait_for(self, condition, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return condition()
+        return True
+
+    def playlist(self) -> bytes:
+        if self.playlist_cache is not None and self.playlist_cache[0] == self.version:
+            return self.playlist_cache[1]
+        segments = [self.segments[sequence] for sequence in sorted(self.segments)]
+        target = max([math.ceil(segment.duration) for segment in segments if segment.complete]
+                     + [math.ceil(self.segment_seconds)])
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:9",
+            f"#EXT-X-TARGETDURATION:{target}",
+            f"#EXT-X-PART-INF:PART-TARGET={self.part_seconds:.3f}",
+            f"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={self.part_seconds * 3:.3f}",
+            f"#EXT-X-MEDIA-SEQUENCE:{self.first_sequence}",
+            f"#EXT-X-DISCONTINUITY-SEQUENCE:{self.discontinuity_sequence}",
+        ]
+        # 最后 3 个目标时长内的段列出部分段
+        parts_from = max(self.first_sequence, self.next_sequence - math.ceil(3 * target / self.segment_seconds))
+        init_version = None
+        for segment in segments:
+            if segment.discontinuity:
+                lines.append("#EXT-X-DISCONTINUITY")
+            if segment.init_version != init_version:
+                init_version = segment.init_version
+                lines.append(f'#EXT-X-MAP:URI="init{init_version}.mp4"')
+            if segment.sequence >= parts_from:
+                for index, part in enumerate(segment.parts):
+                    independent = ",INDEPENDENT=YES" if part.independent else ""
+                    lines.append(f'#EXT-X-PART:DURATION={part.duration:.3f},'
+                                 f'URI="part{segment.sequence}.{index}.m4s"{independent}')
+            if segment.complete:
+                lines.append(f"#EXTINF:{segment.duration:.3f},")
+                lines.append(f"seg{segment.sequence}.m4s")
+        if self.ended:
+            lines.append("#EXT-X-ENDLIST")
+        elif segments:
+            # 下一个部分段的预加载提示，播放器提前请求，数据生成后立即返回
+            current = segments[-1]
+            sequence, index = (current.sequence + 1, 0) if current.complete else (current.sequence, len(current.parts))
+            lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="part{sequence}.{index}.m4s"')
+        body = ("\n".join(lines) + "\n").encode()
+        self.playlist_cache = (self.version, body)
+        return body
+
+    def part(self, sequence: int, index: int) -> bytes | None:
+        segment = self.segments.get(sequence)
+        if segment is None or index >= len(segment.parts):
+            # 当前段已结束时，下一个部分段可能在新的段中
+            return None
+        return segment.parts[index].data
+
+    def segment(self, sequence: int) -> bytes | None:
+        segment = self.segments.get(sequence)
+        return segment.data if segment is not None and segment.complete else None
+
+
+class FragmentBuffer:
+    """PyAV 复用器的输出目标，从字节流中切出初始化段和每个 moof+mdat 分片"""
+
+    def __init__(self, on_init, on_fragment):
+        self.on_init = on_init
+        self.on_fragment = on_fragment
+        self.buffer = bytearray()
+        self.init = b""
+        self.moof = None
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while True:
+            box = next(iter_boxes(self.buffer), None)
+            if box is None or box[2] > len(self.buffer):
+                break
+            kind, _, end = box
+            data_box = bytes(self.buffer[:end])
+            del self.buffer[:end]
+            if kind in (b"ftyp", b"moov"):
+                self.init += data_box
+                if kind == b"moov":
+                    self.on_init(self.init)
+            elif kind == b"moof":
+                self.moof = data_box
+            elif kind == b"mdat" and self.moof is not None:
+                self.on_fragment(self.moof, data_box)
+                self.moof = None
+        return len(data)
+
+
+class HLSWriter:
+    """把帧编码成分片 MP4，交给 HLSStream；在编码线程中调用，结果通过事件循环发布"""
+
+    def __init__(self, stream: HLSStream, loop: asyncio.AbstractEventLoop):
+        self.stream = stream
+        self.loop = loop
+        self.container = None
+        self.video = None
+        self.timescale = 90000
+        self.first_time = None
+        self.last_pts = -1
+        self.next_keyframe = 0.0
+        self.frames = 0
+        self.duration = 0.0
+        self.output = FragmentBuffer(self._on_init, self._on_fragment)
+
+    @property
+    def name(self) -> str:
+        return f"HLS {self.stream.room}"
+
+    def write(self, frame):
+        seconds = float(frame.pts * (frame.time_base or TIME_BASE)) if frame.pts is not None else 0.0
+        if self.container is None:
+            self._open(frame)
+            self.first_time = seconds
+        elapsed = seconds - self.first_time
+        pts = max(round(elapsed / TIME_BASE), self.last_pts + 1)
+        self.last_pts = pts
+        frame.pts = pts
+        frame.time_base = TIME_BASE
+        frame.pict_type = av.video.frame.PictureType.NONE
+        if elapsed >= self.next_keyframe:
+            # 段边界：强制 IDR，播放器可以从这里开始解码
+            frame.pict_type = av.video.frame.PictureType.I
+            self.next_keyframe += self.stream.segment_seconds
+        # 画面尺寸变化时由编码器缩放到初始尺寸，避免切换初始化段
+        for packet in self.video.encode(frame):
+            self.container.mux(packet)
+        self.frames += 1
+        self.duration = elapsed
+
+    def close(self):
+        if self.container is not None:
+            for packet in self.video.encode(None):
+                self.container.mux(packet)
+            self.container.close()
+        self._publish(self.stream.end)
+
+    def _open(self, frame):
+        options = dict(MUXER_OPTIONS, frag_duration=str(int(self.stream.part_seconds * 1_000_000)))
+        self.container = av.open(self.output, "w", format="mp4", options=options)
+        self.video = self.container.add_stream("libx264", rate=30, options=ENCODER_OPTIONS)
+        self.video.width = frame.width // 2 * 2
+        self.video.height = frame.height // 2 * 2
+        self.video.pix_fmt = "yuv420p"
+        self.video.codec_context.time_base = TIME_BASE
+
+    def _on_init(self, data: bytes):
+        self.timescale = media_timescale(data)
+        self._publish(self.stream.set_init, data)
+
+    def _on_fragment(self, moof: bytes, mdat: bytes):
+        _, duration, independent = fragment_info(moof)
+        self._publish(self.stream.add_part, moof + mdat, duration / self.timescale, independent)
+
+    def _publish(self, method, *args):
+        """交给事件循环修改 HLSStream；已被新的写入器取代时丢弃"""
+        self.loop.call_soon_threadsafe(self._apply, method, args)
+
+    def _apply(self, method, args):
+        if self.stream.writer is self:
+            method(*args)
+
+
+class HLSIngest(Recorder):
+    """每个房间拉取一个投屏端的画面，生成低延迟 HLS"""
+
+    peer_id = HLS_PEER_ID
+
+    def __init__(self, send, rooms=None, segment_seconds: float = 2.0, part_seconds: float = 0.5,
+                 window: int = 6, ice_servers=None):
+        if av is None:
+            raise RuntimeError("HLS 需要安装 aiortc")
+        super().__init__(send, "", rooms=rooms, segment_seconds=segment_seconds, ice_servers=ice_servers)
+        self.part_seconds = part_seconds
+        self.window = window
+        self.streams: dict[str, HLSStream] = {}
+
+    def start(self, room: str, client_id: int):
+        # 每个房间只拉取一路，已有投屏端在输出时忽略后来者
+        if any(recording.room == room for recording in self.recordings.values()):
+            return
+        super().start(room, client_id)
+
+    def record_track(self, room: str, client_id: int, track):
+        if any(recording.room == room for recording in self.recordings.values()):
+            return
+        super().record_track(room, client_id, track)
+
+    def new_writer(self, room: str, client_id: int, previous: HLSWriter | None = None) -> HLSWriter:
+        # 同一房间的输出一直沿用，播放器看到的媒体序号不会倒退
+        stream = self.streams.get(room)
+        if stream is None:
+            stream = self.streams[room] = HLSStream(room, self.segment_seconds, self.part_seconds, self.window)
+        else:
+            stream.restart()
+        writer = stream.writer = HLSWriter(stream, asyncio.get_running_loop())
+        return writer
+
+    async def _stop(self, lock: asyncio.Lock, client_id: int) -> Recording | None:
+        # 投屏端停止分享或断开（包括房间关闭）后，稍后释放该房间的分段
+        recording = await super()._stop(lock, client_id)
+        if recording is not None:
+            stream = recording.writer.stream
+            asyncio.get_running_loop().call_later(ENDED_LINGER_SEGMENTS * self.segment_seconds,
+                                                  self._evict, stream, stream.version)
+        return recording
+
+    def _evict(self, stream: HLSStream, version: int):
+        # 期间同一房间可能已开始新的投屏，沿用了这个 HLSStream
+        if self.streams.get(stream.room) is stream and stream.ended and stream.version == version:
+            del self.streams[stream.room]
+
+    async def response(self, room: str, name: str, msn: str | None = None, part: str | None = None) -> Response:
+        """处理 /hls/<房间>/<文件> 请求"""
+        stream = self.streams.get(room)
+        if stream is None:
+            return Response(status_code=404, headers=HEADERS)
+        # 阻塞请求最多等待 3 个目标时长
+        timeout = 3 * stream.segment_seconds
+        body = None
+        if name == "playlist.m3u8":
+            try:
+                sequence = int(msn) if msn is not None else None
+                index = int(part) if part is not None else None
+            except ValueError:
+                return Response(status_code=400, headers=HEADERS)
+            # _HLS_part 必须与 _HLS_msn 一起出现；请求超过最后一段两个序号以上时立即拒绝，不占用等待
+            if (index is not None and sequence is None) or (sequence is not None
+                                                            and sequence > stream.last_sequence + 2):
+                return Response(status_code=400, headers=HEADERS)
+            if sequence is not None:
+                ready = await stream.wait_for(lambda: stream.has_part(sequence, index), timeout)
+            else:
+                ready = await stream.wait_for(lambda: stream.segments or stream.ended, timeout)
+            if not ready:
+                return Response(status_code=503, headers=HEADERS)
+            body = stream.playlist()
+            media_type, cache_control = PLAYLIST_TYPE, PLAYLIST_CACHE
+        else:
+            media_type, cache_control = MEDIA_TYPE, SEGMENT_CACHE
+            if name == "init.mp4":
+                # 不带版本号的地址返回最新的初始化段
+                await stream.wait_for(lambda: stream.init is not None or stream.ended, timeout)
+                body = stream.init
+            elif name.startswith("init") and name.endswith(".mp4"):
+                try:
+                    version = int(name[4:-4])
+                except ValueError:
+                    return Response(status_code=404, headers=HEADERS)
+                # 播放列表引用的版本都已生成，不需要等待
+                body = stream.inits.get(version)
+            elif name.startswith("part") and name.endswith(".m4s"):
+                try:
+                    sequence, index = map(int, name[4:-4].split("."))
+                except ValueError:
+                    return Response(status_code=404, headers=HEADERS)
+                if stream.part(sequence, index) is None and stream.is_next_part(sequence, index):
+                    # 预加载提示指向的部分段：数据生成后立即返回
+                    await stream.wait_for(lambda: stream.part(sequence, index) is not None
+                                          or not stream.is_next_part(sequence, index), timeout)
+                body = stream.part(sequence, index)
+            elif name.startswith("seg") and name.endswith(".m4s"):
+                try:
+                    body = stream.segment(int(name[3:-4]))
+                except ValueError:
+                    pass
+        if body is None:
+            return Response(status_code=404, headers=HEADERS)
+        stream.bytes_served += len(body)
+        return Response(body, media_type=media_type, headers={**HEADERS, "Cache-Control": cache_control})
+
+    def stats(self) -> dict:
+        return {
+            "streams": {room: {"segments": len(stream.segments), "ended": stream.ended,
+                               "bytesServed": stream.bytes_served}
+                        for room, stream in self.streams.items()},
+        }
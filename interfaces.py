@@ -0,0 +1,50 @@
+"""本机网卡地址发现，证书的 IP 地址和 ICE 候选地址都从这里取，两边保持一致"""
+import ipaddress
+import socket
+import struct
+
+
+def local_address_for(host: str) -> str:
+    """返回本机到达该地址所用的网卡地址，用作中继地址（不会真正发包）"""
+    if host.startswith('::ffff:') and '.' in host:
+        host = host[7:]
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.connect((host, 9))
+        return sock.getsockname()[0]
+
+
+def interface_addresses() -> list[str]:
+    """逐个网卡读取 IPv4 地址（Linux），其他系统返回空列表"""
+    try:
+        import fcntl
+    except ImportError:
+        return []
+    addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            try:
+                # SIOCGIFADDR，返回的 ifreq 中地址位于偏移 20
+                ifreq = fcntl.ioctl(sock.fileno(), 0x8915, struct.pack('256s', name[:15].encode()))
+            except OSError:
+                continue
+            addresses.append(socket.inet_ntoa(ifreq[20:24]))
+    return addresses
+
+
+def find_local_addresses() -> list[str]:
+    """本机可用于局域网通信的 IPv4 地址，默认路由所在网卡排在最前"""
+    addresses = []
+    try:
+        addresses.append(local_address_for("10.255.255.255"))
+    except OSError:
+        pass
+    addresses += interface_addresses()
+    try:
+        # Windows 上主机名会解析到所有网卡的地址
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET, socket.SOCK_DGRAM):
+            addresses.append(info[4][0])
+    except OSError:
+        pass
+    return [address for address in dict.fromkeys(addresses)
+            if not ipaddress.ip_address(address).is_loopback]
@@ -0,0 +1,368 @@
+"""信令服务负载测试
+
+在本进程中启动 app，由若干子进程模拟大量页面客户端，按页面的信令协议
+（start-sharing、request-watching、offer/answer、ice-candidates）连接 /ws。
+客户端放在子进程中，本进程的内存和 CPU 只包含服务端的开销。
+
+结果保存为 JSON，用 --baseline 与之前版本的结果对比：
+
+用法: python loadtest.py --clients 2000 --rooms 20 --output after.json --baseline before.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from qoe import percentile
+
+# 对比时关注的指标：(路径, 说明, 数值越小越好)
+COMPARED_METRICS = (
+    (("join", "p50Ms"), "加入时延 p50 (ms)", True),
+    (("join", "p99Ms"), "加入时延 p99 (ms)", True),
+    (("negotiation", "p50Ms"), "协商耗时 p50 (ms)", True),
+    (("relay", "p50Ms"), "转发时延 p50 (ms)", True),
+    (("relay", "p99Ms"), "转发时延 p99 (ms)", True),
+    (("relay", "messagesPerSecond"), "转发吞吐 (msg/s)", False),
+    (("memory", "bytesPerConnection"), "每连接内存 (字节)", True),
+    (("cpu", "usPerJoin"), "每次加入 CPU (µs)", True),
+    (("cpu", "usPerMessage"), "每条消息 CPU (µs)", True),
+)
+
+
+def summarize(values: list) -> dict:
+    """时延列表（秒）汇总为毫秒分位数"""
+    result = {"count": len(values)}
+    if values:
+        result.update({
+            "p50Ms": round(percentile(values, 0.5) * 1000, 3),
+            "p99Ms": round(percentile(values, 0.99) * 1000, 3),
+            "maxMs": round(max(values) * 1000, 3),
+        })
+    return result
+
+
+def resident_memory() -> int | None:
+    """当前进程的常驻内存（字节），没有 /proc 时退回到峰值，两者都没有（Windows）时返回 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class LoadClient:
+    """只处理信令的页面客户端，转发的消息带发送时刻，接收方据此计算转发时延
+
+    一个房间的所有客户端在同一个子进程中，发送和接收使用同一个时钟。
+    """
+
+    def __init__(self, group: "RoomGroup", sharer: bool):
+        self.group = group
+        self.sharer = sharer
+        self.websocket = None
+        self.client_id = None
+        self.joined = asyncio.get_running_loop().create_future()
+        self.closed = False
+        self.sharer_id = None
+        self.viewer_ids = []
+
+    async def connect(self, uri: str):
+        import websockets
+
+        self.websocket = await websockets.connect(uri, max_size=None, ping_interval=None)
+        asyncio.create_task(self._read())
+        await self.joined
+
+    async def send(self, message: dict):
+        await self.websocket.send(json.dumps(message))
+
+    async def send_candidates(self, target_id: int, done: bool):
+        await self.send({"type": "ice-candidates", "targetId": target_id, "data": {
+            "candidates": [self.group.candidate], "done": done, "sentAt": time.perf_counter()}})
+
+    async def _read(self):
+        try:
+            async for data in self.websocket:
+                await self._handle(json.loads(data))
+        except Exception:
+            pass
+        self.closed = True
+
+    async def _handle(self, message: dict):
+        msg_type, data, sender = message["type"], message.get("data"), message.get("from")
+        if isinstance(data, dict) and "sentAt" in data:
+            self.group.latencies.append(time.perf_counter() - data["sentAt"])
+        if msg_type == "client-id":
+            self.client_id = data
+            self.joined.set_result(None)
+        elif msg_type == "start-sharing" and not self.sharer:
+            self.sharer_id = sender
+            await self.send({"type": "request-watching", "targetId": sender})
+        elif msg_type == "request-watching" and self.sharer:
+            self.viewer_ids.append(sender)
+            await self.send({"type": "offer", "targetId": sender, "data": {
+                "type": "offer", "sdp": self.group.sdp, "sentAt": time.perf_counter()}})
+        elif msg_type == "offer" and not self.sharer:
+            await self.send({"type": "answer", "targetId": sender, "data": {
+                "type": "answer", "sdp": self.group.sdp, "sentAt": time.perf_counter()}})
+            await self.send_candidates(sender, done=True)
+        elif msg_type == "ice-candidates":
+            self.group.delivered += 1
+            if self.sharer and data.get("done"):
+                # 观看者的候选全部送达，协商完成
+                self.group.negotiated.append(time.perf_counter() - self.group.sharing_started)
+                await self.send_candidates(sender, done=True)
+
+
+class RoomGroup:
+    """一个子进程负责的若干房间"""
+
+    def __init__(self, uri: str, rooms: list, clients_per_room: int, sdp_size: int):
+        self.uri = uri
+        self.rooms = rooms
+        self.clients_per_room = clients_per_room
+        self.sdp = "v=0\r\n" + "a=candidate:1 1 udp 2122260223 192.168.1.10 54321 typ host\r\n" * (sdp_size // 62)
+        self.candidate = {"candidate": "candidate:1 1 udp 2122260223 192.168.1.10 54321 typ host",
+                          "sdpMid": "0", "sdpMLineIndex": 0}
+        self.clients: list[LoadClient] = []
+        self.sharers: list[LoadClient] = []
+        self.latencies = []
+        self.negotiated = []
+        self.delivered = 0
+        self.sharing_started = 0.0
+
+    async def join(self, concurrency: int) -> dict:
+        """所有客户端加入房间，加入时延为发起连接到收到 client-id 的时间"""
+        limit = asyncio.Semaphore(concurrency)
+        join_times = []
+
+        async def join_one(room, sharer):
+            client = LoadClient(self, sharer)
+            async with limit:
+                start = time.perf_counter()
+                await client.connect(f"{self.uri}?room={room}")
+                join_times.append(time.perf_counter() - start)
+            return client
+
+        for room in self.rooms:
+            members = await asyncio.gather(*(join_one(room, index == 0) for index in range(self.clients_per_room)))
+            self.sharers.append(members[0])
+            self.clients.extend(members)
+        return {"join": join_times}
+
+    async def negotiate(self, timeout: float) -> dict:
+        """投屏端开始投屏，每个观看者完成 request-watching → offer → answer → ice-candidates"""
+        self.latencies, self.delivered = [], 0
+        self.sharing_started = time.perf_counter()
+        for sharer in self.sharers:
+            await sharer.send({"type": "start-sharing"})
+        viewers = len(self.clients) - len(self.sharers)
+        await self._wait(lambda: len(self.negotiated) >= viewers and self.delivered >= 2 * viewers, timeout)
+        return {"negotiation": self.negotiated, "latencies": self.latencies, "delivered": self.delivered}
+
+    async def relay(self, messages: int, rate: float, timeout: float) -> dict:
+        """协商完成后的持续信令：每个观看者与投屏端之间双向各发 messages 条 ice-candidates"""
+        self.latencies, self.delivered = [], 0
+
+        async def trickle(client, targets):
+            for index in range(messages):
+                for target in targets:
+                    await client.send_candidates(target, done=False)
+                await asyncio.sleep(1 / rate)
+
+        viewers = [client for client in self.clients if not client.sharer]
+        await asyncio.gather(*(trickle(viewer, [viewer.sharer_id]) for viewer in viewers),
+                             *(trickle(sharer, sharer.viewer_ids) for sharer in self.sharers))
+        expected = 2 * messages * len(viewers)
+        await self._wait(lambda: self.delivered >= expected, timeout)
+        return {"latencies": self.latencies, "sent": expected, "delivered": self.delivered}
+
+    async def close(self) -> dict:
+        disconnected = sum(client.closed for client in self.clients)
+        await asyncio.gather(*(client.websocket.close() for client in self.clients), return_exceptions=True)
+        return {"disconnected": disconnected}
+
+    async def _wait(self, condition, timeout: float):
+        deadline = time.perf_counter() + timeout
+        while not condition() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+
+
+def client_process(connection, uri: str, rooms: list, clients_per_room: int, sdp_size: int):
+    """子进程入口：按主进程的指令逐步执行，每步的结果通过管道返回"""
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        group = RoomGroup(uri, rooms, clients_per_room, sdp_size)
+        while True:
+            command, *args = await loop.run_in_executor(None, connection.recv)
+            result = await getattr(group, command)(*args)
+            connection.send(result)
+            if command == "close":
+                return
+
+    asyncio.run(run())
+
+
+class ClientPool:
+    """管理所有客户端子进程，指令同时下发并汇总各进程的结果"""
+
+    def __init__(self, uri: str, rooms: int, clients_per_room: int, processes: int, sdp_size: int):
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.processes = []
+        for index in range(processes):
+            assigned = [f"load-{room}" for room in range(index, rooms, processes)]
+            if not assigned:
+                continue
+            parent, child = context.Pipe()
+            process = context.Process(target=client_process, daemon=True,
+                                      args=(child, uri, assigned, clients_per_room, sdp_size))
+            process.start()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    async def run(self, command: str, *args) -> dict:
+        loop = asyncio.get_running_loop()
+        for connection in self.connections:
+            connection.send((command, *args))
+        results = await asyncio.gather(*(loop.run_in_executor(None, connection.recv)
+                                         for connection in self.connections))
+        merged = {}
+        for result in results:
+            for key, value in result.items():
+                merged[key] = merged.get(key, 0 if isinstance(value, int) else []) + value
+        return merged
+
+    def join(self):
+        for process in self.processes:
+            process.join(timeout=5)
+
+
+async def run_load(clients: int, rooms: int, messages: int, rate: float, processes: int,
+                   port: int, concurrency: int, sdp_size: int, timeout: float) -> dict:
+    from bench import start_server, stop_server
+    from main import manager
+
+    clients_per_room = max(2, clients // rooms)
+    total = clients_per_room * rooms
+    server, task = await start_server(port)
+    pool = ClientPool(f"ws://127.0.0.1:{port}/ws", rooms, clients_per_room, processes, sdp_size)
+    try:
+        gc.collect()
+        memory_before = resident_memory()
+        cpu = time.process_time()
+        start = time.perf_counter()
+        joined = await pool.run("join", max(1, concurrency // len(pool.processes)))
+        join_seconds = time.perf_counter() - start
+        join_cpu = time.process_time() - cpu
+        gc.collect()
+        memory_after = resident_memory()
+        memory_per_connection = (round((memory_after - memory_before) / total)
+                                 if memory_before is not None and memory_after is not None else None)
+        connected = len(manager.peers)
+
+        negotiated = await pool.run("negotiate", timeout)
+
+        cpu = time.process_time()
+        start = time.perf_counter()
+        relayed = await pool.run("relay", messages, rate, timeout)
+        relay_seconds = time.perf_counter() - start
+        relay_cpu = time.process_time() - cpu
+        queues = manager.stats()
+        closed = await pool.run("close")
+    finally:
+        pool.join()
+        await stop_server(server, task)
+
+    return {
+        "join": dict(summarize(joined["join"]), seconds=round(join_seconds, 3), connected=connected),
+        "negotiation": dict(summarize(negotiated["negotiation"]),
+                            messages=summarize(negotiated["latencies"])),
+        "relay": dict(summarize(relayed["latencies"]), sent=relayed["sent"], delivered=relayed["delivered"],
+                      messagesPerSecond=round(relayed["delivered"] / relay_seconds, 1)),
+        "memory": {"bytesPerConnection": memory_per_connection},
+        "cpu": {"usPerJoin": round(join_cpu / total * 1e6, 2),
+                "usPerMessage": round(relay_cpu / max(1, relayed["delivered"]) * 1e6, 2)},
+        "disconnected": closed["disconnected"],
+        "queues": queues,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def lookup(results: dict, path: tuple):
+    for key in path:
+        if not isinstance(results, dict) or key not in results:
+            return None
+        results = results[key]
+    return results
+
+
+def print_comparison(results: dict, baseline: dict):
+    print(f"\n对比 {baseline.get('revision') or '基线'} → {results.get('revision') or '当前'}")
+    for path, label, lower_is_better in COMPARED_METRICS:
+        old, new = lookup(baseline, path), lookup(results, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = change > 0.1 if lower_is_better else change < -0.1
+        print(f"  {label:<20} {old:>12} → {new:<12} {change:+.1%}{'  ← 变差' if worse else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000, help="客户端总数")
+    parser.add_argument("--rooms", type=int, default=10, help="房间数，每个房间一个投屏端")
+    parser.add_argument("--messages", type=int, default=20, help="协商后每对客户端每个方向的信令条数")
+    parser.add_argument("--rate", type=float, default=10.0, help="每个客户端每秒发送的信令条数")
+    parser.add_argument("--processes", type=int, default=min(4, os.cpu_count() or 1), help="客户端子进程数")
+    parser.add_argument("--concurrency", type=int, default=200, help="同时发起的连接数")
+    parser.add_argument("--sdp-size", type=int, default=3000, help="offer/answer 中 SDP 的字节数")
+    parser.add_argument("--timeout", type=float, default=60.0, help="每个阶段等待送达的最长时间（秒）")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--output", help="结果 JSON 文件")
+    parser.add_argument("--baseline", help="之前保存的结果 JSON，用于对比")
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in
+              ("clients", "rooms", "messages", "rate", "processes", "concurrency", "sdp_size")}
+    results = {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+    }
+    results.update(asyncio.run(run_load(args.clients, args.rooms, args.messages, args.rate, args.processes,
+                                        args.port, args.concurrency, args.sdp_size, args.timeout)))
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, Response
 import uvicorn
 import json
 import logging
@@ -9,9 +9,31 @@ import os
 import subprocess
 import threading
 import time
-import socket
-import struct
 import asyncio
+import itertools
+import secrets
+import socket
+import tempfile
+from collections import deque
+from contextlib import asynccontextmanager
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import metrics
+from assets import StaticAssets
+from bus import LocalBus, UnixSocketBus
+from cert import ensure_cert
+from heartbeat import Heartbeat
+from hls import HLSIngest
+from interfaces import find_local_addresses
+from qoe import QoEStats
+from recorder import Recorder
+from sfu import SFU, SFU_PEER_ID
+from stun import STUNProtocol, start_stun_server
+from turn import TURNProtocol, issue_credentials
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -20,743 +42,966 @@ logger = logging.getLogger(__name__)
 # 全局变量用于控制服务器状态
 shutdown_event = threading.Event()
 
-
-# 简单的STUN服务器实现
-class SimpleSTUNServer:
-    def __init__(self, host='0.0.0.0', port=3478):
-        self.host = host
-        self.port = port
-        self.socket = None
-        self.running = False
-
-    def start(self):
-        """启动STUN服务器"""
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.socket.bind((self.host, self.port))
-            self.running = True
-
-            print(f"STUN服务器启动在 {self.host}:{self.port}")
-
-            while self.running and not shutdown_event.is_set():
-                try:
-                    self.socket.settimeout(1.0)  # 设置超时，以便检查shutdown_event
-                    data, addr = self.socket.recvfrom(1024)
-
-                    # 简单的STUN响应处理
-                    if len(data) >= 20:  # STUN消息最小长度
-                        response = self.create_stun_response(data, addr)
-                        if response:
-                            self.socket.sendto(response, addr)
-
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    if self.running:
-                        print(f"STUN服务器错误: {e}")
-                    break
-
-        except Exception as e:
-            print(f"STUN服务器启动失败: {e}")
-        finally:
-            if self.socket:
-                self.socket.close()
-
-    def create_stun_response(self, request_data, client_addr):
-        """创建STUN响应"""
-        try:
-            # 解析STUN请求头
-            if len(request_data) < 20:
-                return None
-
-            msg_type, msg_length, magic_cookie = struct.unpack(
-                '!HHI', request_data[:8])
-            transaction_id = request_data[8:20]
-
-            # 检查是否是STUN绑定请求
-            if msg_type == 0x0001 and magic_cookie == 0x2112A442:
-                # 创建成功响应
-                response_type = 0x0101  # Binding Success Response
-
-                # 创建XOR-MAPPED-ADDRESS属性
-                ip_bytes = socket.inet_aton(client_addr[0])
-                port = client_addr[1]
-
-                # XOR映射的IP和端口
-                xor_port = port ^ (magic_cookie >> 16)
-                xor_ip = struct.unpack('!I', ip_bytes)[0] ^ magic_cookie
-
-                # 构建属性
-                attr_type = 0x0020  # XOR-MAPPED-ADDRESS
-                attr_length = 8
-                attr_value = struct.pack(
-                    '!BBHI', 0, 1, xor_port, xor_ip)  # IPv4
-
-                # 构建完整响应
-                total_length = attr_length + 4  # 属性头 + 属性值
-                response = struct.pack(
-                    '!HHI', response_type, total_length, magic_cookie)
-                response += transaction_id
-                response += struct.pack('!HH', attr_type, attr_length)
-                response += attr_value
-
-                return response
-
-        except Exception as e:
-            print(f"创建STUN响应失败: {e}")
-
-        return None
-
-    def stop(self):
-        """停止STUN服务器"""
-        self.running = False
+# 内置STUN服务器端口
+STUN_PORT = int(os.environ.get("STUN_PORT", "3478"))
+# 内置TURN中继与STUN共用端口，直连失败（对称NAT、客户端隔离的Wi-Fi）时经服务器中转
+TURN_ENABLED = os.environ.get("TURN_ENABLED", "1") == "1"
+# 签发TURN凭证的密钥，未配置时每次启动随机生成
+TURN_SECRET = os.environ.get("TURN_SECRET", "").encode() or os.urandom(32)
+# TURN凭证有效期（秒）
+TURN_CREDENTIAL_TTL = int(os.environ.get("TURN_CREDENTIAL_TTL", "21600"))
+# 中继地址，默认使用到达客户端的网卡地址
+TURN_RELAY_IP = os.environ.get("TURN_RELAY_IP") or None
+
+# ICE传输策略：all 允许直连，relay 强制经TURN中继
+ICE_TRANSPORT_POLICY = os.environ.get("ICE_TRANSPORT_POLICY", "all")
+if ICE_TRANSPORT_POLICY not in ("all", "relay"):
+    ICE_TRANSPORT_POLICY = "all"
+# 额外的STUN/TURN地址（逗号分隔），默认不使用公网服务器，离线局域网中它们只会拖慢ICE收集
+ICE_EXTRA_SERVERS = [url.strip() for url in os.environ.get("ICE_EXTRA_SERVERS", "").split(",") if url.strip()]
+
+# worker 进程数，大于 1 时多个进程通过 SO_REUSEPORT 共享端口（需要 Linux 等支持该选项的系统）
+WORKERS = max(1, int(os.environ.get("WORKERS", "1")))
+if WORKERS > 1 and not hasattr(socket, "SO_REUSEPORT"):
+    print("当前系统不支持 SO_REUSEPORT，只启动一个 worker")
+    WORKERS = 1
+# 以下由主进程在启动 worker 时设置
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+BUS_DIR = os.environ.get("BUS_DIR", "")
+WORKER_PARENT_PID = int(os.environ["WORKER_PARENT_PID"]) if "WORKER_PARENT_PID" in os.environ else None
+
+# 运行中的STUN/TURN服务器
+stun_server = None
+# 本机网卡地址，启动时获取
+local_addresses: list[str] = []
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """内置STUN/TURN服务器与信令运行在同一个事件循环上"""
+    global stun_server, local_addresses
+    local_addresses = find_local_addresses()
+    loop_monitor = asyncio.create_task(metrics.monitor_event_loop())
+    heartbeat_task = asyncio.create_task(manager.heartbeat.run()) if HEARTBEAT_INTERVAL > 0 else None
+    await manager.bus.start(manager.handle_bus)
+    # 通知其他 worker 本 worker 已启动，由它们回复各自的房间成员
+    manager.bus.publish({"op": "hello"})
+    stun_transport = None
+    if TURN_ENABLED:
+        factory = lambda: TURNProtocol(TURN_SECRET, TURN_RELAY_IP, server_hosts=local_addresses)
+    else:
+        factory = STUNProtocol
+    try:
+        # 多个 worker 共享 STUN/TURN 端口，内核按地址哈希分配，同一客户端总是落在同一个 worker 上
+        stun_transport, stun_server = await start_stun_server(port=STUN_PORT, protocol_factory=factory,
+                                                              reuse_port=WORKERS > 1)
+        print(f"{'STUN/TURN' if TURN_ENABLED else 'STUN'}服务器启动在端口 {STUN_PORT}")
+    except OSError as e:
+        print(f"STUN服务器启动失败: {e}")
+    yield
+    loop_monitor.cancel()
+    if heartbeat_task is not None:
+        heartbeat_task.cancel()
+    # 写完正在录制的段和索引
+    for ingest in manager.ingests():
+        await ingest.close()
+    manager.bus.close()
+    if stun_transport is not None:
+        stun_transport.close()
+        stun_server = None
+
+
+app = FastAPI(title="局域网在线投屏", lifespan=lifespan)
+
+
+def encode(message: dict) -> bytes:
+    """编码一条出站消息，每帧只编码一次后发送给所有接收者"""
+    if orjson is not None:
+        return orjson.dumps(message)
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def decode(data: str | bytes):
+    """解析入站消息"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+async def close_quietly(websocket: WebSocket, code: int):
+    """服务器主动关闭连接，对端可能已经断开"""
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
 
 
-app = FastAPI(title="局域网在线投屏")
+# 只有这些在线状态事件需要广播，其余信令按 targetId/to 点对点投递
+PRESENCE_TYPES = {"start-sharing", "stop-sharing", "user-count"}
+
+# 每个连接的发送队列长度
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", "256"))
+# 这些类型只有最新一条有意义：队列满时替换队列中已有的同类消息。其余类型不能丢弃
+# （start-sharing/stop-sharing 丢了观看者就不知道投屏开始或结束），队列满说明客户端已严重落后，直接断开
+COALESCED_TYPES = (set(os.environ.get("SEND_QUEUE_COALESCED", "user-count").split(","))
+                   - {"start-sharing", "stop-sharing"})
+
+# 客户端空闲多久（秒）后发送 ping，0 表示关闭心跳；超过 HEARTBEAT_TIMEOUT 仍无任何消息则断开
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "15"))
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", "40"))
+# 心跳超时断开时的关闭码（应用自定义范围）
+HEARTBEAT_CLOSE_CODE = 4000
+PING_MESSAGE = encode({"type": "ping"})
+
+# 连接异常断开后保留会话的时间（秒），期间客户端带会话令牌重连可取回原客户端ID和房间角色，
+# 发给它的消息留在发送队列中，重连后补发；0 表示断开即离开房间
+RESUME_GRACE_SECONDS = float(os.environ.get("RESUME_GRACE_SECONDS", "10"))
+# 页面主动关闭连接（关闭、刷新页面）时的关闭码，不保留会话
+LEAVE_CLOSE_CODES = {1000, 1001}
+# 同一会话从新连接恢复时，关闭仍未断开的旧连接
+SESSION_REPLACED_CLOSE_CODE = 4001
+
+# 页面上报 WebRTC 统计的间隔（秒），0 表示不上报
+QOE_STATS_INTERVAL = float(os.environ.get("QOE_STATS_INTERVAL", "5"))
+# 每个会话保留的采样数
+QOE_SAMPLES = int(os.environ.get("QOE_SAMPLES", "120"))
+
+# 按类型统计的信令消息，其余类型归入 other，避免客户端随意构造类型导致标签过多
+METRIC_MESSAGE_TYPES = (
+    "offer", "answer", "ice-candidates", "request-watching", "request-layer",
+    "start-sharing", "stop-sharing", "stats", "pong", "ice-restart",
+)
+MESSAGES_RECEIVED = metrics.Counter("signaling_messages_total", "收到的信令消息", labels=("type",))
+MESSAGE_COUNTERS = {msg_type: MESSAGES_RECEIVED.labels(msg_type) for msg_type in METRIC_MESSAGE_TYPES}
+OTHER_MESSAGES = MESSAGES_RECEIVED.labels("other")
+BROADCAST_SECONDS = metrics.Histogram("signaling_broadcast_seconds", "一次广播放入房间内所有发送队列的耗时")
+SEND_DELAY_SECONDS = metrics.Histogram("signaling_send_delay_seconds",
+                                       "发送任务每次清空队列时，最早入队的消息从入队到发送完成的时延")
+
+# 未指定房间时加入的默认房间
+DEFAULT_ROOM = "default"
+ROOM_NAME_MAX_LENGTH = 64
+
+# SFU 模式下投屏端只向服务器推一路流，由服务器转发给观看者（需要 aiortc）
+SFU_MODE = os.environ.get("SFU_MODE", "0") == "1"
+
+# 服务端录制（需要 aiortc）：设置 RECORD_DIR 后录制投屏画面，RECORD_ROOMS 以逗号分隔，为空时录制所有房间
+RECORD_DIR = os.environ.get("RECORD_DIR", "")
+RECORD_ROOMS = [room.strip() for room in os.environ.get("RECORD_ROOMS", "").split(",") if room.strip()]
+RECORD_SEGMENT_SECONDS = float(os.environ.get("RECORD_SEGMENT_SECONDS", "10"))
+RECORD_FORMAT = os.environ.get("RECORD_FORMAT", "mp4")
+
+# 低延迟 HLS（需要 aiortc）：为不支持 WebRTC 的设备把每个房间的一路投屏转成 /hls/<房间>/playlist.m3u8
+HLS_ENABLED = os.environ.get("HLS_ENABLED", "0") == "1"
+HLS_ROOMS = [room.strip() for room in os.environ.get("HLS_ROOMS", "").split(",") if room.strip()]
+HLS_SEGMENT_SECONDS = float(os.environ.get("HLS_SEGMENT_SECONDS", "2"))
+HLS_PART_SECONDS = float(os.environ.get("HLS_PART_SECONDS", "0.5"))
+# 每个房间在内存中保留的段数
+HLS_WINDOW = int(os.environ.get("HLS_WINDOW", "6"))
+
+# 投屏端编码预设：网络变差时按 levels 逐级降级，变好后逐级恢复
+# contentHint 设置到屏幕视频轨道上；设置了 idleFramerate 的预设在画面静止时把采集和编码帧率降到该值，
+# 画面一变化立即恢复
+ENCODING_PRESETS = {
+    # 文字/幻灯片：保持清晰度，先降帧率
+    "text": {
+        "label": "文字/幻灯片",
+        "contentHint": "detail",
+        "degradationPreference": "maintain-resolution",
+        "maxBitrate": 2_500_000,
+        "levels": [
+            {"scaleResolutionDownBy": 1, "maxFramerate": 15},
+            {"scaleResolutionDownBy": 1, "maxFramerate": 8},
+            {"scaleResolutionDownBy": 1, "maxFramerate": 4},
+            {"scaleResolutionDownBy": 1.5, "maxFramerate": 2},
+        ],
+    },
+    # 视频/动画：保持流畅，先降分辨率
+    "motion": {
+        "label": "视频/动画",
+        "contentHint": "motion",
+        "degradationPreference": "maintain-framerate",
+        "maxBitrate": 6_000_000,
+        "levels": [
+            {"scaleResolutionDownBy": 1, "maxFramerate": 30},
+            {"scaleResolutionDownBy": 1.5, "maxFramerate": 30},
+            {"scaleResolutionDownBy": 2, "maxFramerate": 24},
+            {"scaleResolutionDownBy": 3, "maxFramerate": 15},
+        ],
+    },
+    # 内容自适应：翻页、滚动时 30 帧，停在一页上时降到 idleFramerate
+    "auto": {
+        "label": "自动（静止时降帧）",
+        "contentHint": "detail",
+        "degradationPreference": "maintain-resolution",
+        "maxBitrate": 4_000_000,
+        "idleFramerate": 5,
+        "levels": [
+            {"scaleResolutionDownBy": 1, "maxFramerate": 30},
+            {"scaleResolutionDownBy": 1, "maxFramerate": 15},
+            {"scaleResolutionDownBy": 1, "maxFramerate": 8},
+            {"scaleResolutionDownBy": 1.5, "maxFramerate": 4},
+        ],
+    },
+}
+SHARE_PRESET = os.environ.get("SHARE_PRESET", "text")
+if SHARE_PRESET not in ENCODING_PRESETS:
+    SHARE_PRESET = "text"
+
+# 观看端时延档位：jitterBufferTarget（毫秒）设置到观看端的每个 RTCRtpReceiver 上
+# interactive 让浏览器使用最小的抖动缓冲，smooth 多缓冲一些以吸收网络抖动、减少卡顿
+LATENCY_PROFILES = {
+    "interactive": {"label": "低延迟", "jitterBufferTarget": 0},
+    "smooth": {"label": "流畅", "jitterBufferTarget": 500},
+}
+# 默认档位，留空使用浏览器默认值；ROOM_LATENCY_PROFILES 按房间指定，如 "lecture=smooth,demo=interactive"
+LATENCY_PROFILE = os.environ.get("LATENCY_PROFILE", "")
+if LATENCY_PROFILE not in LATENCY_PROFILES:
+    LATENCY_PROFILE = None
+ROOM_LATENCY_PROFILES = {
+    room.strip(): profile.strip()
+    for room, _, profile in (item.partition("=") for item in os.environ.get("ROOM_LATENCY_PROFILES", "").split(","))
+    if profile.strip() in LATENCY_PROFILES
+}
+
+# 观看者可选的画面层级及其分辨率缩小倍数，观看者通过 request-layer 消息切换
+SIMULCAST_LAYERS = {"full": 1, "half": 2, "quarter": 4}
+
+# 视频编码优先级，投屏端按观看者 request-watching 中上报的解码能力逐个回退
+CODEC_PREFERENCES = [codec.strip() for codec in
+                     os.environ.get("CODEC_PREFERENCES", "AV1,VP9,H264,VP8").split(",") if codec.strip()]
+# 投屏端支持硬件编码（mediaCapabilities 报告 powerEfficient）的编码优先
+CODEC_PREFER_HARDWARE = os.environ.get("CODEC_PREFER_HARDWARE", "1") == "1"
+
+
+def ice_config(client_id: int, host: str) -> dict:
+    """按本机网卡和配置生成页面的 RTCPeerConnection 配置
+
+    host 为页面访问服务器所用的地址，客户端一定能到达，排在最前。
+    """
+    ice_servers = []
+    if stun_server is not None:
+        hosts = [f"[{host}]" if ":" in host else host]
+        hosts += [address for address in local_addresses if address != host]
+        ice_servers.append({"urls": [f"stun:{address}:{STUN_PORT}" for address in hosts]})
+        if TURN_ENABLED:
+            username, credential = issue_credentials(TURN_SECRET, client_id, TURN_CREDENTIAL_TTL)
+            ice_servers.append({
+                "urls": [f"turn:{address}:{STUN_PORT}?transport=udp" for address in hosts],
+                "username": username,
+                "credential": credential,
+            })
+    if ICE_EXTRA_SERVERS:
+        ice_servers.append({"urls": ICE_EXTRA_SERVERS})
+    return {"iceServers": ice_servers, "iceTransportPolicy": ICE_TRANSPORT_POLICY}
+
+
+def latency_profile(room: str, requested: str | None = None) -> str | None:
+    """观看端的时延档位：页面地址中的 latency 参数优先，其次是房间的配置和默认档位"""
+    if requested in LATENCY_PROFILES:
+        return requested
+    return ROOM_LATENCY_PROFILES.get(room, LATENCY_PROFILE)
+
+
+def server_config(client_id: int, host: str, room: str = DEFAULT_ROOM, latency: str | None = None) -> dict:
+    """下发给页面的服务端配置"""
+    return {
+        "presets": ENCODING_PRESETS,
+        "preset": SHARE_PRESET,
+        "layers": SIMULCAST_LAYERS,
+        "codecs": CODEC_PREFERENCES,
+        "preferHardware": CODEC_PREFER_HARDWARE,
+        "ice": ice_config(client_id, host),
+        "statsInterval": QOE_STATS_INTERVAL,
+        "latencyProfiles": LATENCY_PROFILES,
+        "latencyProfile": latency_profile(room, latency),
+    }
+
+
+class Room:
+    """单个会议房间的投屏端和观看端"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.sharers: set[int] = set()
+        self.viewers: set[int] = set()
+        # 连在其他 worker 上的成员
+        self.remote_sharers: set[int] = set()
+        self.remote_viewers: set[int] = set()
+
+    def __len__(self):
+        return len(self.sharers) + len(self.viewers) + len(self.remote_sharers) + len(self.remote_viewers)
+
+    def members(self):
+        """本 worker 上的成员"""
+        yield from self.sharers
+        yield from self.viewers
+
+    def remote_members(self):
+        yield from self.remote_sharers
+        yield from self.remote_viewers
+
+
+def coalesce_key(msg_type: str) -> str | None:
+    """队列满时可以被同类新消息替换的类型返回自身，否则返回 None"""
+    return msg_type if msg_type in COALESCED_TYPES else None
+
+
+class Peer:
+    """单个客户端连接及其待发送队列"""
+
+    def __init__(self, client_id: int, websocket: WebSocket, room: str):
+        self.client_id = client_id
+        self.websocket = websocket
+        self.room = room
+        # 重连时用来取回本会话的令牌
+        self.token = secrets.token_urlsafe(18)
+        # (可合并的消息类型, 消息, 入队时间)，不可合并的消息类型为 None
+        self.queue: deque[tuple[str | None, bytes, float]] = deque()
+        self.ready = asyncio.Event()
+        self.writer: asyncio.Task | None = None
+        # 连接断开、等待重连期间：断开原因和到期后离开房间的定时器
+        self.detached_reason: str | None = None
+        self.expiry: asyncio.TimerHandle | None = None
+
+    def enqueue(self, message: bytes, coalesce: str | None = None) -> bool | None:
+        """放入发送队列：成功返回True，替换了队列中的同类消息返回None，客户端落后返回False"""
+        if len(self.queue) >= SEND_QUEUE_SIZE:
+            if coalesce is None:
+                return False
+            for index, entry in enumerate(self.queue):
+                if entry[0] == coalesce:
+                    # 留在原来的位置，内容换成最新的
+                    self.queue[index] = (coalesce, message, entry[2])
+                    return None
+            return False
+        self.queue.append((coalesce, message, time.perf_counter()))
+        self.ready.set()
+        return True
 
 
 # 连接管理器
 class ConnectionManager:
     def __init__(self):
-        self.connections: list[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
+        self.peers: dict[int, Peer] = {}
+        self.rooms: dict[str, Room] = {}
+        self.sfu: SFU | None = None
+        self.recorder: Recorder | None = None
+        self.hls: HLSIngest | None = None
+        self.qoe = QoEStats(QOE_SAMPLES, profiles=LATENCY_PROFILES)
+        self.bus = LocalBus()
+        # 其他 worker 上的客户端：客户端ID -> (worker序号, 房间)
+        self.remote: dict[int, tuple[int, str]] = {}
+        self.ids = itertools.count(1)
+        self.heartbeat = Heartbeat(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, self._ping, self._evict)
+        self.resume_grace = RESUME_GRACE_SECONDS
+        # 会话令牌 -> 客户端ID
+        self.sessions: dict[str, int] = {}
+        self.dropped = 0
+        self.lagging_disconnects = 0
+        self.send_failures = 0
+        self.heartbeat_timeouts = 0
+        self.resumes = 0
+        # 按原因统计离开房间的客户端，断线后在保留期内恢复的不计入
+        self.disconnects = {"lagging": 0, "send_failure": 0, "heartbeat": 0, "closed": 0}
+
+    def new_client_id(self) -> int:
+        """分配客户端ID，各 worker 的ID按序号错开，不会重复，0 留给 SFU"""
+        return next(self.ids) * self.bus.workers + self.bus.worker_index
+
+    async def connect(self, websocket: WebSocket, client_id: int, room: str = DEFAULT_ROOM) -> Peer:
         await websocket.accept()
-        self.connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.connections:
-            self.connections.remove(websocket)
-
-    async def broadcast(self, message: str, sender: WebSocket = None):
-        """广播消息给除发送者外的所有连接"""
-        disconnected = []
-        for connection in self.connections:
-            if connection != sender:
-                try:
-                    await connection.send_text(message)
-                except Exception:
-                    disconnected.append(connection)
-
-        # 清理断开的连接
-        for conn in disconnected:
-            self.disconnect(conn)
-
-        # 清理断开的连接
-        for conn in disconnected:
-            self.disconnect(conn)
+        return self.join(websocket, client_id, room)
+
+    def join(self, websocket: WebSocket, client_id: int, room: str = DEFAULT_ROOM) -> Peer:
+        """已接受的连接以新会话加入房间"""
+        peer = Peer(client_id, websocket, room)
+        peer.writer = asyncio.create_task(self._write(peer))
+        self.peers[client_id] = peer
+        self.sessions[peer.token] = client_id
+        self.heartbeat.add(client_id)
+        if room not in self.rooms:
+            self.rooms[room] = Room(room)
+        self.rooms[room].viewers.add(client_id)
+        self.bus.publish({"op": "join", "client": client_id, "room": room})
+        return peer
+
+    def resume(self, websocket: WebSocket, token: str, room: str) -> Peer | None:
+        """已接受的连接带会话令牌重连：取回原客户端ID、房间角色和断开期间积压的消息，
+        令牌无效或会话已到期时返回 None，由调用方改为新会话加入
+
+        旧连接可能还没被发现断开（半开的 TCP），此时由新连接取代并关闭旧连接。
+        """
+        peer = self.peers.get(self.sessions.get(token))
+        if peer is None or peer.room != room:
+            return None
+        if peer.expiry is not None:
+            peer.expiry.cancel()
+            peer.expiry = None
+        if peer.writer is not None:
+            peer.writer.cancel()
+        if peer.detached_reason is None:
+            asyncio.create_task(close_quietly(peer.websocket, SESSION_REPLACED_CLOSE_CODE))
+        peer.detached_reason = None
+        peer.websocket = websocket
+        peer.writer = asyncio.create_task(self._write(peer))
+        peer.ready.set()
+        if peer.client_id in self.heartbeat.last_seen:
+            self.heartbeat.touch(peer.client_id)
+        else:
+            self.heartbeat.add(peer.client_id)
+        self.resumes += 1
+        logger.info("客户端 %s 恢复会话，补发 %d 条消息", peer.client_id, len(peer.queue))
+        return peer
+
+    def detach(self, client_id: int, websocket: WebSocket | None = None, reason: str = "closed"):
+        """连接异常断开：保留会话 resume_grace 秒，期间不通知房间，到期后才离开
+
+        websocket 为断开的连接，会话已由新连接恢复时忽略。
+        """
+        peer = self.peers.get(client_id)
+        if peer is None or (websocket is not None and peer.websocket is not websocket):
+            return
+        if self.resume_grace <= 0:
+            self.leave(client_id, reason)
+            return
+        if peer.detached_reason is not None:
+            return
+        peer.detached_reason = reason
+        if peer.writer is not asyncio.current_task():
+            peer.writer.cancel()
+        peer.writer = None
+        peer.expiry = asyncio.get_running_loop().call_later(self.resume_grace, self._expire, peer)
+
+    def _expire(self, peer: Peer):
+        if self.peers.get(peer.client_id) is peer and peer.detached_reason is not None:
+            logger.info("客户端 %s 未在 %.0f 秒内重连，离开房间", peer.client_id, self.resume_grace)
+            self.leave(peer.client_id, peer.detached_reason)
+
+    def disconnect(self, client_id: int, reason: str = "closed"):
+        peer = self.peers.pop(client_id, None)
+        if peer is None:
+            return
+        self.disconnects[reason] += 1
+        self.sessions.pop(peer.token, None)
+        if peer.expiry is not None:
+            peer.expiry.cancel()
+        self.heartbeat.remove(client_id)
+        self.bus.publish({"op": "leave", "client": client_id})
+        room = self.rooms.get(peer.room)
+        if room is not None:
+            room.sharers.discard(client_id)
+            room.viewers.discard(client_id)
+            if not len(room):
+                del self.rooms[peer.room]
+        if peer.writer is not None and peer.writer is not asyncio.current_task():
+            peer.writer.cancel()
+        if self.sfu is not None:
+            self.sfu.close(client_id, disconnected=True)
+        for ingest in self.ingests():
+            ingest.stop(client_id)
+
+    def leave(self, client_id: int, reason: str = "closed"):
+        """断开客户端并通知房间内其他成员
+
+        主动关闭、队列积压和会话保留期满都走这里，重复调用没有副作用。
+        """
+        peer = self.peers.get(client_id)
+        if peer is None:
+            return
+        self.disconnect(client_id, reason)
+        # 更新用户数量
+        self.broadcast(peer.room, encode({
+            "type": "user-count",
+            "data": self.room_size(peer.room)
+        }), coalesce=coalesce_key("user-count"))
+        # 通知停止分享
+        self.broadcast(peer.room, encode({
+            "type": "stop-sharing",
+            "from": client_id
+        }))
 
+    def _ping(self, client_id: int):
+        peer = self.peers.get(client_id)
+        if peer is not None and peer.detached_reason is None:
+            self.send_to(client_id, PING_MESSAGE)
+
+    def _evict(self, client_id: int):
+        """心跳超时：对端可能已不可达，按异常断开保留会话，再尝试关闭，不等待关闭完成"""
+        peer = self.peers.get(client_id)
+        if peer is None or peer.detached_reason is not None:
+            return
+        logger.info("客户端 %s 心跳超时，断开连接", client_id)
+        self.heartbeat_timeouts += 1
+        websocket = peer.websocket
+        self.detach(client_id, websocket, "heartbeat")
+        asyncio.create_task(close_quietly(websocket, HEARTBEAT_CLOSE_CODE))
+
+    def ingests(self) -> list[Recorder]:
+        """以无头观看者身份拉取投屏画面的服务端组件：录制和 HLS"""
+        return [ingest for ingest in (self.recorder, self.hls) if ingest is not None]
+
+    def room_size(self, room: str) -> int:
+        """房间内的在线人数"""
+        return len(self.rooms[room]) if room in self.rooms else 0
+
+    def set_sharing(self, client_id: int, sharing: bool):
+        """切换客户端在房间内的投屏/观看角色"""
+        peer = self.peers.get(client_id)
+        if peer is None:
+            return
+        room = self.rooms[peer.room]
+        if sharing:
+            room.viewers.discard(client_id)
+            room.sharers.add(client_id)
+        else:
+            room.sharers.discard(client_id)
+            room.viewers.add(client_id)
+        self.bus.publish({"op": "sharing", "client": client_id, "sharing": sharing})
+
+    def sharers(self, room: str):
+        """房间内可供观看的投屏端，SFU 模式下只有 SFU 自己"""
+        if self.sfu is not None:
+            return [SFU_PEER_ID] if self.sfu.is_published(room) else []
+        if room not in self.rooms:
+            return []
+        return [*self.rooms[room].sharers, *self.rooms[room].remote_sharers]
+
+    def handle_bus(self, header: dict, payload: bytes):
+        """处理其他 worker 通过总线发来的消息"""
+        op, worker = header.get("op"), header.get("worker")
+        if op == "send":
+            # 只投递给本 worker 上的连接，避免记录过期时在 worker 之间来回转发
+            if header["client"] in self.peers:
+                self.send_to(header["client"], payload, header["coalesce"])
+        elif op == "broadcast":
+            self._broadcast_local(header["room"], payload, header["sender"], header["coalesce"])
+        elif op == "join":
+            self._remote_leave(header["client"])
+            self.remote[header["client"]] = (worker, header["room"])
+            self.rooms.setdefault(header["room"], Room(header["room"])).remote_viewers.add(header["client"])
+        elif op == "leave":
+            self._remote_leave(header["client"])
+        elif op == "sharing":
+            remote = self.remote.get(header["client"])
+            if remote is not None and remote[1] in self.rooms:
+                room = self.rooms[remote[1]]
+                (room.remote_viewers if header["sharing"] else room.remote_sharers).discard(header["client"])
+                (room.remote_sharers if header["sharing"] else room.remote_viewers).add(header["client"])
+        elif op == "hello":
+            # 该 worker 刚启动（或重启），之前记录的它的成员已失效，回复本 worker 的成员
+            for client_id in [client_id for client_id, (owner, _) in self.remote.items() if owner == worker]:
+                self._remote_leave(client_id)
+            for client_id, peer in self.peers.items():
+                self.bus.send(worker, {"op": "join", "client": client_id, "room": peer.room})
+                if client_id in self.rooms[peer.room].sharers:
+                    self.bus.send(worker, {"op": "sharing", "client": client_id, "sharing": True})
+
+    def _remote_leave(self, client_id: int):
+        remote = self.remote.pop(client_id, None)
+        if remote is None or remote[1] not in self.rooms:
+            return
+        room = self.rooms[remote[1]]
+        room.remote_sharers.discard(client_id)
+        room.remote_viewers.discard(client_id)
+        if not len(room):
+            del self.rooms[remote[1]]
+
+    async def _write(self, peer: Peer):
+        """单个连接的发送任务，慢客户端只阻塞自己的队列"""
+        # 恢复会话时会换用新连接重新创建发送任务，这里可以固定下来
+        queue, ready, send = peer.queue, peer.ready, peer.websocket.send_bytes
+        try:
+            while True:
+                await ready.wait()
+                # 每次唤醒只记录一次：队首消息等得最久，是这一批消息时延的上限
+                oldest = queue[0][2] if queue else None
+                while queue:
+                    entry = queue.popleft()
+                    try:
+                        await send(entry[1])
+                    except BaseException:
+                        # 没有确认发出的消息放回队首，会话恢复后由新连接重发
+                        queue.appendleft(entry)
+                        raise
+                if oldest is not None:
+                    SEND_DELAY_SECONDS.observe(time.perf_counter() - oldest)
+                ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.send_failures += 1
+            self.detach(peer.client_id, peer.websocket, "send_failure")
+
+    def send_to(self, client_id: int, message: bytes, coalesce: str | None = None) -> bool:
+        """将消息放入指定客户端的发送队列，不等待发送完成"""
+        peer = self.peers.get(client_id)
+        if peer is None:
+            remote = self.remote.get(client_id)
+            if remote is None:
+                return False
+            # 客户端连在其他 worker 上，由该 worker 放入发送队列
+            self.bus.send(remote[0], {"op": "send", "client": client_id, "coalesce": coalesce}, message)
+            return True
+        result = peer.enqueue(message, coalesce)
+        if result is None:
+            self.dropped += 1
+        elif result is False:
+            logger.warning("客户端 %s 发送队列已满，断开连接", client_id)
+            self.lagging_disconnects += 1
+            self.leave(client_id, "lagging")
+            asyncio.create_task(close_quietly(peer.websocket, 1013))
+        return bool(result)
+
+    def broadcast(self, room: str, message: bytes, sender_id: int = None, coalesce: str | None = None):
+        """广播消息给房间内除发送者外的所有连接"""
+        if room not in self.rooms:
+            return
+        self._broadcast_local(room, message, sender_id, coalesce)
+        # 每个有该房间成员的 worker 只发一次，由它转给自己的成员
+        remote_workers = {self.remote[client_id][0] for client_id in self.rooms[room].remote_members()}
+        for worker in remote_workers:
+            self.bus.send(worker, {"op": "broadcast", "room": room, "sender": sender_id, "coalesce": coalesce},
+                          message)
+
+    def _broadcast_local(self, room: str, message: bytes, sender_id: int | None, coalesce: str | None):
+        if room not in self.rooms:
+            return
+        start = time.perf_counter()
+        # 同一条消息的队列项在所有接收者之间共用，队列未满时直接放入，其余情况交给 send_to 处理
+        entry = (coalesce, message, start)
+        peers = self.peers
+        members = self.rooms[room]
+        for client_id in [*members.sharers, *members.viewers]:
+            if client_id == sender_id:
+                continue
+            peer = peers.get(client_id)
+            if peer is not None:
+                queue = peer.queue
+                depth = len(queue)
+                if depth < SEND_QUEUE_SIZE:
+                    # 队列非空时发送任务已被唤醒，不必再设置事件
+                    if not depth:
+                        peer.ready.set()
+                    queue.append(entry)
+                    continue
+            self.send_to(client_id, message, coalesce)
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
+
+    def relay(self, data: str, sender_id: int):
+        """转发客户端消息：带目标的点对点投递，在线状态事件才广播"""
+        sender = self.peers.get(sender_id)
+        if sender is None:
+            return
+        try:
+            message = decode(data)
+        except ValueError:
+            logger.debug("丢弃客户端 %s 发来的非 JSON 消息", sender_id)
+            return
+        if not isinstance(message, dict) or not message:
+            return
+        self.heartbeat.touch(sender_id)
+        msg_type = message.get('type')
+        target_id = message.get('targetId', message.get('to'))
+        # 类型和目标用于查表和路由，格式不对的消息直接丢弃
+        if (not isinstance(msg_type, str)
+                or (target_id is not None and (not isinstance(target_id, int) or isinstance(target_id, bool)))):
+            logger.debug("丢弃客户端 %s 发来的格式错误的消息", sender_id)
+            return
+        (MESSAGE_COUNTERS.get(msg_type) or OTHER_MESSAGES).inc()
+        if msg_type == 'pong':
+            return
+        if msg_type == 'request-layer' and (not isinstance(message.get('data'), str)
+                                            or message['data'] not in SIMULCAST_LAYERS):
+            return
+        if msg_type == 'stats':
+            # 统计只交给服务器汇总，不转发
+            self.qoe.record(sender.room, sender_id, message.get('data'))
+            return
+        for ingest in self.ingests():
+            if target_id == ingest.peer_id:
+                ingest.handle(sender.room, sender_id, message)
+                return
+            if msg_type == 'start-sharing' and self.sfu is None:
+                # SFU 模式下使用 SFU 收到的推流
+                ingest.start(sender.room, sender_id)
+            elif msg_type == 'stop-sharing':
+                ingest.stop(sender_id)
+        if self.sfu is not None:
+            if target_id == SFU_PEER_ID:
+                self.sfu.handle(sender.room, sender_id, message)
+                return
+            if msg_type == 'start-sharing':
+                # 由 SFU 接收推流后再通知房间内的观看者
+                self.set_sharing(sender_id, True)
+                self.sfu.request_publish(sender.room, sender_id)
+                return
+            if msg_type == 'stop-sharing':
+                self.sfu.close(sender_id)
+        if target_id is None and msg_type not in PRESENCE_TYPES:
+            logger.debug("丢弃无目标的信令消息: %s", msg_type)
+            return
+        if target_id is not None:
+            # 只允许发给同一房间的客户端，包括连在其他 worker 上的
+            target = self.peers.get(target_id)
+            target_room = target.room if target is not None else self.remote.get(target_id, (None, None))[1]
+            if target_room != sender.room:
+                return
+        elif msg_type == 'start-sharing' or msg_type == 'stop-sharing':
+            self.set_sharing(sender_id, msg_type == 'start-sharing')
+
+        # 原样转发，只把 from 拼接进对象末尾，不重新编码整个消息
+        frame = data.rstrip().encode()
+        if 'from' in message or not frame.endswith(b'}'):
+            message['from'] = sender_id
+            frame = encode(message)
+        else:
+            frame = b'%s,"from":%d}' % (frame[:-1], sender_id)
+
+        coalesce = coalesce_key(msg_type)
+        if target_id is not None:
+            self.send_to(target_id, frame, coalesce)
+        else:
+            self.broadcast(sender.room, frame, sender_id, coalesce)
+
+    def stats(self) -> dict:
+        """发送队列统计"""
+        depths = [len(peer.queue) for peer in self.peers.values()]
+        return {
+            "connections": len(self.peers),
+            "rooms": len(self.rooms),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "dropped": self.dropped,
+            "lagging_disconnects": self.lagging_disconnects,
+            "send_failures": self.send_failures,
+            "heartbeat_timeouts": self.heartbeat_timeouts,
+            "heartbeat_pings": self.heartbeat.pings,
+            "detached": sum(1 for peer in self.peers.values() if peer.detached_reason is not None),
+            "resumes": self.resumes,
+        }
+
+
+def server_stats() -> dict:
+    """信令与STUN/TURN服务器统计"""
+    stats = manager.stats()
+    stats["worker"] = WORKER_INDEX
+    stats["remote_clients"] = len(manager.remote)
+    if manager.recorder is not None:
+        stats["recordings"] = manager.recorder.stats()
+    if manager.hls is not None:
+        stats["hls"] = manager.hls.stats()
+    if stun_server is not None:
+        stats["stun_requests"] = stun_server.requests
+        stats["stun_errors"] = stun_server.errors
+        if isinstance(stun_server, TURNProtocol):
+            stats["turn_allocations"] = len(stun_server.allocations)
+            stats["turn_relayed_packets"] = stun_server.relayed_packets
+            stats["turn_relayed_bytes"] = stun_server.relayed_bytes
+    return stats
+
+
+# 页面静态资源，启动时读入内存并预压缩
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+static_assets = StaticAssets(STATIC_DIR)
 
 manager = ConnectionManager()
+if WORKERS > 1:
+    manager.bus = UnixSocketBus(BUS_DIR, WORKER_INDEX, WORKERS, WORKER_PARENT_PID)
+
+# 由已有状态得出的指标，抓取 /metrics 时才读取
+metrics.Gauge("signaling_connections", "在线的信令连接数", lambda: len(manager.peers))
+metrics.Gauge("signaling_rooms", "房间数", lambda: len(manager.rooms))
+metrics.Gauge("signaling_queue_depth", "所有发送队列中待发送的消息数",
+              lambda: sum(len(peer.queue) for peer in manager.peers.values()))
+metrics.Counter("signaling_dropped_total", "发送队列满时被更新的同类消息替换掉的消息", function=lambda: manager.dropped)
+metrics.Counter("signaling_send_failures_total", "发送失败后断开的连接", function=lambda: manager.send_failures)
+metrics.Counter("signaling_disconnects_total", "离开房间的连接", labels=("reason",), function=lambda: {
+    (reason,): count for reason, count in manager.disconnects.items()
+})
+metrics.Counter("signaling_resumes_total", "断线后在保留期内恢复的会话", function=lambda: manager.resumes)
+metrics.Counter("stun_requests_total", "处理的 STUN/TURN 请求",
+                function=lambda: stun_server.requests if stun_server else 0)
+metrics.Counter("stun_errors_total", "返回错误响应的 STUN/TURN 请求",
+                function=lambda: stun_server.errors if stun_server else 0)
+metrics.Gauge("turn_allocations", "TURN 中继分配数",
+              lambda: len(stun_server.allocations) if isinstance(stun_server, TURNProtocol) else 0)
+metrics.Counter("turn_relayed_packets_total", "TURN 中继转发的包",
+                function=lambda: stun_server.relayed_packets if isinstance(stun_server, TURNProtocol) else 0)
+metrics.Counter("turn_relayed_bytes_total", "TURN 中继转发的字节",
+                function=lambda: stun_server.relayed_bytes if isinstance(stun_server, TURNProtocol) else 0)
+if SFU_MODE:
+    if WORKERS > 1:
+        # SFU 的媒体连接只存在于单个进程中
+        raise RuntimeError("SFU_MODE 只支持单个 worker")
+    manager.sfu = SFU(
+        lambda client_id, message: manager.send_to(client_id, encode(message)),
+        lambda room, message, sender_id: manager.broadcast(room, encode(message), sender_id),
+        layers=SIMULCAST_LAYERS,
+        codecs=CODEC_PREFERENCES,
+    )
+if RECORD_DIR:
+    manager.recorder = Recorder(
+        lambda client_id, message: manager.send_to(client_id, encode(message)),
+        RECORD_DIR,
+        rooms=RECORD_ROOMS,
+        segment_seconds=RECORD_SEGMENT_SECONDS,
+        format=RECORD_FORMAT,
+    )
+if HLS_ENABLED:
+    if WORKERS > 1:
+        # 段只保存在拉流的 worker 的内存中
+        raise RuntimeError("HLS_ENABLED 只支持单个 worker")
+    manager.hls = HLSIngest(
+        lambda client_id, message: manager.send_to(client_id, encode(message)),
+        rooms=HLS_ROOMS,
+        segment_seconds=HLS_SEGMENT_SECONDS,
+        part_seconds=HLS_PART_SECONDS,
+        window=HLS_WINDOW,
+    )
+if manager.sfu is not None:
+    for ingest in manager.ingests():
+        manager.sfu.publish_listeners.append(ingest.record_track)
 
 
 @app.get("/", response_class=HTMLResponse)
-async def get():
+async def get(request: Request):
     """主页面"""
-    return """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>局域网在线投屏</title>
-        <meta charset="UTF-8">
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                margin: 0;
-                padding: 20px;
-                background: #f5f6fa;
-                min-height: 100vh;
-            }
-            .container {
-                max-width: 900px;
-                margin: 0 auto;
-                background: white;
-                padding: 30px;
-                border-radius: 15px;
-                box-shadow: 0 10px 30px rgba(0,0,0,0.2);
-            }
-            h1 {
-                text-align: center;
-                color: #333;
-                margin-bottom: 30px;
-                font-size: 2.5em;
-            }
-            .status {
-                padding: 15px;
-                border-radius: 10px;
-                font-weight: bold;
-                flex: 1;
-                margin-right: 10px;
-            }
-            .status.connected {
-                background: #d4edda;
-                color: #155724;
-            }
-            .status.disconnected {
-                background: #f8d7da;
-                color: #721c24;
-            }
-            .status-row {
-                display: flex;
-                align-items: center;
-                margin-bottom: 20px;
-                gap: 10px;
-            }
-            .user-count {
-                background: #e3f2fd;
-                color: #1565c0;
-                padding: 15px;
-                border-radius: 10px;
-                font-weight: bold;
-                white-space: nowrap;
-            }
-            .controls {
-                text-align: center;
-                margin: 30px 0;
-            }
-            button {
-                background: linear-gradient(45deg, #4CAF50, #45a049);
-                color: white;
-                padding: 15px 30px;
-                border: none;
-                border-radius: 25px;
-                cursor: pointer;
-                font-size: 16px;
-                margin: 10px;
-                transition: all 0.3s ease;
-                box-shadow: 0 4px 15px rgba(0,0,0,0.2);
-            }
-            button:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 6px 20px rgba(0,0,0,0.3);
-            }
-            button:disabled {
-                background: #ccc;
-                cursor: not-allowed;
-                transform: none;
-                box-shadow: none;
-            }
-            .stop-btn {
-                background: linear-gradient(45deg, #f44336, #da190b);
-            }
-            .info {
-                background: #e9ecef;
-                padding: 10px;
-                border-radius: 10px;
-                margin: 20px 0;
-                text-align: center;
-            }
-            .video-grid {
-                display: grid;
-                grid-template-columns: 1fr 1fr;
-                gap: 20px;
-                margin-top: 30px;
-            }
-            .video-item {
-                text-align: center;
-                position: relative;
-            }
-            .video-header {
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-                margin-bottom: 10px;
-            }
-            .video-label {
-                font-weight: bold;
-                font-size: 18px;
-                color: #555;
-            }
-            video {
-                width: 100%;
-                max-width: 400px;
-                height: 250px;
-                border: 3px solid #ddd;
-                border-radius: 10px;
-                background: #000;
-                object-fit: contain;
-            }
-            video:fullscreen {
-                object-fit: contain;
-                width: 100vw;
-                height: 100vh;
-                max-width: none;
-                border: none;
-                border-radius: 0;
-            }
-            video:-webkit-full-screen {
-                object-fit: contain;
-                width: 100vw;
-                height: 100vh;
-                max-width: none;
-                border: none;
-                border-radius: 0;
-            }
-            video:-moz-full-screen {
-                object-fit: contain;
-                width: 100vw;
-                height: 100vh;
-                max-width: none;
-                border: none;
-                border-radius: 0;
-            }
-            .empty-video {
-                width: 100%;
-                max-width: 400px;
-                height: 250px;
-                border: 3px dashed #ccc;
-                border-radius: 10px;
-                background: #f8f9fa;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                color: #6c757d;
-                font-size: 16px;
-            }
-            @media (max-width: 768px) {
-                .video-grid {
-                    grid-template-columns: 1fr;
-                }
-                .container {
-                    padding: 20px;
-                    margin: 10px;
-                }
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🖥️ 局域网在线投屏</h1>
-            
-            <div class="status-row">
-                <div id="status" class="status disconnected">
-                    连接状态: 未连接
-                </div>
-                <div class="user-count">
-                    在线用户: <span id="userCount">1</span> 人
-                </div>
-            </div>
-            
-            <div class="info">
-                <p><strong>使用说明:</strong> 请将投屏端与展示端（服务端）连接至相同局域网；在投屏端使用浏览器访问当前页面地址栏相同网址，点击下方"开始投屏"，选择"整个屏幕"窗口进行共享。展示端投屏画面内可点击全屏。</p>
-            </div>
-            
-            <div class="controls">
-                <button id="shareBtn" onclick="toggleShare()">开始投屏</button>
-                <button onclick="location.reload()">刷新页面</button>
-            </div>
-            
-            <div class="video-grid">
-                <div class="video-item">
-                    <div class="video-header">
-                        <div class="video-label">我的屏幕</div>
-                    </div>
-                    <video id="localVideo" autoplay muted controls style="display:none;"></video>
-                    <div id="localPlaceholder" class="empty-video">等待开始投屏...</div>
-                </div>
-                <div class="video-item">
-                    <div class="video-header">
-                        <div class="video-label">投屏画面</div>
-                    </div>
-                    <video id="remoteVideo" autoplay controls style="display:none;"></video>
-                    <div id="remotePlaceholder" class="empty-video">等待对方投屏...</div>
-                </div>
-            </div>
-        </div>
-
-        <script>
-            let localStream = null;
-            let peerConnection = null;
-            let websocket = null;
-            let isSharing = false;
-            let myClientId = null;
-
-            // WebRTC 配置
-            const rtcConfig = {
-                iceServers: [
-                    { urls: `stun:${location.hostname}:3478` },  // 使用本机STUN服务器
-                    { urls: 'stun:stun.l.google.com:19302' },   // 备用公网STUN
-                    { urls: 'stun:stun1.l.google.com:19302' }   // 备用公网STUN
-                ]
-            };
-
-            // 初始化
-            window.onload = function() {
-                connectWebSocket();
-            };
-
-            // WebSocket 连接
-            function connectWebSocket() {
-                const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
-                websocket = new WebSocket(`${protocol}//${location.host}/ws`);
-                
-                websocket.onopen = () => {
-                    updateStatus('已连接', true);
-                };
-                
-                websocket.onmessage = async (event) => {
-                    try {
-                        const message = JSON.parse(event.data);
-                        await handleMessage(message);
-                    } catch (error) {
-                        console.error('处理消息错误:', error);
-                    }
-                };
-                
-                websocket.onclose = () => {
-                    updateStatus('连接断开', false);
-                    setTimeout(connectWebSocket, 3000);
-                };
-                
-                websocket.onerror = (error) => {
-                    console.error('WebSocket 错误:', error);
-                };
-            }
-
-            // 处理消息
-            async function handleMessage(message) {
-                const { type, data, from } = message;
-                
-                // 忽略自己发送的消息
-                if (from === myClientId) return;
-                
-                switch (type) {
-                    case 'client-id':
-                        myClientId = data;
-                        break;
-                    case 'start-sharing':
-                        if (!isSharing) {
-                            setTimeout(() => {
-                                if (!isSharing) {
-                                    requestWatching(from);
-                                }
-                            }, 500);
-                        }
-                        break;
-                    case 'request-watching':
-                        if (isSharing) {
-                            await sendOfferTo(from);
-                        }
-                        break;
-                    case 'offer':
-                        await handleOffer(data, from);
-                        break;
-                    case 'answer':
-                        await handleAnswer(data, from);
-                        break;
-                    case 'ice-candidate':
-                        await handleIceCandidate(data, from);
-                        break;
-                    case 'user-count':
-                        document.getElementById('userCount').textContent = data;
-                        break;
-                    case 'stop-sharing':
-                        handleStopSharing(from);
-                        break;
-                }
-            }
-
-            // 切换分享状态
-            async function toggleShare() {
-                if (isSharing) {
-                    stopSharing();
-                } else {
-                    await startSharing();
-                }
-            }
-
-            // 开始分享
-            async function startSharing() {
-                try {
-                    // 获取屏幕流
-                    localStream = await navigator.mediaDevices.getDisplayMedia({
-                        video: {
-                            mediaSource: 'screen',
-                            width: { ideal: 1920 },
-                            height: { ideal: 1080 },
-                            frameRate: { ideal: 30 }
-                        },
-                        audio: true
-                    });
-                    
-                    // 显示本地视频
-                    const localVideo = document.getElementById('localVideo');
-                    localVideo.srcObject = localStream;
-                    localVideo.style.display = 'block';
-                    document.getElementById('localPlaceholder').style.display = 'none';
-                    
-                    // 监听流结束
-                    localStream.getVideoTracks()[0].onended = () => {
-                        stopSharing();
-                    };
-                    
-                    // 创建分享者连接
-                    peerConnection = new RTCPeerConnection(rtcConfig);
-                    
-                    // 添加本地流
-                    localStream.getTracks().forEach(track => {
-                        peerConnection.addTrack(track, localStream);
-                    });
-                    
-                    // ICE 候选处理
-                    peerConnection.onicecandidate = (event) => {
-                        if (event.candidate) {
-                            sendMessage({
-                                type: 'ice-candidate',
-                                data: event.candidate
-                            });
-                        }
-                    };
-                    
-                    // 通知开始分享
-                    sendMessage({ type: 'start-sharing' });
-                    
-                    isSharing = true;
-                    document.getElementById('shareBtn').textContent = '停止投屏';
-                    document.getElementById('shareBtn').className = 'stop-btn';
-                    
-                } catch (error) {
-                    alert('投屏失败，请确保选择了要分享的屏幕或窗口');
-                }
-            }
-
-            // 停止分享
-            function stopSharing() {
-                if (localStream) {
-                    localStream.getTracks().forEach(track => track.stop());
-                    localStream = null;
-                }
-                
-                if (peerConnection) {
-                    peerConnection.close();
-                    peerConnection = null;
-                }
-                
-                // 重置UI
-                document.getElementById('localVideo').style.display = 'none';
-                document.getElementById('localPlaceholder').style.display = 'flex';
-                document.getElementById('shareBtn').textContent = '开始投屏';
-                document.getElementById('shareBtn').className = '';
-                
-                // 通知停止分享
-                sendMessage({ type: 'stop-sharing' });
-                
-                isSharing = false;
-            }
-
-            // 请求观看分享
-            function requestWatching(sharerId) {
-                sendMessage({
-                    type: 'request-watching',
-                    targetId: sharerId
-                });
-            }
-
-            // 发送offer给指定观看者
-            async function sendOfferTo(viewerId) {
-                if (!isSharing || !localStream) return;
-                
-                try {
-                    if (peerConnection) {
-                        peerConnection.close();
-                    }
-                    
-                    peerConnection = new RTCPeerConnection(rtcConfig);
-                    
-                    // 添加本地流
-                    localStream.getTracks().forEach(track => {
-                        peerConnection.addTrack(track, localStream);
-                    });
-                    
-                    // ICE 候选处理
-                    peerConnection.onicecandidate = (event) => {
-                        if (event.candidate) {
-                            sendMessage({
-                                type: 'ice-candidate',
-                                data: event.candidate
-                            });
-                        }
-                    };
-
-                    // 创建并发送 offer
-                    const offer = await peerConnection.createOffer({
-                        offerToReceiveVideo: false,
-                        offerToReceiveAudio: false
-                    });
-                    await peerConnection.setLocalDescription(offer);
-                    
-                    sendMessage({
-                        type: 'offer',
-                        data: offer
-                    });
-                } catch (error) {
-                    console.error('发送offer失败:', error);
-                }
-            }
-
-            // 创建观看者连接
-            async function createViewerConnection() {
-                if (isSharing) return;
-                
-                if (peerConnection) {
-                    peerConnection.close();
-                }
-                
-                peerConnection = new RTCPeerConnection(rtcConfig);
-                
-                // 监听远程流
-                peerConnection.ontrack = (event) => {
-                    if (event.streams.length > 0) {
-                        const remoteVideo = document.getElementById('remoteVideo');
-                        remoteVideo.srcObject = event.streams[0];
-                        remoteVideo.style.display = 'block';
-                        document.getElementById('remotePlaceholder').style.display = 'none';
-                        
-                        // 确保自动播放
-                        remoteVideo.play().catch(e => {
-                            console.error('自动播放失败:', e);
-                            // 如果自动播放失败，尝试设置静音后播放
-                            remoteVideo.muted = true;
-                            remoteVideo.play().catch(err => console.error('静音播放也失败:', err));
-                        });
-                    }
-                };
-                
-                // ICE 候选处理
-                peerConnection.onicecandidate = (event) => {
-                    if (event.candidate) {
-                        sendMessage({
-                            type: 'ice-candidate',
-                            data: event.candidate
-                        });
-                    }
-                };
-            }
-
-            // 处理 offer
-            async function handleOffer(offer, from) {
-                if (isSharing) return;
-                
-                await createViewerConnection();
-                
-                try {
-                    await peerConnection.setRemoteDescription(offer);
-                    const answer = await peerConnection.createAnswer();
-                    await peerConnection.setLocalDescription(answer);
-                    
-                    sendMessage({
-                        type: 'answer',
-                        data: answer
-                    });
-                } catch (error) {
-                    console.error('处理offer失败:', error);
-                }
-            }
-
-            // 处理 answer
-            async function handleAnswer(answer, from) {
-                if (!peerConnection) return;
-                
-                try {
-                    await peerConnection.setRemoteDescription(answer);
-                } catch (error) {
-                    console.error('处理answer失败:', error);
-                }
-            }
-
-            // 处理 ICE candidate
-            async function handleIceCandidate(candidate, from) {
-                if (!peerConnection) return;
-                
-                try {
-                    await peerConnection.addIceCandidate(candidate);
-                } catch (error) {
-                    console.error('添加ICE候选失败:', error);
-                }
-            }
-
-            // 处理停止分享
-            function handleStopSharing(from) {
-                if (peerConnection && !isSharing) {
-                    peerConnection.close();
-                    peerConnection = null;
-                }
-                
-                // 重置远程视频
-                document.getElementById('remoteVideo').style.display = 'none';
-                document.getElementById('remotePlaceholder').style.display = 'flex';
-                document.getElementById('remoteVideo').srcObject = null;
-            }
-
-            // 发送消息
-            function sendMessage(message) {
-                if (websocket && websocket.readyState === WebSocket.OPEN) {
-                    websocket.send(JSON.stringify(message));
-                }
-            }
-
-            // 更新状态
-            function updateStatus(message, isConnected) {
-                const status = document.getElementById('status');
-                status.textContent = `连接状态: ${message}`;
-                status.className = `status ${isConnected ? 'connected' : 'disconnected'}`;
-            }
-
-            // 页面关闭清理
-            window.onbeforeunload = function() {
-                if (isSharing) {
-                    stopSharing();
-                }
-            };
-        </script>
-    </body>
-    </html>
-    """
+    return static_assets.index.response(request)
+
+
+@app.get("/static/{name}")
+async def static_file(name: str, request: Request):
+    """页面引用的 CSS/JS，文件名带内容哈希"""
+    asset = static_assets.get(name)
+    if asset is None:
+        return Response(status_code=404)
+    return asset.response(request)
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket 端点处理实时通信"""
-    client_id = id(websocket)
-    await manager.connect(websocket)
-
-    # 发送客户端ID和用户数量
-    try:
-        await websocket.send_text(json.dumps({
-            "type": "client-id",
-            "data": client_id
-        }))
-
-        await manager.broadcast(json.dumps({
+    room = (websocket.query_params.get("room") or DEFAULT_ROOM)[:ROOM_NAME_MAX_LENGTH]
+    token = websocket.query_params.get("session")
+    # 先完成握手，之后查找会话和加入房间之间没有等待，会话不会在中途到期
+    await websocket.accept()
+    peer = manager.resume(websocket, token, room) if token else None
+    resumed = peer is not None
+    if not resumed:
+        peer = manager.join(websocket, manager.new_client_id(), room)
+    client_id = peer.client_id
+
+    # 发送客户端ID、会话令牌和服务端配置
+    manager.send_to(client_id, encode({
+        "type": "client-id",
+        "data": client_id
+    }))
+    manager.send_to(client_id, encode({
+        "type": "session",
+        "data": {"token": peer.token, "resumed": resumed, "grace": manager.resume_grace}
+    }))
+    manager.send_to(client_id, encode({
+        "type": "server-config",
+        "data": server_config(client_id, websocket.url.hostname or "localhost", room,
+                              websocket.query_params.get("latency"))
+    }))
+
+    # 恢复的会话仍在房间中，断开期间的投屏状态变化已在补发的消息里
+    if not resumed:
+        manager.broadcast(room, encode({
             "type": "user-count",
-            "data": len(manager.connections)
-        }))
-    except Exception:
-        pass
+            "data": manager.room_size(room)
+        }), coalesce=coalesce_key("user-count"))
 
+        # 告知新加入者房间内正在投屏的客户端
+        for sharer_id in manager.sharers(room):
+            manager.send_to(client_id, encode({
+                "type": "start-sharing",
+                "from": sharer_id
+            }))
+
+    close_code = None
     try:
         while True:
             data = await websocket.receive_text()
-            message = json.loads(data)
-            message['from'] = client_id
 
-            # 广播消息给其他客户端
-            await manager.broadcast(json.dumps(message), websocket)
+            # 按目标转发给其他客户端
+            manager.relay(data, client_id)
+
+    except WebSocketDisconnect as e:
+        close_code = e.code
+    except Exception as e:
+        logger.debug("客户端 %s 连接异常: %s", client_id, e)
+    finally:
+        if close_code in LEAVE_CLOSE_CODES:
+            # 会话已由新连接恢复时，旧连接的关闭不代表离开
+            if peer.websocket is websocket:
+                manager.leave(client_id)
+        else:
+            # 网络中断：保留会话等待重连
+            manager.detach(client_id, websocket)
+
+
+@app.get("/hls/{room}/{name}")
+async def hls(room: str, name: str, _HLS_msn: str | None = None, _HLS_part: str | None = None):
+    """低延迟 HLS 播放列表、初始化段、段和部分段"""
+    if manager.hls is None:
+        return Response(status_code=404)
+    return await manager.hls.response(room, name, _HLS_msn, _HLS_part)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Prometheus 文本格式的运行指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/qoe")
+async def qoe(room: str | None = None):
+    """页面上报的 WebRTC 统计，按会话给出 p50/p95"""
+    return {"interval": QOE_STATS_INTERVAL, "sessions": manager.qoe.summary(room)}
+
+
+@app.get("/stats")
+async def stats():
+    """信令发送队列与STUN/TURN统计"""
+    return server_stats()
+
+
+def run_server(host: str, port: int, sockets: list | None = None, **options):
+    """启动 HTTPS 服务器。ssl 模块默认已开启会话恢复（TLS 1.3 会话票据、TLS 1.2 会话缓存），
+    票据密钥在进程内生成，多 worker 时只有连回同一个 worker 的客户端能恢复会话"""
+    config = uvicorn.Config(app, host=host, port=port, log_level="warning", log_config=None,
+                            access_log=False, **options)
+    uvicorn.Server(config).run(sockets=sockets)
+
+
+def serve_worker(host: str, port: int, **options):
+    """worker 进程入口：各 worker 用 SO_REUSEPORT 绑定同一端口，由内核分配新连接"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    run_server(host, port, sockets=[sock], **options)
+
+
+def spawn_workers(count: int, host: str, port: int, **options) -> list[subprocess.Popen]:
+    """启动 count 个 worker 进程，它们共享总线目录和 TURN 凭证密钥"""
+    env = dict(
+        os.environ,
+        WORKERS=str(count),
+        BUS_DIR=BUS_DIR or tempfile.mkdtemp(prefix="screenshare-bus-"),
+        WORKER_PARENT_PID=str(os.getpid()),
+        TURN_SECRET=os.environ.get("TURN_SECRET") or os.urandom(32).hex(),
+    )
+    code = f"import main; main.serve_worker({host!r}, {port!r}, **{options!r})"
+    return [
+        subprocess.Popen([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         env=dict(env, WORKER_INDEX=str(index)))
+        for index in range(count)
+    ]
 
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        # 更新用户数量
-        await manager.broadcast(json.dumps({
-            "type": "user-count",
-            "data": len(manager.connections)
-        }))
-        # 通知停止分享
-        await manager.broadcast(json.dumps({
-            "type": "stop-sharing",
-            "from": client_id
-        }))
-    except Exception:
-        manager.disconnect(websocket)
 
 if __name__ == "__main__":
     import threading
@@ -857,17 +1102,15 @@ if __name__ == "__main__":
             if not shutdown_event.is_set():
                 print(f"HTTP服务器错误: {e}")
 
+    # 复用已有证书，密钥类型、有效期或本机地址不符时重新生成
+    ensure_cert("cert.pem", "key.pem")
+
     print(f"投屏服务启动成功！")
     print("=" * 30)
     print("按 Ctrl+C 立即强制退出程序")
     print("或者输入 'q' 然后按回车退出")
     print("=" * 30)
 
-    # 启动内置STUN服务器
-    stun_server = SimpleSTUNServer()
-    stun_thread = threading.Thread(target=stun_server.start, daemon=True)
-    stun_thread.start()
-
     # 启动键盘监控线程
     keyboard_thread = threading.Thread(target=keyboard_monitor, daemon=True)
     keyboard_thread.start()
@@ -877,17 +1120,15 @@ if __name__ == "__main__":
     http_thread.start()
 
     try:
-        # 启动HTTPS服务器
-        uvicorn.run(
-            app,
-            host="0.0.0.0",
-            port=443,
-            log_level="warning",
-            ssl_keyfile="key.pem",
-            ssl_certfile="cert.pem",
-            log_config=None,
-            access_log=False
-        )
+        if WORKERS > 1:
+            # 启动多个HTTPS worker进程共享443端口
+            print(f"启动 {WORKERS} 个 worker 进程")
+            for process in spawn_workers(WORKERS, "0.0.0.0", 443,
+                                         ssl_keyfile="key.pem", ssl_certfile="cert.pem"):
+                process.wait()
+        else:
+            # 启动HTTPS服务器
+            run_server("0.0.0.0", 443, ssl_keyfile="key.pem", ssl_certfile="cert.pem")
     except KeyboardInterrupt:
         print("\n收到键盘中断，立即强制退出...")
         # 直接强制退出
@@ -0,0 +1,164 @@
+"""Prometheus 文本格式的运行指标
+
+不依赖 prometheus_client。热路径上只做整数加法和一次二分查找，可以常开；
+由已有计数器或运行时状态得出的指标在抓取时通过回调读取，平时没有开销。
+"""
+import asyncio
+import math
+from bisect import bisect_left
+
+# 默认的时延分桶（秒），覆盖从几十微秒的 STUN 响应到秒级的慢客户端
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REGISTRY: list["Metric"] = []
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), function=None):
+        """function 在抓取时调用：无标签时返回数值，有标签时返回 {标签值元组: 数值}"""
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.function = function
+        self.children: dict[tuple, object] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """返回 (后缀, 标签值, 额外标签, 数值)"""
+        if self.function is not None:
+            value = self.function()
+            if self.label_names:
+                for label_values, sample in value.items():
+                    yield "", label_values, "", sample
+            else:
+                yield "", (), "", value
+            return
+        for label_values, child in self.children.items():
+            yield from child.samples(label_values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, label_values, extra, value in self.samples():
+            labels = format_labels(self.label_names, label_values, extra)
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return lines
+
+
+class CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self, label_values):
+        yield "", label_values, "", self.value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), function=None):
+        super().__init__(name, help, labels, function)
+        if not labels and function is None:
+            self.default = self.labels()
+            self.inc = self.default.inc
+
+    def new_child(self):
+        return CounterValue()
+
+
+class Gauge(Metric):
+    """只支持回调形式，数值在抓取时读取"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, function, labels: tuple = ()):
+        super().__init__(name, help, labels, function)
+
+
+class HistogramValue:
+    __slots__ = ("upper_bounds", "counts", "sum", "count")
+
+    def __init__(self, upper_bounds: tuple):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, label_values):
+        cumulative = 0
+        for bound, count in zip((*self.upper_bounds, math.inf), self.counts):
+            cumulative += count
+            yield "_bucket", label_values, f'le="{format_value(bound)}"', cumulative
+        yield "_sum", label_values, "", self.sum
+        yield "_count", label_values, "", self.count
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+        if not labels:
+            self.default = self.labels()
+            self.observe = self.default.observe
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "定时器唤醒相对预定时间的延迟",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+
+async def monitor_event_loop(interval: float = 0.5):
+    """定期测量事件循环延迟：计划 interval 秒后唤醒，实际多等的时间即为被阻塞的时间"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - expected))
@@ -0,0 +1,124 @@
+"""页面上报的 WebRTC 统计（getStats）汇总，用于定位观看端卡顿
+
+每个会话（上报者, 对端, 方向）保留最近的若干个采样，按会话给出 p50/p95。
+"""
+import math
+import time
+from collections import OrderedDict, deque
+
+# 接受的数值字段：帧率、解码/编码耗时、抖动缓冲时延及其目标值、丢包率、码率、往返时延、卡顿次数
+NUMERIC_FIELDS = ("fps", "decodeMs", "encodeMs", "jitterMs", "jitterTargetMs", "loss", "kbps", "rttMs", "freezes")
+QUALITY_LIMITATIONS = {"none", "cpu", "bandwidth", "other"}
+DIRECTIONS = {"in", "out"}
+# 一条上报消息中最多的采样数（投屏端每个观看者一条）
+MAX_SAMPLES_PER_MESSAGE = 64
+
+
+def percentile(values: list, fraction: float) -> float | None:
+    """最近秩法求分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Session:
+    def __init__(self, room: str, client_id: int, peer_id: int, direction: str, size: int):
+        self.room = room
+        self.client_id = client_id
+        self.peer_id = peer_id
+        self.direction = direction
+        self.samples: deque[dict] = deque(maxlen=size)
+        self.updated = 0.0
+
+
+class QoEStats:
+    def __init__(self, samples_per_session: int = 120, max_sessions: int = 500, profiles=()):
+        self.samples_per_session = samples_per_session
+        self.max_sessions = max_sessions
+        # 观看端上报的时延档位名称，只接受服务端配置中存在的档位
+        self.profiles = set(profiles)
+        # 按最近更新排序，超过上限时淘汰最久未更新的会话，断开的会话在此之前仍可查看
+        self.sessions: OrderedDict[tuple, Session] = OrderedDict()
+
+    def record(self, room: str, client_id: int, data) -> int:
+        """记录一条上报消息，返回接受的采样数"""
+        if not isinstance(data, list):
+            return 0
+        accepted = 0
+        now = time.time()
+        for item in data[:MAX_SAMPLES_PER_MESSAGE]:
+            if not isinstance(item, dict):
+                continue
+            peer_id, direction = item.get("peer"), item.get("dir")
+            if not isinstance(peer_id, int) or isinstance(peer_id, bool) or direction not in DIRECTIONS:
+                continue
+            sample = {"t": now}
+            for field in NUMERIC_FIELDS:
+                value = item.get(field)
+                if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                        and math.isfinite(value) and value >= 0):
+                    sample[field] = value
+            if item.get("limit") in QUALITY_LIMITATIONS:
+                sample["limit"] = item["limit"]
+            profile = item.get("profile")
+            if isinstance(profile, str) and profile in self.profiles:
+                sample["profile"] = profile
+            self._session(room, client_id, peer_id, direction).samples.append(sample)
+            accepted += 1
+        return accepted
+
+    def _session(self, room: str, client_id: int, peer_id: int, direction: str) -> Session:
+        key = (client_id, peer_id, direction)
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = Session(room, client_id, peer_id, direction, self.samples_per_session)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        else:
+            self.sessions.move_to_end(key)
+        session.updated = time.time()
+        return session
+
+    def summary(self, room: str | None = None) -> list[dict]:
+        """按会话汇总各指标的 p50/p95
+
+        观看端的端到端时延按 往返时延/2 + 抖动缓冲 + 解码 估算，投屏端对同一观看者上报了
+        编码耗时时一并计入；采集和渲染的时间无法从 getStats 得到，不包含在内。
+        """
+        encode_ms = {}
+        for session in self.sessions.values():
+            if session.direction == "out":
+                values = [sample["encodeMs"] for sample in session.samples if "encodeMs" in sample]
+                if values:
+                    encode_ms[(session.client_id, session.peer_id)] = percentile(values, 0.5)
+
+        result = []
+        for session in self.sessions.values():
+            if room is not None and session.room != room:
+                continue
+            entry = {
+                "room": session.room,
+                "client": session.client_id,
+                "peer": session.peer_id,
+                "direction": session.direction,
+                "samples": len(session.samples),
+                "updated": session.updated,
+            }
+            for field in NUMERIC_FIELDS:
+                values = [sample[field] for sample in session.samples if field in sample]
+                if values:
+                    entry[field] = {"p50": percentile(values, 0.5), "p95": percentile(values, 0.95)}
+            for field in ("limit", "profile"):
+                values = [sample[field] for sample in session.samples if field in sample]
+                if values:
+                    entry[field] = max(set(values), key=values.count)
+            if session.direction == "in":
+                encode = encode_ms.get((session.peer_id, session.client_id), 0)
+                latencies = [sample["rttMs"] / 2 + sample["jitterMs"] + sample.get("decodeMs", 0) + encode
+                             for sample in session.samples if "rttMs" in sample and "jitterMs" in sample]
+                if latencies:
+                    entry["glassToGlassMs"] = {"p50": percentile(latencies, 0.5),
+                                               "p95": percentile(latencies, 0.95)}
+            result.append(entry)
+        return result
@@ -0,0 +1,417 @@
+"""服务端录制：以无头观看者身份加入房间，把投屏画面写成分段文件
+
+需要安装 aiortc。录制端在信令中作为一个虚拟客户端出现（RECORDER_PEER_ID），
+投屏端开始分享时由它发出 request-watching，投屏页面像对待普通观看者一样发来 offer。
+SFU 模式下直接录制 SFU 收到的推流，投屏端不需要多推一路。
+
+aiortc 只向应用提供解码后的帧，无法直接转存收到的码流，录制时重新编码：
+MP4 使用 H.264，WebM 使用 VP8。编码在线程中进行，不阻塞信令的事件循环；
+待编码的帧队列有上限，编码跟不上时丢弃最旧的帧。
+
+每个录制一个目录，按 RECORD_SEGMENT_SECONDS 切分成独立可播放的文件，每段以关键帧开头，
+index.json 记录各段的起始时间和时长，按时间定位到段后再在段内查找，不需要扫描整个录制。
+投屏端连接中断后重新发来 offer 时继续写入同一个目录，之后的第一段标记 discontinuity。
+"""
+import asyncio
+import bisect
+import json
+import logging
+import os
+import re
+import time
+from collections import deque
+from fractions import Fraction
+
+try:
+    import av
+    from aiortc import RTCConfiguration, RTCPeerConnection, RTCRtpReceiver, RTCSessionDescription
+except ImportError:
+    RTCPeerConnection = None
+
+from sfu import PENDING_CANDIDATES_MAX, add_ice_candidate
+
+logger = logging.getLogger(__name__)
+
+# 录制端在信令中的客户端ID
+RECORDER_PEER_ID = -1
+
+# 待编码的帧数上限，约 1 秒
+PENDING_FRAMES_MAX = 30
+
+# 段内时间戳精度
+TIME_BASE = Fraction(1, 1000)
+
+FORMATS = {
+    # 分片 MP4：每个关键帧一个片段，边录边写，录制中断时已写入的片段仍可播放
+    "mp4": {
+        "codec": "libx264",
+        "options": {"preset": "veryfast", "tune": "zerolatency", "crf": "26"},
+        "container": {"movflags": "frag_keyframe+empty_moov+default_base_moof"},
+    },
+    "webm": {
+        "codec": "libvpx",
+        "options": {"deadline": "realtime", "cpu-used": "8", "crf": "20", "b": "2M"},
+        "container": {},
+    },
+}
+
+
+def safe_name(name: str) -> str:
+    """房间名来自客户端，转换为可以安全用作目录名的形式"""
+    return re.sub(r"[^\w-]", "_", name)[:64] or "_"
+
+
+def find_segment(index: dict, seconds: float) -> tuple[dict, float] | None:
+    """按录制时间找到所在的段，返回 (段, 段内时间)"""
+    segments = index["segments"]
+    if not segments:
+        return None
+    position = max(0, bisect.bisect_right([segment["start"] for segment in segments], seconds) - 1)
+    segment = segments[position]
+    return segment, max(0.0, seconds - segment["start"])
+
+
+class SegmentWriter:
+    """把帧编码写入分段文件，写完一段后更新索引
+
+    write/close 会阻塞，由 Recording 在线程中调用。name、frames、duration 用于日志和统计。
+    """
+
+    def __init__(self, directory: str, segment_seconds: float = 10.0, format: str = "mp4",
+                 metadata: dict | None = None):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.format = format
+        self.settings = FORMATS[format]
+        self.index = {
+            **(metadata or {}),
+            "format": format,
+            "segmentSeconds": segment_seconds,
+            "started": time.time(),
+            "ended": None,
+            "duration": 0.0,
+            "segments": [],
+        }
+        self.container = None
+        self.stream = None
+        self.segment = None
+        self.first_pts = 0
+        self.last_pts = -1
+        self.frames = 0
+        self.discontinuity = False
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def name(self) -> str:
+        return self.directory
+
+    @property
+    def duration(self) -> float:
+        return self.index["duration"]
+
+    def write(self, frame):
+        time_base = frame.time_base or Fraction(1, 90000)
+        if self.container is not None:
+            pts = int((frame.pts - self.first_pts) * time_base / TIME_BASE)
+            if (pts / 1000 >= self.segment_seconds or pts < 0
+                    or (frame.width // 2 * 2, frame.height // 2 * 2) != (self.stream.width, self.stream.height)):
+                # 到达分段时长、时间戳回绕或画面尺寸变化时开始新的一段
+                self._finish_segment()
+        if self.container is None:
+            self._open_segment(frame)
+            pts = 0
+        # 编码器要求时间戳严格递增
+        pts = max(pts, self.last_pts + 1)
+        self.last_pts = pts
+        frame.pts = pts
+        frame.time_base = TIME_BASE
+        for packet in self.stream.encode(frame):
+            self.container.mux(packet)
+        self.segment["frames"] += 1
+        self.frames += 1
+
+    def close(self):
+        self._finish_segment()
+        self.index["ended"] = time.time()
+        self._write_index()
+
+    def resume(self):
+        """关闭后继续写入：下一帧开始新的一段，接在已有的段之后"""
+        self.index["ended"] = None
+        self.discontinuity = True
+
+    def _open_segment(self, frame):
+        number = len(self.index["segments"]) + 1
+        name = f"segment-{number:05d}.{self.format}"
+        self.container = av.open(os.path.join(self.directory, name), "w", format=self.format,
+                                 options=self.settings["container"])
+        # 编码器按整数帧率做码率控制，实际时间戳来自收到的帧
+        self.stream = self.container.add_stream(self.settings["codec"], rate=30,
+                                                options=self.settings["options"])
+        self.stream.width = frame.width // 2 * 2
+        self.stream.height = frame.height // 2 * 2
+        self.stream.pix_fmt = "yuv420p"
+        self.stream.codec_context.time_base = TIME_BASE
+        self.first_pts = frame.pts or 0
+        self.last_pts = -1
+        self.segment = {"file": name, "start": self.index["duration"], "duration": 0.0, "frames": 0,
+                        "bytes": 0, "width": self.stream.width, "height": self.stream.height}
+        if self.discontinuity:
+            # 与上一段之间有中断，start 只累计已录下的时长
+            self.segment["discontinuity"] = True
+            self.discontinuity = False
+
+    def _finish_segment(self):
+        if self.container is None:
+            return
+        for packet in self.stream.encode(None):
+            self.container.mux(packet)
+        self.container.close()
+        segment = self.segment
+        # 最后一帧按平均帧间隔计入时长
+        frame_interval = self.last_pts / max(1, segment["frames"] - 1) if segment["frames"] > 1 else 0
+        segment["duration"] = round((self.last_pts + frame_interval) / 1000, 3)
+        segment["bytes"] = os.path.getsize(os.path.join(self.directory, segment["file"]))
+        self.index["segments"].append(segment)
+        self.index["duration"] = round(self.index["duration"] + segment["duration"], 3)
+        self.container = self.stream = self.segment = None
+        self._write_index()
+
+    def _write_index(self):
+        # 先写临时文件再替换，读取方不会看到写了一半的索引
+        path = os.path.join(self.directory, "index.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.index, f, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+class Recording:
+    """一路投屏画面的录制：接收帧放入有上限的队列，由编码任务在线程中写入"""
+
+    def __init__(self, room: str, writer: SegmentWriter):
+        self.room = room
+        self.writer = writer
+        self.pc = None
+        # 投屏端连接的代次，区分先于 offer 到达的新连接候选和旧连接迟到的候选
+        self.generation = 0
+        self.frames: deque = deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.closing = False
+        self.reader: asyncio.Task | None = None
+        self.encoder = asyncio.create_task(self._encode())
+
+    def start(self, track):
+        if self.reader is not None:
+            self.reader.cancel()
+        self.reader = asyncio.create_task(self._read(track))
+
+    async def _read(self, track):
+        try:
+            while True:
+                frame = await track.recv()
+                if len(self.frames) >= PENDING_FRAMES_MAX:
+                    self.frames.popleft()
+                    self.dropped += 1
+                self.frames.append(frame)
+                self.ready.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 轨道结束
+            pass
+
+    async def _encode(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.frames:
+                    await asyncio.to_thread(self.writer.write, self.frames.popleft())
+                if self.closing:
+                    break
+        except Exception as e:
+            logger.warning("录制 %s 编码失败: %s", self.writer.name, e)
+        try:
+            await asyncio.to_thread(self.writer.close)
+        except Exception as e:
+            logger.warning("录制 %s 关闭失败: %s", self.writer.name, e)
+
+    async def close(self):
+        """停止接收，写完队列中剩余的帧后关闭文件"""
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.pc is not None:
+            await self.pc.close()
+        # 正在线程中编码的帧无法中途取消，等编码任务自己写完退出
+        self.closing = True
+        self.ready.set()
+        await self.encoder
+        logger.info("录制结束: %s（%d 帧，%.1f 秒，丢弃 %d 帧）", self.writer.name,
+                    self.writer.frames, self.writer.duration, self.dropped)
+
+
+class Recorder:
+    """以无头观看者身份接收投屏画面，new_writer 决定写到哪里"""
+
+    # 在信令中的客户端ID
+    peer_id = RECORDER_PEER_ID
+
+    def __init__(self, send, directory: str, rooms=None, segment_seconds: float = 10.0,
+                 format: str = "mp4", ice_servers=None):
+        """send(client_id, message) 发给单个客户端；rooms 为空时录制所有房间"""
+        if RTCPeerConnection is None:
+            raise RuntimeError("录制需要安装 aiortc")
+        if format not in FORMATS:
+            raise ValueError(f"不支持的录制格式: {format}")
+        self.send = send
+        self.directory = directory
+        self.rooms = set(rooms or [])
+        self.segment_seconds = segment_seconds
+        self.format = format
+        self.ice_servers = ice_servers or []
+        # 投屏端客户端ID -> 录制
+        self.recordings: dict[int, Recording] = {}
+        self.locks: dict[int, asyncio.Lock] = {}
+        # 已向其请求观看的投屏端，只接受它们发来的 offer
+        self.requested: set[int] = set()
+        # 连接或远端描述尚未就绪时收到的 (代次, 候选)，None 表示候选结束
+        self.pending_candidates: dict[int, list] = {}
+
+    def wants(self, room: str) -> bool:
+        return not self.rooms or room in self.rooms
+
+    def start(self, room: str, client_id: int):
+        """投屏端开始分享时，以观看者身份向它请求一路流"""
+        if not self.wants(room) or client_id in self.recordings:
+            return
+        self.requested.add(client_id)
+        codecs = sorted({codec.mimeType for codec in RTCRtpReceiver.getCapabilities("video").codecs})
+        self.send(client_id, {"type": "request-watching", "from": self.peer_id, "data": {"codecs": codecs}})
+
+    def record_track(self, room: str, client_id: int, track):
+        """直接录制服务器已经收到的轨道（SFU 模式）"""
+        if not self.wants(room):
+            return
+        lock = self.locks.setdefault(client_id, asyncio.Lock())
+        asyncio.create_task(self._record_track(lock, room, client_id, track))
+
+    def handle(self, room: str, client_id: int, message: dict):
+        """处理投屏端发给录制端的信令，同一投屏端的消息按到达顺序串行处理"""
+        lock = self.locks.setdefault(client_id, asyncio.Lock())
+        asyncio.create_task(self._handle(lock, room, client_id, message))
+
+    def stop(self, client_id: int):
+        """投屏端停止分享或断开时结束录制"""
+        self.requested.discard(client_id)
+        self.pending_candidates.pop(client_id, None)
+        lock = self.locks.pop(client_id, None)
+        if lock is not None:
+            asyncio.create_task(self._stop(lock, client_id))
+
+    async def close(self):
+        """服务器退出前写完所有录制"""
+        await asyncio.gather(*(recording.close() for recording in self.recordings.values()))
+        self.recordings.clear()
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self.recordings),
+            "frames": sum(recording.writer.frames for recording in self.recordings.values()),
+            "dropped": sum(recording.dropped for recording in self.recordings.values()),
+        }
+
+    def new_writer(self, room: str, client_id: int, previous: SegmentWriter | None = None):
+        """previous 为同一投屏端上一次连接的写入器，重新连接时接着写入"""
+        if previous is not None:
+            previous.resume()
+            return previous
+        directory = os.path.join(self.directory, safe_name(room),
+                                 f"{time.strftime('%Y%m%d-%H%M%S')}-{client_id}")
+        return SegmentWriter(directory, self.segment_seconds, self.format, {"room": room, "sharer": client_id})
+
+    def _new_recording(self, room: str, client_id: int, previous: Recording | None = None) -> Recording:
+        writer = self.new_writer(room, client_id, previous.writer if previous is not None else None)
+        recording = self.recordings[client_id] = Recording(room, writer)
+        logger.info("%s录制房间 %s 的投屏端 %s: %s", "继续" if previous is not None else "开始",
+                    room, client_id, recording.writer.name)
+        return recording
+
+    async def _record_track(self, lock: asyncio.Lock, room: str, client_id: int, track):
+        async with lock:
+            old = self.recordings.pop(client_id, None)
+            if old is not None:
+                await old.close()
+            self._new_recording(room, client_id, old).start(track)
+
+    async def _handle(self, lock: asyncio.Lock, room: str, client_id: int, message: dict):
+        async with lock:
+            msg_type = message.get('type')
+            data = message.get('data')
+            try:
+                if msg_type == 'offer' and client_id in self.requested:
+                    generation = message.get('generation')
+                    await self._answer(room, client_id, data, generation if isinstance(generation, int) else 0)
+                elif msg_type == 'ice-candidates':
+                    await self._add_candidates(client_id, data or {})
+            except Exception as e:
+                logger.warning("录制端处理 %s 失败: %s", msg_type, e)
+
+    async def _add_candidates(self, client_id: int, data: dict):
+        """处理一批候选，所属连接的远端描述尚未设置时先缓存，旧连接的候选丢弃"""
+        candidates = [candidate for candidate in data.get('candidates') or [] if candidate.get('candidate')]
+        if data.get('done'):
+            candidates.append(None)
+        generation = data.get('generation')
+        generation = generation if isinstance(generation, int) else 0
+        recording = self.recordings.get(client_id)
+        pc = recording.pc if recording is not None else None
+        current = recording.generation if pc is not None else -1
+        if generation < current:
+            return
+        if generation > current or pc.remoteDescription is None:
+            pending = self.pending_candidates.setdefault(client_id, [])
+            pending.extend((generation, candidate) for candidate in candidates)
+            del pending[:-PENDING_CANDIDATES_MAX]
+            return
+        for candidate in candidates:
+            await add_ice_candidate(pc, candidate)
+
+    async def _answer(self, room: str, client_id: int, offer: dict, generation: int = 0):
+        """接收投屏端的 offer，收到视频轨道后开始写入"""
+        old = self.recordings.pop(client_id, None)
+        if old is not None:
+            await old.close()
+        recording = self._new_recording(room, client_id, old)
+        pc = recording.pc = RTCPeerConnection(RTCConfiguration(iceServers=self.ice_servers))
+        recording.generation = generation
+
+        @pc.on("track")
+        def on_track(track):
+            if track.kind == "video":
+                recording.start(track)
+
+        @pc.on("connectionstatechange")
+        async def on_state():
+            if pc.connectionState == "failed" and self.recordings.get(client_id) is recording:
+                # 投屏端会重新发来 offer，保留录制接着写入，停止分享或离开时才结束
+                await pc.close()
+
+        await pc.setRemoteDescription(RTCSessionDescription(offer['sdp'], offer['type']))
+        pending = self.pending_candidates.pop(client_id, [])
+        for candidate_generation, candidate in pending:
+            if candidate_generation == generation:
+                await add_ice_candidate(pc, candidate)
+        await pc.setLocalDescription(await pc.createAnswer())
+        self.send(client_id, {
+            "type": "answer",
+            "from": self.peer_id,
+            "data": {"type": "answer", "sdp": pc.localDescription.sdp},
+        })
+
+    async def _stop(self, lock: asyncio.Lock, client_id: int) -> Recording | None:
+        async with lock:
+            recording = self.recordings.pop(client_id, None)
+            if recording is not None:
+                await recording.close()
+            return recording
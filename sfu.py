@@ -0,0 +1,286 @@
+"""SFU 转发模式：投屏端只向服务器推一路流，由服务器转发给房间内所有观看者
+
+需要安装 aiortc。aiortc 的接收端会把 RTP 解码成帧，MediaRelay 将同一路解码结果
+分发给所有订阅者，再由每个观看者的发送端编码，投屏端的上行和编码负载与人数无关。
+aiortc 不支持接收 simulcast，观看者请求的画面层级由 SFU 在编码前按比例缩小得到。
+"""
+import asyncio
+import logging
+
+try:
+    from aiortc import (MediaStreamTrack, RTCConfiguration, RTCPeerConnection, RTCRtpReceiver,
+                        RTCRtpSender, RTCSessionDescription)
+    from aiortc.contrib.media import MediaRelay
+    from aiortc.sdp import candidate_from_sdp
+except ImportError:
+    MediaStreamTrack = object
+    RTCPeerConnection = None
+
+logger = logging.getLogger(__name__)
+
+# SFU 在信令中作为一个虚拟客户端出现，客户端用 targetId=0 与它交换 offer/answer/ICE
+SFU_PEER_ID = 0
+
+# 连接建立前每个客户端最多缓存的 ICE 候选数
+PENDING_CANDIDATES_MAX = 64
+
+
+async def add_ice_candidate(pc, data: dict | None):
+    """把页面发来的一个候选加入 aiortc 连接，None 表示对端候选已全部发送"""
+    if data is None:
+        await pc.addIceCandidate(None)
+        return
+    candidate = candidate_from_sdp(data['candidate'].split(':', 1)[1])
+    candidate.sdpMid = data.get('sdpMid')
+    candidate.sdpMLineIndex = data.get('sdpMLineIndex')
+    await pc.addIceCandidate(candidate)
+
+
+class ScaledVideoTrack(MediaStreamTrack):
+    """按观看者选择的层级缩小转发画面"""
+
+    kind = "video"
+
+    def __init__(self, source, scale: int = 1):
+        super().__init__()
+        self.source = source
+        self.scale = scale
+
+    async def recv(self):
+        frame = await self.source.recv()
+        if self.scale == 1:
+            return frame
+        # 编码器要求宽高为偶数
+        scaled = frame.reformat(width=frame.width // self.scale // 2 * 2,
+                                height=frame.height // self.scale // 2 * 2)
+        scaled.pts = frame.pts
+        scaled.time_base = frame.time_base
+        return scaled
+
+    def stop(self):
+        super().stop()
+        self.source.stop()
+
+
+class SFURoom:
+    """一个房间的推流连接和所有订阅连接"""
+
+    def __init__(self):
+        self.publisher_id: int | None = None
+        self.publisher = None
+        self.tracks = []
+        self.relay = MediaRelay()
+        self.subscribers: dict = {}
+        self.scaled_tracks: dict[int, ScaledVideoTrack] = {}
+
+
+class SFU:
+    def __init__(self, send, broadcast, ice_servers=None, layers=None, codecs=None):
+        """send(client_id, message) 发给单个客户端，broadcast(room, message, sender_id) 发给房间"""
+        if RTCPeerConnection is None:
+            raise RuntimeError("SFU 模式需要安装 aiortc")
+        self.send = send
+        self.broadcast = broadcast
+        self.ice_servers = ice_servers or []
+        self.layers = layers or {"full": 1}
+        self.codecs = [f"video/{codec}".lower() for codec in codecs or []]
+        self.rooms: dict[str, SFURoom] = {}
+        self.client_rooms: dict[int, str] = {}
+        self.locks: dict[int, asyncio.Lock] = {}
+        # 连接或远端描述尚未就绪时收到的候选，None 表示候选结束
+        self.pending_candidates: dict[int, list] = {}
+        # 收到推流的视频轨道时逐个调用 listener(room, client_id, track)，供录制和 HLS 使用
+        self.publish_listeners = []
+
+    def is_published(self, room: str) -> bool:
+        return room in self.rooms and self.rooms[room].publisher is not None
+
+    def handle(self, room: str, client_id: int, message: dict):
+        """处理发给 SFU 的信令，同一客户端的消息按到达顺序串行处理"""
+        lock = self.locks.setdefault(client_id, asyncio.Lock())
+        asyncio.create_task(self._handle(lock, room, client_id, message))
+
+    def request_publish(self, room: str, client_id: int):
+        """投屏端开始分享时，以观看者身份向它请求一路流"""
+        codecs = sorted({codec.mimeType for codec in RTCRtpReceiver.getCapabilities("video").codecs})
+        self.send(client_id, {"type": "request-watching", "from": SFU_PEER_ID, "data": {"codecs": codecs}})
+
+    def close(self, client_id: int, disconnected: bool = False):
+        """客户端停止分享或断开时释放对应的连接"""
+        lock = self.locks.setdefault(client_id, asyncio.Lock())
+        if disconnected:
+            # 断开后不会再有该客户端的消息，排在队尾的关闭任务之后不再需要锁
+            del self.locks[client_id]
+        asyncio.create_task(self._close(lock, client_id))
+
+    async def _handle(self, lock: asyncio.Lock, room: str, client_id: int, message: dict):
+        async with lock:
+            msg_type = message.get('type')
+            data = message.get('data')
+            try:
+                if msg_type == 'offer':
+                    await self._publish(room, client_id, data)
+                elif msg_type == 'request-watching':
+                    await self._subscribe(room, client_id, (data or {}).get('codecs'))
+                elif msg_type == 'answer':
+                    pc = self._connection(client_id)
+                    if pc is not None:
+                        await pc.setRemoteDescription(RTCSessionDescription(data['sdp'], data['type']))
+                        await self._add_pending_candidates(client_id, pc)
+                elif msg_type == 'ice-candidates':
+                    await self._add_candidates(client_id, data or {})
+                elif msg_type == 'request-layer':
+                    self._set_layer(client_id, data)
+            except Exception as e:
+                logger.warning("SFU 处理 %s 失败: %s", msg_type, e)
+
+    def _connection(self, client_id: int):
+        sfu_room = self.rooms.get(self.client_rooms.get(client_id))
+        if sfu_room is None:
+            return None
+        if sfu_room.publisher_id == client_id:
+            return sfu_room.publisher
+        return sfu_room.subscribers.get(client_id)
+
+    def _new_connection(self):
+        return RTCPeerConnection(RTCConfiguration(iceServers=self.ice_servers))
+
+    async def _publish(self, room: str, client_id: int, offer: dict):
+        """接收投屏端的推流 offer"""
+        # 新的推流替换房间内原有的推流，旧的订阅连接一并关闭
+        await self._close_room(room)
+        sfu_room = self.rooms[room] = SFURoom()
+        # 候选总在 offer/answer 之后发出，之前缓存的属于旧连接
+        self.pending_candidates.pop(client_id, None)
+
+        pc = self._new_connection()
+        sfu_room.publisher_id = client_id
+        sfu_room.publisher = pc
+        self.client_rooms[client_id] = room
+
+        @pc.on("track")
+        def on_track(track):
+            sfu_room.tracks.append(track)
+            if track.kind == "video":
+                for listener in self.publish_listeners:
+                    listener(room, client_id, sfu_room.relay.subscribe(track, buffered=False))
+
+        @pc.on("connectionstatechange")
+        async def on_state():
+            if pc.connectionState == "failed" and sfu_room.publisher is pc:
+                await self._close_room(room)
+
+        await pc.setRemoteDescription(RTCSessionDescription(offer['sdp'], offer['type']))
+        await self._add_pending_candidates(client_id, pc)
+        await pc.setLocalDescription(await pc.createAnswer())
+        self.send(client_id, {
+            "type": "answer",
+            "from": SFU_PEER_ID,
+            "data": {"type": "answer", "sdp": pc.localDescription.sdp},
+        })
+        # 通知房间内的观看者向 SFU 请求观看
+        self.broadcast(room, {"type": "start-sharing", "from": SFU_PEER_ID}, client_id)
+
+    async def _subscribe(self, room: str, client_id: int, viewer_codecs: list | None = None):
+        """为观看者建立一路订阅连接，由 SFU 发起 offer"""
+        sfu_room = self.rooms.get(room)
+        if sfu_room is None or sfu_room.publisher is None or client_id == sfu_room.publisher_id:
+            return
+        old = sfu_room.subscribers.pop(client_id, None)
+        if old is not None:
+            await old.close()
+        self.pending_candidates.pop(client_id, None)
+
+        pc = self._new_connection()
+        sfu_room.subscribers[client_id] = pc
+        self.client_rooms[client_id] = room
+        for track in sfu_room.tracks:
+            relayed = sfu_room.relay.subscribe(track, buffered=False)
+            if track.kind == "video":
+                relayed = sfu_room.scaled_tracks[client_id] = ScaledVideoTrack(relayed)
+            pc.addTrack(relayed)
+        for transceiver in pc.getTransceivers():
+            if transceiver.kind == "video":
+                transceiver.setCodecPreferences(self._codec_preferences(viewer_codecs))
+
+        @pc.on("connectionstatechange")
+        async def on_state():
+            if pc.connectionState == "failed" and sfu_room.subscribers.get(client_id) is pc:
+                del sfu_room.subscribers[client_id]
+                sfu_room.scaled_tracks.pop(client_id, None)
+                await pc.close()
+
+        await pc.setLocalDescription(await pc.createOffer())
+        self.send(client_id, {
+            "type": "offer",
+            "from": SFU_PEER_ID,
+            "data": {"type": "offer", "sdp": pc.localDescription.sdp},
+        })
+
+    def _codec_preferences(self, viewer_codecs: list | None) -> list:
+        """按配置的优先级排序可发送的编码，去掉观看者无法解码的格式"""
+        decodable = {mime.lower() for mime in viewer_codecs} if viewer_codecs else None
+        codecs = [codec for codec in RTCRtpSender.getCapabilities("video").codecs
+                  if codec.mimeType.lower() == "video/rtx" or decodable is None
+                  or codec.mimeType.lower() in decodable]
+
+        def rank(codec):
+            mime = codec.mimeType.lower()
+            if mime == "video/rtx":
+                return len(self.codecs) + 1
+            return self.codecs.index(mime) if mime in self.codecs else len(self.codecs)
+
+        return sorted(codecs, key=rank)
+
+    def _set_layer(self, client_id: int, layer: str):
+        """切换观看者的画面层级"""
+        sfu_room = self.rooms.get(self.client_rooms.get(client_id))
+        if sfu_room is not None and client_id in sfu_room.scaled_tracks:
+            sfu_room.scaled_tracks[client_id].scale = self.layers.get(layer, 1)
+
+    async def _add_candidates(self, client_id: int, data: dict):
+        """处理一批候选，连接尚未就绪时先缓存，不丢弃先于 offer/answer 处理完成到达的候选"""
+        candidates = [candidate for candidate in data.get('candidates') or [] if candidate.get('candidate')]
+        if data.get('done'):
+            candidates.append(None)
+        pc = self._connection(client_id)
+        if pc is None or pc.remoteDescription is None:
+            pending = self.pending_candidates.setdefault(client_id, [])
+            pending.extend(candidates)
+            del pending[:-PENDING_CANDIDATES_MAX]
+            return
+        for candidate in candidates:
+            await self._add_candidate(pc, candidate)
+
+    async def _add_pending_candidates(self, client_id: int, pc):
+        for candidate in self.pending_candidates.pop(client_id, []):
+            await self._add_candidate(pc, candidate)
+
+    async def _add_candidate(self, pc, data: dict | None):
+        await add_ice_candidate(pc, data)
+
+    async def _close(self, lock: asyncio.Lock, client_id: int):
+        async with lock:
+            self.pending_candidates.pop(client_id, None)
+            room = self.client_rooms.pop(client_id, None)
+            sfu_room = self.rooms.get(room)
+            if sfu_room is not None:
+                if sfu_room.publisher_id == client_id:
+                    await self._close_room(room)
+                else:
+                    sfu_room.scaled_tracks.pop(client_id, None)
+                    pc = sfu_room.subscribers.pop(client_id, None)
+                    if pc is not None:
+                        await pc.close()
+
+    async def _close_room(self, room: str):
+        """推流端离开，关闭房间内所有订阅连接"""
+        sfu_room = self.rooms.pop(room, None)
+        if sfu_room is None:
+            return
+        self.broadcast(room, {"type": "stop-sharing", "from": SFU_PEER_ID}, sfu_room.publisher_id)
+        self.client_rooms.pop(sfu_room.publisher_id, None)
+        connections = [sfu_room.publisher, *sfu_room.subscribers.values()]
+        for client_id in sfu_room.subscribers:
+            self.client_rooms.pop(client_id, None)
+        await asyncio.gather(*(pc.close() for pc in connections if pc is not None))
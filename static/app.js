@@ -0,0 +1,995 @@
+let localStream = null;
+let peerConnection = null;  // 观看端与投屏端的连接
+const peerConnections = new Map();  // 投屏端为每个观看者维护的连接，按观看者ID索引
+let serverConfig = { presets: {}, preset: null, layers: { full: 1 } };
+let currentLayer = 'full';  // 观看端当前请求的画面层级
+let hardwareCodecs = new Set();  // 投屏端可硬件编码的 mimeType
+// 不参与排序的辅助编码
+const AUXILIARY_CODECS = new Set(['video/rtx', 'video/red', 'video/ulpfec', 'video/flexfec-03']);
+let currentPreset = null;
+let adaptTimer = null;
+let statsTimer = null;  // 定期向服务器上报 getStats 采样
+let contentTimer = null;  // 内容自适应预设下定期检查画面是否静止
+let contentStatic = false;  // 画面静止，已降低采集和编码帧率
+let staticSamples = 0;
+let contentChecking = false;
+
+// 码率自适应阈值：丢包率/往返时延超过 DOWN 时降一级，连续 UP_SAMPLES 次良好时升一级
+const ADAPT_INTERVAL = 2000;
+const LOSS_DOWN = 0.05, RTT_DOWN = 0.3;
+const LOSS_UP = 0.01, RTT_UP = 0.15, UP_SAMPLES = 3;
+// 屏幕采集参数，降帧和恢复时在此基础上修改帧率
+const CAPTURE_CONSTRAINTS = {
+    width: { ideal: 1920 },
+    height: { ideal: 1080 },
+    frameRate: { ideal: 30 }
+};
+// 内容自适应：平均每帧编码字节数连续 STATIC_SAMPLES 次低于 STATIC_FRAME_BYTES 视为画面静止，
+// 任意一次超过即恢复。静止时编码器只输出很小的跳过帧，字节数比画面本身的差异更可靠
+const CONTENT_CHECK_INTERVAL = 250;
+const STATIC_FRAME_BYTES = 1500, STATIC_SAMPLES = 8;
+let websocket = null;
+let isSharing = false;
+let myClientId = null;
+let remotePeerId = null;  // 观看端对应的投屏端ID
+const textDecoder = new TextDecoder();
+// 房间名来自页面地址 /?room=xxx
+const roomName = new URLSearchParams(location.search).get('room') || 'default';
+// 页面地址中的 latency=interactive|smooth 覆盖房间的时延档位
+const latencyParam = new URLSearchParams(location.search).get('latency');
+let appliedLatencyProfile = null;  // 观看端接收器实际使用的时延档位，随统计上报
+
+// WebRTC 配置，收到服务端下发的配置后替换
+let rtcConfig = {
+    iceServers: [
+        { urls: `stun:${location.hostname}:3478` }  // 使用本机STUN服务器
+    ]
+};
+let watchRequestedAt = null;  // 请求观看的时间，用于统计首帧耗时
+// 服务端分配的会话令牌，断线重连时带上，保留期内可取回原客户端ID和投屏/观看角色
+let sessionToken = null;
+let reconnectAttempts = 0;
+// 断线后第几次重连前等待的时间（毫秒），第一次很快，以便在服务端保留期内恢复会话
+const RECONNECT_DELAYS = [250, 1000, 3000];
+// 媒体连接断开后等待多久发起 ICE 重启，以及连续重启的上限，超过后关闭连接
+const ICE_RESTART_DELAY = 2000, ICE_RESTART_MAX = 3;
+// 本端 ICE 候选在这段时间（毫秒）内合并为一条消息发送
+const ICE_BATCH_WINDOW = 30;
+// 远端描述设置之前收到的 ICE 候选，按发送者ID和连接代次缓存，null 表示候选结束
+const pendingCandidates = new Map();
+const PENDING_CANDIDATES_MAX = 64;
+// 投屏端每新建一个连接加一，随 offer 和双方的候选发送。候选可能先于 offer 到达，
+// 观看端据此区分它属于新连接还是旧连接
+let connectionGeneration = 0;
+
+// 初始化
+window.onload = function() {
+    document.getElementById('roomName').textContent = roomName;
+    const remoteVideo = document.getElementById('remoteVideo');
+    remoteVideo.addEventListener('loadedmetadata', selectLayer);
+    remoteVideo.addEventListener('playing', reportFirstFrame);
+    window.addEventListener('resize', selectLayer);
+    document.addEventListener('fullscreenchange', selectLayer);
+    connectWebSocket();
+};
+
+// WebSocket 连接
+function connectWebSocket() {
+    const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+    let url = `${protocol}//${location.host}/ws?room=${encodeURIComponent(roomName)}`;
+    if (latencyParam) url += `&latency=${encodeURIComponent(latencyParam)}`;
+    if (sessionToken) url += `&session=${encodeURIComponent(sessionToken)}`;
+    const ws = websocket = new WebSocket(url);
+    websocket.binaryType = 'arraybuffer';  // 服务端以二进制帧发送预编码的JSON
+
+    websocket.onopen = () => {
+        reconnectAttempts = 0;
+        updateStatus('已连接', true);
+    };
+
+    websocket.onmessage = async (event) => {
+        try {
+            const text = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data);
+            const message = JSON.parse(text);
+            await handleMessage(message);
+        } catch (error) {
+            console.error('处理消息错误:', error);
+        }
+    };
+
+    websocket.onclose = () => {
+        // 已被新连接取代的旧连接
+        if (websocket !== ws) return;
+        updateStatus('连接断开', false);
+        const delay = RECONNECT_DELAYS[Math.min(reconnectAttempts, RECONNECT_DELAYS.length - 1)];
+        reconnectAttempts++;
+        setTimeout(connectWebSocket, delay);
+    };
+
+    websocket.onerror = (error) => {
+        console.error('WebSocket 错误:', error);
+    };
+}
+
+// 处理消息
+async function handleMessage(message) {
+    const { type, data, from } = message;
+
+    // 忽略自己发送的消息
+    if (from === myClientId) return;
+
+    switch (type) {
+        case 'client-id':
+            myClientId = data;
+            break;
+        case 'session':
+            handleSession(data);
+            break;
+        case 'server-config':
+            applyServerConfig(data);
+            break;
+        case 'start-sharing':
+            if (!isSharing) {
+                setTimeout(() => {
+                    if (!isSharing) {
+                        requestWatching(from);
+                    }
+                }, 500);
+            }
+            break;
+        case 'request-watching':
+            if (isSharing) {
+                await sendOfferTo(from, data && data.codecs);
+            }
+            break;
+        case 'offer':
+            await handleOffer(data, from, message.restart, message.generation);
+            break;
+        case 'answer':
+            await handleAnswer(data, from);
+            break;
+        case 'ice-candidates':
+            await handleIceCandidates(data, from);
+            break;
+        case 'ice-restart':
+            if (isSharing && peerConnections.has(from)) {
+                await restartIce(from, peerConnections.get(from));
+            }
+            break;
+        case 'request-layer':
+            if (isSharing) {
+                handleLayerRequest(data, from);
+            }
+            break;
+        case 'user-count':
+            document.getElementById('userCount').textContent = data;
+            break;
+        case 'stop-sharing':
+            handleStopSharing(from);
+            break;
+        case 'ping':
+            sendMessage({ type: 'pong' });
+            break;
+    }
+}
+
+// 切换分享状态
+async function toggleShare() {
+    if (isSharing) {
+        stopSharing();
+    } else {
+        await startSharing();
+    }
+}
+
+// 开始分享
+async function startSharing() {
+    try {
+        // 获取屏幕流
+        localStream = await navigator.mediaDevices.getDisplayMedia({
+            video: { mediaSource: 'screen', ...CAPTURE_CONSTRAINTS },
+            audio: true
+        });
+        applyContentHint();
+
+        // 显示本地视频
+        const localVideo = document.getElementById('localVideo');
+        localVideo.srcObject = localStream;
+        localVideo.style.display = 'block';
+        document.getElementById('localPlaceholder').style.display = 'none';
+
+        // 监听流结束
+        localStream.getVideoTracks()[0].onended = () => {
+            stopSharing();
+        };
+
+        hardwareCodecs = await detectHardwareCodecs(localStream.getVideoTracks()[0]);
+
+        // 通知开始分享
+        sendMessage({ type: 'start-sharing' });
+        adaptTimer = setInterval(adaptSenders, ADAPT_INTERVAL);
+        contentTimer = setInterval(checkContent, CONTENT_CHECK_INTERVAL);
+
+        isSharing = true;
+        document.getElementById('shareBtn').textContent = '停止投屏';
+        document.getElementById('shareBtn').className = 'stop-btn';
+
+    } catch (error) {
+        alert('投屏失败，请确保选择了要分享的屏幕或窗口');
+    }
+}
+
+// 停止分享
+function stopSharing() {
+    if (localStream) {
+        localStream.getTracks().forEach(track => track.stop());
+        localStream = null;
+    }
+
+    peerConnections.forEach(pc => pc.close());
+    peerConnections.clear();
+    clearInterval(adaptTimer);
+    adaptTimer = null;
+    clearInterval(contentTimer);
+    contentTimer = null;
+    contentStatic = false;
+    staticSamples = 0;
+
+    // 重置UI
+    document.getElementById('localVideo').style.display = 'none';
+    document.getElementById('localPlaceholder').style.display = 'flex';
+    document.getElementById('shareBtn').textContent = '开始投屏';
+    document.getElementById('shareBtn').className = '';
+
+    // 通知停止分享
+    sendMessage({ type: 'stop-sharing' });
+
+    isSharing = false;
+}
+
+// 请求观看分享
+function requestWatching(sharerId) {
+    watchRequestedAt = performance.now();
+    sendMessage({
+        type: 'request-watching',
+        targetId: sharerId,
+        data: { codecs: receiverCodecs() }
+    });
+}
+
+// 本机可解码的视频编码 mimeType
+function receiverCodecs() {
+    if (!window.RTCRtpReceiver || !RTCRtpReceiver.getCapabilities) return null;
+    const caps = RTCRtpReceiver.getCapabilities('video');
+    return caps ? [...new Set(caps.codecs.map(codec => codec.mimeType))] : null;
+}
+
+// 通过 mediaCapabilities 找出可硬件编码的编码格式
+async function detectHardwareCodecs(track) {
+    const result = new Set();
+    if (!navigator.mediaCapabilities || !navigator.mediaCapabilities.encodingInfo) return result;
+
+    const settings = track.getSettings();
+    for (const codec of serverConfig.codecs) {
+        const contentType = `video/${codec}`;
+        try {
+            const info = await navigator.mediaCapabilities.encodingInfo({
+                type: 'webrtc',
+                video: {
+                    contentType,
+                    width: settings.width || 1920,
+                    height: settings.height || 1080,
+                    bitrate: 2500000,
+                    framerate: settings.frameRate || 30
+                }
+            });
+            if (info.supported && info.powerEfficient) {
+                result.add(contentType.toLowerCase());
+            }
+        } catch (error) {
+            // 不支持 webrtc 类型查询的浏览器忽略
+        }
+    }
+    return result;
+}
+
+// 按服务端优先级排序编码，去掉观看者无法解码的格式
+function applyCodecPreferences(pc, viewerCodecs) {
+    const transceiver = pc.getTransceivers().find(t => t.sender.track && t.sender.track.kind === 'video');
+    if (!transceiver || !transceiver.setCodecPreferences || !RTCRtpReceiver.getCapabilities) return;
+
+    const caps = RTCRtpReceiver.getCapabilities('video');
+    if (!caps) return;
+    const decodable = viewerCodecs ? new Set(viewerCodecs.map(mime => mime.toLowerCase())) : null;
+    const priority = serverConfig.codecs.map(codec => `video/${codec}`.toLowerCase());
+    const rank = (codec) => {
+        const mime = codec.mimeType.toLowerCase();
+        if (AUXILIARY_CODECS.has(mime)) return 2 * priority.length + 1;
+        const index = priority.indexOf(mime);
+        const base = index === -1 ? priority.length : index;
+        return serverConfig.preferHardware && hardwareCodecs.has(mime) ? base - priority.length : base;
+    };
+
+    const codecs = caps.codecs
+        .filter(codec => {
+            const mime = codec.mimeType.toLowerCase();
+            return AUXILIARY_CODECS.has(mime) || !decodable || decodable.has(mime);
+        })
+        .sort((a, b) => rank(a) - rank(b));
+    try {
+        transceiver.setCodecPreferences(codecs);
+    } catch (error) {
+        console.error('设置编码优先级失败:', error);
+    }
+}
+
+// 发送offer给指定观看者
+// iceRestarts 为替换的旧连接已重试的次数，服务端观看者重连时沿用
+async function sendOfferTo(viewerId, viewerCodecs, iceRestarts = 0) {
+    if (!isSharing || !localStream) return;
+
+    try {
+        // 只替换该观看者自己的连接，不影响其他观看者
+        closeViewerConnection(viewerId);
+
+        const pc = new RTCPeerConnection(rtcConfig);
+        pc.generation = ++connectionGeneration;
+        pc.viewerCodecs = viewerCodecs;
+        pc.iceRestarts = iceRestarts;
+        peerConnections.set(viewerId, pc);
+
+        // 添加本地流
+        localStream.getTracks().forEach(track => {
+            pc.addTrack(track, localStream);
+        });
+        applyCodecPreferences(pc, viewerCodecs);
+
+        pc.onconnectionstatechange = () => handleViewerConnectionState(viewerId, pc);
+
+        // ICE 候选处理
+        pc.onicecandidate = (event) => queueLocalCandidate(pc, viewerId, event.candidate);
+
+        // 创建并发送 offer
+        const offer = await pc.createOffer({
+            offerToReceiveVideo: false,
+            offerToReceiveAudio: false
+        });
+        await pc.setLocalDescription(offer);
+        // 先发 offer，候选在此之后才可能发出
+        sendMessage({
+            type: 'offer',
+            targetId: viewerId,
+            data: offer,
+            generation: pc.generation
+        });
+        await applyEncoding(pc);
+    } catch (error) {
+        console.error('发送offer失败:', error);
+    }
+}
+
+// 投屏端的观看者连接断开时先尝试 ICE 重启，多次失败后才关闭
+function handleViewerConnectionState(viewerId, pc) {
+    if (peerConnections.get(viewerId) !== pc) return;
+    if (pc.connectionState === 'connected') {
+        pc.iceRestarts = 0;
+    } else if (pc.connectionState === 'disconnected') {
+        // 短暂断开常能自行恢复，仍未恢复再重启
+        setTimeout(() => {
+            if (pc.connectionState === 'disconnected') restartIce(viewerId, pc);
+        }, ICE_RESTART_DELAY);
+    } else if (pc.connectionState === 'failed') {
+        if ((pc.iceRestarts || 0) < ICE_RESTART_MAX) {
+            restartIce(viewerId, pc);
+        } else {
+            closeViewerConnection(viewerId);
+        }
+    }
+}
+
+// 在已有连接上做 ICE 重启：保留 DTLS 会话和编码器状态，只重新收集候选、选择网络路径
+async function restartIce(viewerId, pc) {
+    if (peerConnections.get(viewerId) !== pc) return;
+    if (!websocket || websocket.readyState !== WebSocket.OPEN) return;  // 会话恢复后再重启
+
+    const restarts = (pc.iceRestarts || 0) + 1;
+    if (viewerId <= 0) {
+        // SFU、录制等服务端观看者（ID 不大于 0）不支持 ICE 重启，重新发 offer 建立新连接
+        await sendOfferTo(viewerId, pc.viewerCodecs, restarts);
+        return;
+    }
+    if (pc.signalingState !== 'stable') return;
+    pc.iceRestarts = restarts;
+    try {
+        const offer = await pc.createOffer({ iceRestart: true });
+        await pc.setLocalDescription(offer);
+        sendMessage({
+            type: 'offer',
+            targetId: viewerId,
+            data: offer,
+            restart: true,
+            generation: pc.generation
+        });
+    } catch (error) {
+        console.error('ICE 重启失败:', error);
+    }
+}
+
+// 收到会话令牌：恢复的会话修复媒体连接，新会话丢弃上一个会话的状态
+function handleSession(data) {
+    const previous = sessionToken;
+    sessionToken = data.token;
+    if (data.resumed) {
+        recoverConnections();
+    } else if (previous) {
+        resetSession();
+    }
+}
+
+// 会话恢复后只修复没有连通的媒体连接，仍在传输的连接不受影响
+function recoverConnections() {
+    if (isSharing) {
+        peerConnections.forEach((pc, viewerId) => {
+            if (pc.connectionState !== 'connected') restartIce(viewerId, pc);
+        });
+    } else if (peerConnection && remotePeerId !== null && peerConnection.connectionState !== 'connected') {
+        if (remotePeerId > 0) {
+            sendMessage({ type: 'ice-restart', targetId: remotePeerId });
+        } else {
+            requestWatching(remotePeerId);
+        }
+    }
+}
+
+// 会话已过期：房间内其他成员已收到本端离开的通知，原有连接全部作废
+function resetSession() {
+    if (isSharing) {
+        peerConnections.forEach(pc => pc.close());
+        peerConnections.clear();
+        // 重新宣告投屏，观看者会重新请求观看
+        sendMessage({ type: 'start-sharing' });
+    } else if (remotePeerId !== null) {
+        // 服务端随后会告知正在投屏的客户端
+        handleStopSharing(remotePeerId);
+    }
+}
+
+// 应用服务端下发的配置
+function applyServerConfig(config) {
+    serverConfig = config;
+    const select = document.getElementById('presetSelect');
+    select.innerHTML = '';
+    for (const [name, preset] of Object.entries(config.presets)) {
+        select.add(new Option(preset.label, name));
+    }
+    if (!currentPreset || !config.presets[currentPreset]) {
+        currentPreset = config.preset;
+    }
+    select.value = currentPreset;
+    // ICE 服务器由服务端按本机网卡生成，包含本机STUN和TURN中继
+    rtcConfig = config.ice;
+
+    if (peerConnection) {
+        peerConnection.getReceivers().forEach(applyLatencyProfile);
+    }
+
+    clearInterval(statsTimer);
+    statsTimer = config.statsInterval > 0 ? setInterval(reportStats, config.statsInterval * 1000) : null;
+}
+
+// 上报各连接的视频统计：观看端上报接收，投屏端按观看者上报发送
+async function reportStats() {
+    const samples = [];
+    const connections = isSharing ? [...peerConnections] :
+        (peerConnection && remotePeerId !== null ? [[remotePeerId, peerConnection]] : []);
+    for (const [peerId, pc] of connections) {
+        try {
+            const sample = await sampleConnection(pc, isSharing ? 'out' : 'in');
+            if (sample) {
+                sample.peer = peerId;
+                samples.push(sample);
+            }
+        } catch (error) {
+            console.error('读取连接统计失败:', error);
+        }
+    }
+    if (samples.length) {
+        sendMessage({ type: 'stats', data: samples });
+    }
+}
+
+function roundTo(value, digits) {
+    return Number(value.toFixed(digits));
+}
+
+// 与上一次采样做差，得到这段时间内的平均值
+async function sampleConnection(pc, direction) {
+    if (pc.connectionState !== 'connected') return null;
+
+    let rtp = null, rtt = null, remoteLoss = null;
+    const stats = await pc.getStats();
+    stats.forEach(report => {
+        if (report.type === 'candidate-pair' && report.nominated && report.state === 'succeeded') {
+            rtt = report.currentRoundTripTime ?? rtt;
+        } else if (report.type === (direction === 'in' ? 'inbound-rtp' : 'outbound-rtp')
+                   && report.kind === 'video' && !rtp) {
+            rtp = report;
+        } else if (report.type === 'remote-inbound-rtp' && report.kind === 'video') {
+            remoteLoss = report.fractionLost ?? remoteLoss;
+        }
+    });
+    if (!rtp) return null;
+
+    const previous = pc.lastRtpStats;
+    pc.lastRtpStats = rtp;
+    const sample = { dir: direction };
+    if (rtt !== null) sample.rttMs = roundTo(rtt * 1000, 1);
+    if (rtp.framesPerSecond !== undefined) sample.fps = roundTo(rtp.framesPerSecond, 1);
+    if (direction === 'out' && rtp.qualityLimitationReason) sample.limit = rtp.qualityLimitationReason;
+    if (direction === 'out' && remoteLoss !== null) sample.loss = roundTo(remoteLoss, 3);
+
+    const seconds = previous ? (rtp.timestamp - previous.timestamp) / 1000 : 0;
+    if (seconds <= 0) return sample;
+    const delta = key => (rtp[key] ?? 0) - (previous[key] ?? 0);
+
+    if (direction === 'in') {
+        sample.kbps = roundTo(delta('bytesReceived') * 8 / seconds / 1000, 1);
+        const frames = delta('framesDecoded');
+        if (frames > 0) sample.decodeMs = roundTo(delta('totalDecodeTime') / frames * 1000, 2);
+        const emitted = delta('jitterBufferEmittedCount');
+        if (emitted > 0) sample.jitterMs = roundTo(delta('jitterBufferDelay') / emitted * 1000, 1);
+        if (emitted > 0 && rtp.jitterBufferTargetDelay !== undefined) {
+            sample.jitterTargetMs = roundTo(delta('jitterBufferTargetDelay') / emitted * 1000, 1);
+        }
+        if (appliedLatencyProfile) sample.profile = appliedLatencyProfile;
+        const lost = Math.max(0, delta('packetsLost'));
+        const received = delta('packetsReceived');
+        if (lost + received > 0) sample.loss = roundTo(lost / (lost + received), 3);
+        sample.freezes = Math.max(0, delta('freezeCount'));
+    } else {
+        sample.kbps = roundTo(delta('bytesSent') * 8 / seconds / 1000, 1);
+        const frames = delta('framesEncoded');
+        if (frames > 0) sample.encodeMs = roundTo(delta('totalEncodeTime') / frames * 1000, 2);
+    }
+    return sample;
+}
+
+// 切换编码预设，所有观看者从最高档重新开始自适应
+function changePreset(name) {
+    currentPreset = name;
+    applyContentHint();
+    peerConnections.forEach(pc => {
+        pc.adaptLevel = 0;
+    });
+    // 恢复满帧率，新预设需要时重新检测静止
+    setContentStatic(false);
+}
+
+// 按预设设置屏幕视频轨道的内容类型，浏览器据此选择编码器的清晰度/流畅度取舍
+function applyContentHint() {
+    const preset = serverConfig.presets[currentPreset];
+    const track = localStream && localStream.getVideoTracks()[0];
+    if (track && preset && preset.contentHint && 'contentHint' in track) {
+        track.contentHint = preset.contentHint;
+    }
+}
+
+// 内容自适应：画面静止时降低帧率，有变化时立即恢复
+async function checkContent() {
+    const preset = serverConfig.presets[currentPreset];
+    if (!preset || !preset.idleFramerate || contentChecking) return;
+
+    // 各观看者的编码器输入同一画面，取一个已连接的连接采样即可
+    const pc = [...peerConnections.values()].find(pc => pc.connectionState === 'connected');
+    if (!pc) return;
+    contentChecking = true;
+    let rtp = null;
+    try {
+        const stats = await pc.getStats();
+        stats.forEach(report => {
+            if (report.type === 'outbound-rtp' && report.kind === 'video' && !rtp) rtp = report;
+        });
+    } finally {
+        contentChecking = false;
+    }
+    if (!rtp) return;
+
+    const previous = pc.lastContentStats;
+    pc.lastContentStats = rtp;
+    if (!previous || !isSharing) return;
+    const frames = (rtp.framesEncoded ?? 0) - (previous.framesEncoded ?? 0);
+    // 重传的字节与画面内容无关
+    const bytes = (rtp.bytesSent ?? 0) - (previous.bytesSent ?? 0)
+        - ((rtp.retransmittedBytesSent ?? 0) - (previous.retransmittedBytesSent ?? 0));
+    const still = frames === 0 || bytes / frames < STATIC_FRAME_BYTES;
+
+    if (!still) {
+        staticSamples = 0;
+        if (contentStatic) setContentStatic(false);
+    } else if (!contentStatic && ++staticSamples >= STATIC_SAMPLES) {
+        setContentStatic(true);
+    }
+}
+
+// 切换静止状态：同时限制屏幕采集帧率和每个观看者的编码帧率
+function setContentStatic(value) {
+    const changed = contentStatic !== value;
+    contentStatic = value;
+    staticSamples = 0;
+    const preset = serverConfig.presets[currentPreset];
+    const track = localStream && localStream.getVideoTracks()[0];
+    if (changed && track && preset) {
+        // applyConstraints 会替换全部约束，分辨率也要一并传入
+        const constraints = value
+            ? { ...CAPTURE_CONSTRAINTS, frameRate: { max: preset.idleFramerate } }
+            : CAPTURE_CONSTRAINTS;
+        track.applyConstraints(constraints).catch(error => console.error('调整采集帧率失败:', error));
+    }
+    peerConnections.forEach(pc => applyEncoding(pc));
+}
+
+// 按当前预设和自适应档位设置视频发送参数
+async function applyEncoding(pc, availableBitrate) {
+    const preset = serverConfig.presets[currentPreset];
+    const sender = pc.getSenders().find(s => s.track && s.track.kind === 'video');
+    if (!preset || !sender) return;
+
+    const level = preset.levels[pc.adaptLevel || 0];
+    const params = sender.getParameters();
+    if (!params.encodings || params.encodings.length === 0) return;
+
+    let maxBitrate = preset.maxBitrate;
+    if (availableBitrate) {
+        maxBitrate = Math.min(maxBitrate, Math.floor(availableBitrate * 0.85));
+    }
+    params.degradationPreference = preset.degradationPreference;
+    const layerScale = serverConfig.layers[pc.layer] || 1;
+    params.encodings.forEach(encoding => {
+        encoding.maxBitrate = Math.floor(maxBitrate / (layerScale * layerScale));
+        encoding.scaleResolutionDownBy = level.scaleResolutionDownBy * layerScale;
+        encoding.maxFramerate = contentStatic ? Math.min(level.maxFramerate, preset.idleFramerate)
+            : level.maxFramerate;
+    });
+    try {
+        await sender.setParameters(params);
+    } catch (error) {
+        console.error('设置编码参数失败:', error);
+    }
+}
+
+// 根据每个观看者连接的网络状况调整编码档位
+async function adaptSenders() {
+    const preset = serverConfig.presets[currentPreset];
+    if (!preset) return;
+
+    for (const pc of peerConnections.values()) {
+        if (pc.connectionState !== 'connected') continue;
+
+        let rtt = null, loss = null, available = null;
+        const stats = await pc.getStats();
+        stats.forEach(report => {
+            if (report.type === 'candidate-pair' && report.nominated && report.state === 'succeeded') {
+                rtt = report.currentRoundTripTime ?? rtt;
+                available = report.availableOutgoingBitrate ?? available;
+            } else if (report.type === 'remote-inbound-rtp' && report.kind === 'video') {
+                loss = report.fractionLost ?? loss;
+                rtt = rtt ?? report.roundTripTime;
+            }
+        });
+
+        const level = pc.adaptLevel || 0;
+        if ((loss !== null && loss > LOSS_DOWN) || (rtt !== null && rtt > RTT_DOWN)) {
+            pc.adaptLevel = Math.min(level + 1, preset.levels.length - 1);
+            pc.goodSamples = 0;
+        } else if ((loss === null || loss < LOSS_UP) && (rtt === null || rtt < RTT_UP)) {
+            pc.goodSamples = (pc.goodSamples || 0) + 1;
+            if (pc.goodSamples >= UP_SAMPLES && level > 0) {
+                pc.adaptLevel = level - 1;
+                pc.goodSamples = 0;
+            }
+        }
+        await applyEncoding(pc, available);
+    }
+}
+
+// 观看者请求切换画面层级
+function handleLayerRequest(layer, viewerId) {
+    const pc = peerConnections.get(viewerId);
+    if (!pc || !(layer in serverConfig.layers)) return;
+    pc.layer = layer;
+    applyEncoding(pc);
+}
+
+// 观看端按显示尺寸和网络带宽选择画面层级
+function selectLayer() {
+    const remoteVideo = document.getElementById('remoteVideo');
+    if (isSharing || remotePeerId === null || !remoteVideo.videoWidth) return;
+
+    // 按当前层级反推投屏端原始宽度
+    const sourceWidth = remoteVideo.videoWidth * (serverConfig.layers[currentLayer] || 1);
+    const displayWidth = (document.fullscreenElement === remoteVideo ? screen.width : remoteVideo.clientWidth)
+        * (window.devicePixelRatio || 1);
+    const layers = Object.entries(serverConfig.layers).sort((a, b) => b[1] - a[1]);
+
+    // 选满足显示宽度的最小层级
+    let layer = 'full';
+    for (const [name, scale] of layers) {
+        if (sourceWidth / scale >= displayWidth) {
+            layer = name;
+            break;
+        }
+    }
+    // 带宽不足时进一步降低层级
+    const downlink = navigator.connection && navigator.connection.downlink;
+    if (downlink && downlink < 2) {
+        const minScale = downlink < 1 ? 4 : 2;
+        const fallback = layers.find(([, scale]) => scale <= minScale);
+        if (fallback && fallback[1] > serverConfig.layers[layer]) {
+            layer = fallback[0];
+        }
+    }
+
+    if (layer !== currentLayer) {
+        currentLayer = layer;
+        sendMessage({
+            type: 'request-layer',
+            targetId: remotePeerId,
+            data: layer
+        });
+    }
+}
+
+// 关闭与指定观看者的连接
+function closeViewerConnection(viewerId) {
+    const pc = peerConnections.get(viewerId);
+    if (pc) {
+        pc.close();
+        peerConnections.delete(viewerId);
+    }
+}
+
+// 创建观看者连接
+async function createViewerConnection() {
+    if (isSharing) return;
+
+    if (peerConnection) {
+        peerConnection.close();
+    }
+
+    peerConnection = new RTCPeerConnection(rtcConfig);
+    appliedLatencyProfile = null;
+
+    // 监听远程流
+    // SFU 转发的音视频轨道不在同一个流里，统一合并到一个流中播放
+    const remoteStream = new MediaStream();
+    peerConnection.ontrack = (event) => {
+        if (event.track) {
+            applyLatencyProfile(event.receiver);
+            remoteStream.addTrack(event.track);
+            const remoteVideo = document.getElementById('remoteVideo');
+            remoteVideo.srcObject = remoteStream;
+            remoteVideo.style.display = 'block';
+            document.getElementById('remotePlaceholder').style.display = 'none';
+
+            // 确保自动播放
+            remoteVideo.play().catch(e => {
+                console.error('自动播放失败:', e);
+                // 如果自动播放失败，尝试设置静音后播放
+                remoteVideo.muted = true;
+                remoteVideo.play().catch(err => console.error('静音播放也失败:', err));
+            });
+        }
+    };
+
+    // ICE 候选处理
+    const pc = peerConnection;
+    const targetId = remotePeerId;
+    pc.onicecandidate = (event) => queueLocalCandidate(pc, targetId, event.candidate);
+}
+
+// 按服务端下发的时延档位设置接收器的抖动缓冲目标，音视频使用同一目标以保持同步
+function applyLatencyProfile(receiver) {
+    const name = serverConfig.latencyProfile;
+    const profile = name && serverConfig.latencyProfiles && serverConfig.latencyProfiles[name];
+    if (!profile || !receiver) return;
+
+    const target = profile.jitterBufferTarget;
+    try {
+        if ('jitterBufferTarget' in receiver) {
+            receiver.jitterBufferTarget = target;
+        } else if ('playoutDelayHint' in receiver) {
+            // 旧版 Chrome 的非标准属性，单位为秒
+            receiver.playoutDelayHint = target / 1000;
+        } else {
+            return;
+        }
+        appliedLatencyProfile = name;
+    } catch (error) {
+        console.error('设置抖动缓冲目标失败:', error);
+    }
+}
+
+// 处理 offer
+async function handleOffer(offer, from, restart, generation) {
+    if (isSharing) return;
+
+    if (restart && peerConnection && remotePeerId === from && peerConnection.signalingState !== 'closed') {
+        await handleRestartOffer(offer, from);
+        return;
+    }
+    remotePeerId = from;
+    currentLayer = 'full';  // 新连接从完整画面开始
+    await createViewerConnection();
+    // SFU 等服务端对端不带代次
+    peerConnection.generation = generation || 0;
+
+    try {
+        await peerConnection.setRemoteDescription(offer);
+        await addPendingCandidates(peerConnection, from);
+        const answer = await peerConnection.createAnswer();
+        await peerConnection.setLocalDescription(answer);
+
+        sendMessage({
+            type: 'answer',
+            targetId: from,
+            data: answer
+        });
+    } catch (error) {
+        console.error('处理offer失败:', error);
+    }
+}
+
+// ICE 重启的 offer：在原连接上应答，画面不中断
+async function handleRestartOffer(offer, from) {
+    try {
+        await peerConnection.setRemoteDescription(offer);
+        const answer = await peerConnection.createAnswer();
+        await peerConnection.setLocalDescription(answer);
+        sendMessage({
+            type: 'answer',
+            targetId: from,
+            data: answer
+        });
+    } catch (error) {
+        console.error('处理ICE重启失败:', error);
+    }
+}
+
+// 处理 answer
+async function handleAnswer(answer, from) {
+    const pc = peerConnections.get(from);
+    if (!pc) return;
+
+    try {
+        await pc.setRemoteDescription(answer);
+        await addPendingCandidates(pc, from);
+    } catch (error) {
+        console.error('处理answer失败:', error);
+    }
+}
+
+// 合并短时间内产生的本端候选，收集结束时立即发送并附带结束标记
+function queueLocalCandidate(pc, targetId, candidate) {
+    if (!pc.candidateBatch) {
+        pc.candidateBatch = { candidates: [], timer: null };
+    }
+    const batch = pc.candidateBatch;
+    if (candidate && candidate.candidate) {
+        batch.candidates.push(candidate.toJSON());
+    }
+    if (!candidate) {
+        clearTimeout(batch.timer);
+        flushLocalCandidates(pc, targetId, true);
+    } else if (!batch.timer) {
+        batch.timer = setTimeout(() => flushLocalCandidates(pc, targetId, false), ICE_BATCH_WINDOW);
+    }
+}
+
+function flushLocalCandidates(pc, targetId, done) {
+    const batch = pc.candidateBatch;
+    batch.timer = null;
+    if (!batch.candidates.length && !done) return;
+    if (pc.signalingState === 'closed') return;
+    sendMessage({
+        type: 'ice-candidates',
+        targetId: targetId,
+        data: { candidates: batch.candidates, done: done, generation: pc.generation || 0 }
+    });
+    batch.candidates = [];
+}
+
+// 处理一批 ICE 候选，属于尚未建立的连接或远端描述未设置时先缓存
+async function handleIceCandidates(data, from) {
+    const candidates = [...(data.candidates || [])];
+    if (data.done) candidates.push(null);
+    const pc = isSharing ? peerConnections.get(from) :
+        (from === remotePeerId ? peerConnection : null);
+    // 服务端对端的候选不带代次，属于当前连接
+    const generation = data.generation ?? (pc ? pc.generation || 0 : 0);
+    const current = pc ? pc.generation || 0 : -1;
+    if (generation < current) return;  // 已被替换的连接
+    if (generation > current || !pc.remoteDescription) {
+        let byGeneration = pendingCandidates.get(from);
+        if (!byGeneration) pendingCandidates.set(from, byGeneration = new Map());
+        const pending = [...(byGeneration.get(generation) || []), ...candidates];
+        byGeneration.set(generation, pending.slice(-PENDING_CANDIDATES_MAX));
+        return;
+    }
+    await addCandidates(pc, candidates);
+}
+
+// 远端描述设置后补上该连接之前缓存的候选，更早连接的一并丢弃
+async function addPendingCandidates(pc, from) {
+    const byGeneration = pendingCandidates.get(from);
+    if (!byGeneration) return;
+    const generation = pc.generation || 0;
+    const candidates = byGeneration.get(generation) || [];
+    for (const key of [...byGeneration.keys()]) {
+        if (key <= generation) byGeneration.delete(key);
+    }
+    if (!byGeneration.size) pendingCandidates.delete(from);
+    await addCandidates(pc, candidates);
+}
+
+async function addCandidates(pc, candidates) {
+    for (const candidate of candidates) {
+        try {
+            // 不带参数表示对端候选已全部发送
+            await (candidate ? pc.addIceCandidate(candidate) : pc.addIceCandidate());
+        } catch (error) {
+            console.error('添加ICE候选失败:', error);
+        }
+    }
+}
+
+// 处理停止分享
+function handleStopSharing(from) {
+    pendingCandidates.delete(from);
+    // 观看者离开时只清理投屏端上对应的连接
+    if (isSharing) {
+        closeViewerConnection(from);
+        return;
+    }
+    if (from !== remotePeerId) return;
+
+    if (peerConnection) {
+        peerConnection.close();
+        peerConnection = null;
+    }
+    remotePeerId = null;
+
+    // 重置远程视频
+    document.getElementById('remoteVideo').style.display = 'none';
+    document.getElementById('remotePlaceholder').style.display = 'flex';
+    document.getElementById('remoteVideo').srcObject = null;
+}
+
+// 发送消息
+function sendMessage(message) {
+    if (websocket && websocket.readyState === WebSocket.OPEN) {
+        websocket.send(JSON.stringify(message));
+    }
+}
+
+// 统计从请求观看到画面开始播放的耗时
+function reportFirstFrame() {
+    if (watchRequestedAt === null) return;
+    const elapsed = Math.round(performance.now() - watchRequestedAt);
+    watchRequestedAt = null;
+    console.log(`首帧耗时: ${elapsed}ms`);
+    updateStatus(`已连接，首帧耗时 ${elapsed}ms`, true);
+}
+
+// 更新状态
+function updateStatus(message, isConnected) {
+    const status = document.getElementById('status');
+    status.textContent = `连接状态: ${message}`;
+    status.className = `status ${isConnected ? 'connected' : 'disconnected'}`;
+}
+
+// 页面关闭清理
+window.onbeforeunload = function() {
+    if (isSharing) {
+        stopSharing();
+    }
+};
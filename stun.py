@@ -0,0 +1,226 @@
+"""运行在 asyncio 事件循环上的 STUN 服务器 (RFC 5389)"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import socket
+import struct
+import time
+import zlib
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+MAGIC_COOKIE = 0x2112A442
+MAGIC_COOKIE_BYTES = struct.pack('!I', MAGIC_COOKIE)
+FINGERPRINT_XOR = 0x5354554E
+
+# 消息类型
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+BINDING_ERROR = 0x0111
+
+# 属性类型
+ATTR_MAPPED_ADDRESS = 0x0001
+ATTR_USERNAME = 0x0006
+ATTR_MESSAGE_INTEGRITY = 0x0008
+ATTR_ERROR_CODE = 0x0009
+ATTR_XOR_MAPPED_ADDRESS = 0x0020
+ATTR_FINGERPRINT = 0x8028
+
+FAMILY_IPV4 = 0x01
+FAMILY_IPV6 = 0x02
+
+HEADER = struct.Struct('!HHI12s')
+ATTR_HEADER = struct.Struct('!HH')
+XOR_ADDRESS_V4 = struct.Struct('!HHBBH4s')
+XOR_ADDRESS_V6 = struct.Struct('!HHBBH16s')
+MESSAGE_INTEGRITY = struct.Struct('!HH20s')
+FINGERPRINT = struct.Struct('!HHI')
+
+# 从收到请求到响应交给内核的耗时
+STUN_RESPONSE_SECONDS = Histogram(
+    "stun_response_seconds", "STUN/TURN 请求处理耗时",
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01))
+
+# 响应最大长度：头部 + IPv6 XOR-MAPPED-ADDRESS + MESSAGE-INTEGRITY + FINGERPRINT
+MAX_RESPONSE_SIZE = HEADER.size + XOR_ADDRESS_V6.size + MESSAGE_INTEGRITY.size + FINGERPRINT.size + 32
+
+
+def parse_attributes(data: bytes) -> dict[int, tuple[int, bytes]] | None:
+    """解析属性，返回 {类型: (属性在消息中的偏移, 值)}，格式错误返回 None"""
+    attributes = {}
+    offset = HEADER.size
+    end = HEADER.size + struct.unpack_from('!H', data, 2)[0]
+    if end > len(data):
+        return None
+    while offset + ATTR_HEADER.size <= end:
+        attr_type, attr_length = ATTR_HEADER.unpack_from(data, offset)
+        value_start = offset + ATTR_HEADER.size
+        if value_start + attr_length > end:
+            return None
+        attributes.setdefault(attr_type, (offset, data[value_start:value_start + attr_length]))
+        offset = value_start + (attr_length + 3) // 4 * 4
+    return attributes
+
+
+def fingerprint_valid(data: bytes, offset: int, value: bytes) -> bool:
+    return (zlib.crc32(data[:offset]) ^ FINGERPRINT_XOR) == struct.unpack('!I', value)[0]
+
+
+def message_integrity_valid(data: bytes, offset: int, value: bytes, key: bytes) -> bool:
+    """校验 MESSAGE-INTEGRITY，长度字段需改写为截止到该属性末尾"""
+    length = offset + MESSAGE_INTEGRITY.size - HEADER.size
+    signed = data[:2] + struct.pack('!H', length) + data[4:offset]
+    expected = hmac.new(key, signed, hashlib.sha1).digest()
+    return hmac.compare_digest(expected, value)
+
+
+def xor_address(host: str) -> tuple[int, bytes]:
+    """返回地址族和未异或的地址字节，IPv4 映射的 IPv6 地址按 IPv4 处理"""
+    if ':' in host:
+        if host.startswith('::ffff:') and '.' in host:
+            return FAMILY_IPV4, socket.inet_aton(host[7:])
+        return FAMILY_IPV6, socket.inet_pton(socket.AF_INET6, host.split('%', 1)[0])
+    return FAMILY_IPV4, socket.inet_aton(host)
+
+
+def pack_xor_mapped_address(buf: bytearray, offset: int, addr: tuple, transaction_id: bytes,
+                            attr_type: int = ATTR_XOR_MAPPED_ADDRESS) -> int:
+    """在 offset 处写入 XOR 地址属性，返回写入后的偏移"""
+    family, address = xor_address(addr[0])
+    port = addr[1] ^ (MAGIC_COOKIE >> 16)
+    if family == FAMILY_IPV4:
+        xored = (int.from_bytes(address, 'big') ^ MAGIC_COOKIE).to_bytes(4, 'big')
+        XOR_ADDRESS_V4.pack_into(buf, offset, attr_type, 8, 0, family, port, xored)
+        return offset + XOR_ADDRESS_V4.size
+    mask = int.from_bytes(MAGIC_COOKIE_BYTES + transaction_id, 'big')
+    xored = (int.from_bytes(address, 'big') ^ mask).to_bytes(16, 'big')
+    XOR_ADDRESS_V6.pack_into(buf, offset, attr_type, 20, 0, family, port, xored)
+    return offset + XOR_ADDRESS_V6.size
+
+
+def unpack_xor_address(value: bytes, transaction_id: bytes) -> tuple[str, int] | None:
+    """解析 XOR 地址属性的值"""
+    if len(value) < 8:
+        return None
+    family, port = value[1], struct.unpack_from('!H', value, 2)[0] ^ (MAGIC_COOKIE >> 16)
+    if family == FAMILY_IPV4:
+        address = (int.from_bytes(value[4:8], 'big') ^ MAGIC_COOKIE).to_bytes(4, 'big')
+        return socket.inet_ntoa(address), port
+    if family == FAMILY_IPV6 and len(value) >= 20:
+        mask = int.from_bytes(MAGIC_COOKIE_BYTES + transaction_id, 'big')
+        address = (int.from_bytes(value[4:20], 'big') ^ mask).to_bytes(16, 'big')
+        return socket.inet_ntop(socket.AF_INET6, address), port
+    return None
+
+
+def pack_attribute(buf: bytearray, offset: int, attr_type: int, value: bytes) -> int:
+    """在 offset 处写入一个属性并按4字节对齐，返回写入后的偏移"""
+    ATTR_HEADER.pack_into(buf, offset, attr_type, len(value))
+    offset += ATTR_HEADER.size
+    buf[offset:offset + len(value)] = value
+    padded = offset + (len(value) + 3) // 4 * 4
+    buf[offset + len(value):padded] = bytes(padded - offset - len(value))
+    return padded
+
+
+def finish_message(buf: bytearray, offset: int, msg_type: int, transaction_id: bytes,
+                   key: bytes | None = None) -> int:
+    """写入消息头，按需追加 MESSAGE-INTEGRITY 和 FINGERPRINT，返回消息总长度"""
+    if key is not None:
+        HEADER.pack_into(buf, 0, msg_type, offset + MESSAGE_INTEGRITY.size - HEADER.size,
+                         MAGIC_COOKIE, transaction_id)
+        digest = hmac.new(key, memoryview(buf)[:offset], hashlib.sha1).digest()
+        MESSAGE_INTEGRITY.pack_into(buf, offset, ATTR_MESSAGE_INTEGRITY, 20, digest)
+        offset += MESSAGE_INTEGRITY.size
+    HEADER.pack_into(buf, 0, msg_type, offset + FINGERPRINT.size - HEADER.size,
+                     MAGIC_COOKIE, transaction_id)
+    crc = zlib.crc32(memoryview(buf)[:offset]) ^ FINGERPRINT_XOR
+    FINGERPRINT.pack_into(buf, offset, ATTR_FINGERPRINT, 4, crc)
+    return offset + FINGERPRINT.size
+
+
+def pack_error_code(buf: bytearray, offset: int, code: int, reason: bytes) -> int:
+    value = struct.pack('!HBB', 0, code // 100, code % 100) + reason
+    return pack_attribute(buf, offset, ATTR_ERROR_CODE, value)
+
+
+class STUNProtocol(asyncio.DatagramProtocol):
+    """处理 STUN Binding 请求
+
+    integrity_key(username) 返回短期凭证的密钥；未提供时按 RFC 5389 忽略请求中的
+    MESSAGE-INTEGRITY，提供时校验失败返回 401。
+    """
+
+    def __init__(self, integrity_key=None):
+        self.integrity_key = integrity_key
+        self.transport = None
+        # 响应缓冲区预先分配，sendto 会立即拷贝数据，可以重复使用
+        self.buffer = bytearray(MAX_RESPONSE_SIZE)
+        self.requests = 0
+        self.errors = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        if len(data) < HEADER.size or data[0] & 0xC0:
+            return
+        msg_type, _, magic_cookie, transaction_id = HEADER.unpack_from(data)
+        if magic_cookie != MAGIC_COOKIE:
+            return
+        start = time.perf_counter()
+        length = self.handle(data, msg_type, transaction_id, addr)
+        if length:
+            self.transport.sendto(memoryview(self.buffer)[:length], addr)
+            STUN_RESPONSE_SECONDS.observe(time.perf_counter() - start)
+
+    def handle(self, data: bytes, msg_type: int, transaction_id: bytes, addr: tuple) -> int:
+        """处理一条请求，响应写入 self.buffer，返回响应长度，0 表示不响应"""
+        if msg_type != BINDING_REQUEST:
+            return 0
+        self.requests += 1
+        key = None
+        if len(data) > HEADER.size:
+            attributes = parse_attributes(data)
+            if attributes is None:
+                return 0
+            if ATTR_FINGERPRINT in attributes and not fingerprint_valid(data, *attributes[ATTR_FINGERPRINT]):
+                return 0
+            if ATTR_MESSAGE_INTEGRITY in attributes and self.integrity_key is not None:
+                username = attributes.get(ATTR_USERNAME, (0, b''))[1]
+                key = self.integrity_key(username)
+                if key is None or not message_integrity_valid(data, *attributes[ATTR_MESSAGE_INTEGRITY], key):
+                    self.errors += 1
+                    offset = pack_error_code(self.buffer, HEADER.size, 401, b'Unauthorized')
+                    return finish_message(self.buffer, offset, BINDING_ERROR, transaction_id)
+        offset = pack_xor_mapped_address(self.buffer, HEADER.size, addr, transaction_id)
+        return finish_message(self.buffer, offset, BINDING_SUCCESS, transaction_id, key)
+
+
+async def start_stun_server(host: str = '::', port: int = 3478, protocol_factory=STUNProtocol,
+                            reuse_port: bool = False):
+    """在当前事件循环上启动 STUN 服务器，优先使用 IPv4/IPv6 双栈
+
+    reuse_port 允许多个进程绑定同一端口，由内核按来源地址分配数据报。
+    """
+    loop = asyncio.get_running_loop()
+    if host in ('::', '0.0.0.0') and socket.has_ipv6:
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('::', port))
+        except OSError:
+            # 系统禁用了 IPv6 时创建套接字本身就会失败，退回 IPv4
+            if sock is not None:
+                sock.close()
+            host = '0.0.0.0'
+        else:
+            return await loop.create_datagram_endpoint(protocol_factory, sock=sock)
+    return await loop.create_datagram_endpoint(protocol_factory, local_addr=(host, port),
+                                               reuse_port=reuse_port or None)
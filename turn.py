@@ -0,0 +1,429 @@
+"""内置 TURN 中继服务器 (RFC 8656，仅 UDP 中继)
+
+与 STUN 共用同一个端口。凭证采用 TURN REST API 的形式：用户名为 "过期时间戳:客户端ID"，
+密码为服务端密钥对用户名的 HMAC-SHA1，由信令连接在握手时下发，无需保存账号。
+"""
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import ipaddress
+import logging
+import os
+import struct
+import time
+
+from interfaces import local_address_for
+from stun import (ATTR_FINGERPRINT, ATTR_MESSAGE_INTEGRITY, ATTR_USERNAME, BINDING_REQUEST, HEADER,
+                  MAGIC_COOKIE, STUNProtocol, fingerprint_valid, finish_message, message_integrity_valid,
+                  pack_attribute, pack_error_code, pack_xor_mapped_address, parse_attributes,
+                  unpack_xor_address)
+
+logger = logging.getLogger(__name__)
+
+REALM = b"screenshare"
+
+# 方法
+METHOD_ALLOCATE = 0x003
+METHOD_REFRESH = 0x004
+METHOD_SEND = 0x006
+METHOD_DATA = 0x007
+METHOD_CREATE_PERMISSION = 0x008
+METHOD_CHANNEL_BIND = 0x009
+
+# 消息类别
+CLASS_MASK = 0x0110
+CLASS_REQUEST = 0x0000
+CLASS_INDICATION = 0x0010
+CLASS_SUCCESS = 0x0100
+CLASS_ERROR = 0x0110
+
+# 属性类型
+ATTR_CHANNEL_NUMBER = 0x000C
+ATTR_LIFETIME = 0x000D
+ATTR_XOR_PEER_ADDRESS = 0x0012
+ATTR_DATA = 0x0013
+ATTR_REALM = 0x0014
+ATTR_NONCE = 0x0015
+ATTR_XOR_RELAYED_ADDRESS = 0x0016
+ATTR_REQUESTED_TRANSPORT = 0x0019
+
+TRANSPORT_UDP = 17
+
+# 各类有效期（秒）
+DEFAULT_LIFETIME = 600
+MAX_LIFETIME = 3600
+PERMISSION_LIFETIME = 300
+CHANNEL_LIFETIME = 600
+NONCE_LIFETIME = 3600
+SWEEP_INTERVAL = 30
+
+CHANNEL_MIN = 0x4000
+CHANNEL_MAX = 0x4FFF
+CHANNEL_HEADER = struct.Struct('!HH')
+
+
+def issue_credentials(secret: bytes, client_id: int, ttl: int) -> tuple[str, str]:
+    """签发短期 TURN 凭证"""
+    username = f"{int(time.time()) + ttl}:{client_id}"
+    password = base64.b64encode(hmac.new(secret, username.encode(), hashlib.sha1).digest()).decode()
+    return username, password
+
+
+# 0.0.0.0/8 表示"本网络"，发往其中的地址在部分系统上会到达本机
+THIS_NETWORK = ipaddress.ip_network("0.0.0.0/8")
+
+
+@functools.lru_cache(maxsize=1024)
+def canonical_host(host: str) -> str | None:
+    """地址的规范写法，IPv4 映射的 IPv6 地址按 IPv4 处理，无效地址返回 None"""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return str(address)
+
+
+@functools.lru_cache(maxsize=1024)
+def peer_forbidden(host: str) -> bool:
+    """环回、未指定、本网络、链路本地（含云主机元数据服务）和组播地址不能作为中继对端"""
+    host = canonical_host(host)
+    if host is None:
+        return True
+    address = ipaddress.ip_address(host)
+    return (address.is_loopback or address.is_unspecified or address.is_link_local or address.is_multicast
+            or (address.version == 4 and address in THIS_NETWORK))
+
+
+class Allocation:
+    """一个客户端的中继分配"""
+
+    def __init__(self, client_addr: tuple, username: bytes, key: bytes, transaction_id: bytes):
+        self.client_addr = client_addr
+        self.username = username
+        self.key = key
+        self.transaction_id = transaction_id
+        self.transport = None
+        self.relay_addr = None
+        self.expires = 0.0
+        self.permissions: dict[str, float] = {}
+        self.channels: dict[int, tuple] = {}
+        self.peer_channels: dict[tuple, int] = {}
+        self.channel_expires: dict[int, float] = {}
+
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    """中继端口收到对端数据后转交给 TURN 服务器"""
+
+    def __init__(self, server: "TURNProtocol", allocation: Allocation):
+        self.server = server
+        self.allocation = allocation
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        self.server.relay_to_client(self.allocation, data, addr)
+
+
+class TURNProtocol(STUNProtocol):
+    def __init__(self, secret: bytes, relay_ip: str | None = None, realm: bytes = REALM,
+                 server_hosts=(), allowed_peers=()):
+        """server_hosts 为本机地址，不允许中继到这些地址，避免 TURN 被用来访问服务器本机的服务；
+        allowed_peers 仅供测试，列出的地址即使被禁止也允许中继"""
+        super().__init__(integrity_key=self.long_term_key)
+        self.secret = secret
+        self.relay_ip = relay_ip
+        self.server_hosts = {canonical_host(host) for host in (*server_hosts, relay_ip) if host} - {None}
+        self.allowed_peers = {canonical_host(host) for host in allowed_peers} - {None}
+        self.realm = realm
+        self.buffer = bytearray(512)
+        # ChannelData/Data 指示的发送缓冲区
+        self.relay_buffer = bytearray(65536 + 64)
+        self.allocations: dict[tuple, Allocation] = {}
+        self.relayed_packets = 0
+        self.relayed_bytes = 0
+        self.sweeper = None
+        # 保留打开中继端口的任务引用，防止任务在完成前被回收
+        self.pending: set[asyncio.Task] = set()
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.sweeper = asyncio.get_running_loop().call_later(SWEEP_INTERVAL, self.sweep)
+
+    def connection_lost(self, exc):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+        for allocation in list(self.allocations.values()):
+            self.release(allocation)
+
+    # 认证
+
+    def long_term_key(self, username: bytes) -> bytes | None:
+        """按用户名推导长期凭证密钥，凭证过期返回 None"""
+        try:
+            expiry = int(username.split(b':', 1)[0])
+        except ValueError:
+            return None
+        if expiry < time.time():
+            return None
+        password = base64.b64encode(hmac.new(self.secret, username, hashlib.sha1).digest())
+        return hashlib.md5(username + b':' + self.realm + b':' + password).digest()
+
+    def make_nonce(self) -> bytes:
+        timestamp = b'%x' % int(time.time())
+        tag = hmac.new(self.secret, timestamp, hashlib.sha1).hexdigest()[:16].encode()
+        return timestamp + b'-' + tag
+
+    def nonce_valid(self, nonce: bytes) -> bool:
+        timestamp, _, tag = nonce.partition(b'-')
+        try:
+            age = time.time() - int(timestamp, 16)
+        except ValueError:
+            return False
+        expected = hmac.new(self.secret, timestamp, hashlib.sha1).hexdigest()[:16].encode()
+        return age < NONCE_LIFETIME and hmac.compare_digest(tag, expected)
+
+    # 收包
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        # ChannelData 消息的前两位为 01
+        if data and 0x40 <= data[0] <= 0x4F:
+            self.channel_data(data, addr)
+            return
+        super().datagram_received(data, addr)
+
+    def handle(self, data: bytes, msg_type: int, transaction_id: bytes, addr: tuple) -> int:
+        if msg_type == BINDING_REQUEST:
+            return super().handle(data, msg_type, transaction_id, addr)
+        method, msg_class = msg_type & ~CLASS_MASK, msg_type & CLASS_MASK
+        attributes = parse_attributes(data)
+        if attributes is None:
+            return 0
+        if ATTR_FINGERPRINT in attributes and not fingerprint_valid(data, *attributes[ATTR_FINGERPRINT]):
+            return 0
+        if msg_class == CLASS_INDICATION:
+            if method == METHOD_SEND:
+                self.send_indication(attributes, transaction_id, addr)
+            return 0
+        if msg_class != CLASS_REQUEST or method not in (
+                METHOD_ALLOCATE, METHOD_REFRESH, METHOD_CREATE_PERMISSION, METHOD_CHANNEL_BIND):
+            return 0
+        self.requests += 1
+
+        # 除 Binding 外的请求都需要长期凭证
+        if ATTR_MESSAGE_INTEGRITY not in attributes:
+            return self.error(method, transaction_id, 401, b'Unauthorized', with_nonce=True)
+        if ATTR_USERNAME not in attributes or ATTR_NONCE not in attributes or ATTR_REALM not in attributes:
+            return self.error(method, transaction_id, 400, b'Bad Request')
+        username = attributes[ATTR_USERNAME][1]
+        key = self.long_term_key(username)
+        if key is None or not message_integrity_valid(data, *attributes[ATTR_MESSAGE_INTEGRITY], key):
+            return self.error(method, transaction_id, 401, b'Unauthorized', with_nonce=True)
+        if not self.nonce_valid(attributes[ATTR_NONCE][1]):
+            return self.error(method, transaction_id, 438, b'Stale Nonce', with_nonce=True)
+
+        if method == METHOD_ALLOCATE:
+            return self.allocate(attributes, transaction_id, addr, username, key)
+        allocation = self.allocations.get(addr)
+        if allocation is None or allocation.transport is None or allocation.username != username:
+            return self.error(method, transaction_id, 437, b'Allocation Mismatch')
+        if method == METHOD_REFRESH:
+            return self.refresh(allocation, attributes, transaction_id)
+        if method == METHOD_CREATE_PERMISSION:
+            return self.create_permission(allocation, attributes, transaction_id)
+        return self.channel_bind(allocation, attributes, transaction_id)
+
+    def error(self, method: int, transaction_id: bytes, code: int, reason: bytes,
+              with_nonce: bool = False) -> int:
+        self.errors += 1
+        offset = pack_error_code(self.buffer, HEADER.size, code, reason)
+        if with_nonce:
+            offset = pack_attribute(self.buffer, offset, ATTR_REALM, self.realm)
+            offset = pack_attribute(self.buffer, offset, ATTR_NONCE, self.make_nonce())
+        return finish_message(self.buffer, offset, method | CLASS_ERROR, transaction_id)
+
+    # 请求处理
+
+    def allocate(self, attributes: dict, transaction_id: bytes, addr: tuple, username: bytes, key: bytes) -> int:
+        existing = self.allocations.get(addr)
+        if existing is not None:
+            # 重传的 Allocate 请求返回相同的结果，分配中的请求直接忽略
+            if existing.transaction_id != transaction_id:
+                return self.error(METHOD_ALLOCATE, transaction_id, 437, b'Allocation Mismatch')
+            if existing.transport is None:
+                return 0
+            return self.allocate_success(existing, transaction_id)
+        transport = attributes.get(ATTR_REQUESTED_TRANSPORT)
+        if transport is None or transport[1][:1] != bytes([TRANSPORT_UDP]):
+            return self.error(METHOD_ALLOCATE, transaction_id, 442, b'Unsupported Transport Protocol')
+
+        allocation = Allocation(addr, username, key, transaction_id)
+        allocation.expires = time.monotonic() + self.requested_lifetime(attributes)
+        self.allocations[addr] = allocation
+        task = asyncio.create_task(self.open_relay(allocation))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return 0
+
+    async def open_relay(self, allocation: Allocation):
+        """为分配打开中继端口，完成后发送 Allocate 成功响应"""
+        loop = asyncio.get_running_loop()
+        try:
+            relay_ip = self.relay_ip or local_address_for(allocation.client_addr[0])
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: RelayProtocol(self, allocation), local_addr=(relay_ip, 0))
+        except OSError as e:
+            logger.warning("TURN 中继端口分配失败: %s", e)
+            self.allocations.pop(allocation.client_addr, None)
+            length = self.error(METHOD_ALLOCATE, allocation.transaction_id, 508, b'Insufficient Capacity')
+            self.transport.sendto(memoryview(self.buffer)[:length], allocation.client_addr)
+            return
+        if self.allocations.get(allocation.client_addr) is not allocation:
+            transport.close()
+            return
+        allocation.transport = transport
+        allocation.relay_addr = transport.get_extra_info('sockname')[:2]
+        length = self.allocate_success(allocation, allocation.transaction_id)
+        self.transport.sendto(memoryview(self.buffer)[:length], allocation.client_addr)
+
+    def allocate_success(self, allocation: Allocation, transaction_id: bytes) -> int:
+        offset = pack_xor_mapped_address(self.buffer, HEADER.size, allocation.relay_addr, transaction_id,
+                                         ATTR_XOR_RELAYED_ADDRESS)
+        offset = pack_xor_mapped_address(self.buffer, offset, allocation.client_addr, transaction_id)
+        lifetime = max(0, int(allocation.expires - time.monotonic()))
+        offset = pack_attribute(self.buffer, offset, ATTR_LIFETIME, struct.pack('!I', lifetime))
+        return finish_message(self.buffer, offset, METHOD_ALLOCATE | CLASS_SUCCESS, transaction_id, allocation.key)
+
+    def requested_lifetime(self, attributes: dict) -> int:
+        if ATTR_LIFETIME not in attributes:
+            return DEFAULT_LIFETIME
+        return min(struct.unpack('!I', attributes[ATTR_LIFETIME][1][:4])[0], MAX_LIFETIME)
+
+    def refresh(self, allocation: Allocation, attributes: dict, transaction_id: bytes) -> int:
+        lifetime = self.requested_lifetime(attributes)
+        if lifetime == 0:
+            self.release(allocation)
+        else:
+            allocation.expires = time.monotonic() + lifetime
+        offset = pack_attribute(self.buffer, HEADER.size, ATTR_LIFETIME, struct.pack('!I', lifetime))
+        return finish_message(self.buffer, offset, METHOD_REFRESH | CLASS_SUCCESS, transaction_id, allocation.key)
+
+    def create_permission(self, allocation: Allocation, attributes: dict, transaction_id: bytes) -> int:
+        peer = self.peer_address(attributes, transaction_id)
+        if peer is None:
+            return self.error(METHOD_CREATE_PERMISSION, transaction_id, 400, b'Bad Request')
+        if self.peer_refused(peer[0]):
+            return self.error(METHOD_CREATE_PERMISSION, transaction_id, 403, b'Forbidden')
+        allocation.permissions[peer[0]] = time.monotonic() + PERMISSION_LIFETIME
+        return finish_message(self.buffer, HEADER.size, METHOD_CREATE_PERMISSION | CLASS_SUCCESS,
+                              transaction_id, allocation.key)
+
+    def channel_bind(self, allocation: Allocation, attributes: dict, transaction_id: bytes) -> int:
+        peer = self.peer_address(attributes, transaction_id)
+        channel = attributes.get(ATTR_CHANNEL_NUMBER)
+        if peer is None or channel is None:
+            return self.error(METHOD_CHANNEL_BIND, transaction_id, 400, b'Bad Request')
+        if self.peer_refused(peer[0]):
+            return self.error(METHOD_CHANNEL_BIND, transaction_id, 403, b'Forbidden')
+        number = struct.unpack('!H', channel[1][:2])[0]
+        # 通道号和对端地址必须一一对应
+        if (not CHANNEL_MIN <= number <= CHANNEL_MAX
+                or allocation.channels.get(number, peer) != peer
+                or allocation.peer_channels.get(peer, number) != number):
+            return self.error(METHOD_CHANNEL_BIND, transaction_id, 400, b'Bad Request')
+        now = time.monotonic()
+        allocation.channels[number] = peer
+        allocation.peer_channels[peer] = number
+        allocation.channel_expires[number] = now + CHANNEL_LIFETIME
+        allocation.permissions[peer[0]] = now + PERMISSION_LIFETIME
+        return finish_message(self.buffer, HEADER.size, METHOD_CHANNEL_BIND | CLASS_SUCCESS,
+                              transaction_id, allocation.key)
+
+    def peer_refused(self, host: str) -> bool:
+        canonical = canonical_host(host)
+        if canonical in self.allowed_peers:
+            return False
+        return peer_forbidden(host) or canonical in self.server_hosts
+
+    def peer_address(self, attributes: dict, transaction_id: bytes) -> tuple | None:
+        if ATTR_XOR_PEER_ADDRESS not in attributes:
+            return None
+        return unpack_xor_address(attributes[ATTR_XOR_PEER_ADDRESS][1], transaction_id)
+
+    # 数据中继
+
+    def send_indication(self, attributes: dict, transaction_id: bytes, addr: tuple):
+        """客户端通过 Send 指示发给对端"""
+        allocation = self.allocations.get(addr)
+        if allocation is None or allocation.transport is None or ATTR_DATA not in attributes:
+            return
+        peer = self.peer_address(attributes, transaction_id)
+        if peer is None or self.peer_refused(peer[0]) or allocation.permissions.get(peer[0], 0) < time.monotonic():
+            return
+        data = attributes[ATTR_DATA][1]
+        allocation.transport.sendto(data, peer)
+        self.relayed_packets += 1
+        self.relayed_bytes += len(data)
+
+    def channel_data(self, data: bytes, addr: tuple):
+        """客户端通过 ChannelData 发给对端"""
+        allocation = self.allocations.get(addr)
+        if allocation is None or allocation.transport is None or len(data) < CHANNEL_HEADER.size:
+            return
+        number, length = CHANNEL_HEADER.unpack_from(data)
+        peer = allocation.channels.get(number)
+        if peer is None or length > len(data) - CHANNEL_HEADER.size:
+            return
+        if allocation.permissions.get(peer[0], 0) < time.monotonic():
+            return
+        allocation.transport.sendto(memoryview(data)[CHANNEL_HEADER.size:CHANNEL_HEADER.size + length], peer)
+        self.relayed_packets += 1
+        self.relayed_bytes += length
+
+    def relay_to_client(self, allocation: Allocation, data: bytes, peer: tuple):
+        """对端发到中继端口的数据转发给客户端，已绑定通道的用 ChannelData"""
+        peer = peer[:2]
+        if allocation.permissions.get(peer[0], 0) < time.monotonic():
+            return
+        buf = self.relay_buffer
+        number = allocation.peer_channels.get(peer)
+        if number is not None:
+            CHANNEL_HEADER.pack_into(buf, 0, number, len(data))
+            buf[CHANNEL_HEADER.size:CHANNEL_HEADER.size + len(data)] = data
+            length = CHANNEL_HEADER.size + len(data)
+        else:
+            transaction_id = os.urandom(12)
+            offset = pack_xor_mapped_address(buf, HEADER.size, peer, transaction_id, ATTR_XOR_PEER_ADDRESS)
+            offset = pack_attribute(buf, offset, ATTR_DATA, data)
+            HEADER.pack_into(buf, 0, METHOD_DATA | CLASS_INDICATION, offset - HEADER.size,
+                             MAGIC_COOKIE, transaction_id)
+            length = offset
+        self.transport.sendto(memoryview(buf)[:length], allocation.client_addr)
+        self.relayed_packets += 1
+        self.relayed_bytes += len(data)
+
+    # 过期清理
+
+    def release(self, allocation: Allocation):
+        if self.allocations.get(allocation.client_addr) is allocation:
+            del self.allocations[allocation.client_addr]
+        if allocation.transport is not None:
+            allocation.transport.close()
+
+    def sweep(self):
+        """定期清理过期的分配、权限和通道，不为每个分配单独设定时器"""
+        now = time.monotonic()
+        for allocation in list(self.allocations.values()):
+            if allocation.expires < now:
+                self.release(allocation)
+                continue
+            for host, expires in list(allocation.permissions.items()):
+                if expires < now:
+                    del allocation.permissions[host]
+            for number, expires in list(allocation.channel_expires.items()):
+                if expires < now:
+                    peer = allocation.channels.pop(number)
+                    allocation.peer_channels.pop(peer, None)
+                    del allocation.channel_expires[number]
+        self.sweeper = asyncio.get_running_loop().call_later(SWEEP_INTERVAL, self.sweep)